@@ -1,5 +1,6 @@
 import click
 import youtube_dl
+import vodindex
 
 
 @click.command(
@@ -17,6 +18,8 @@ def download(url, filename):
     # https://github.com/ytdl-org/youtube-dl/blob/master/README.md#embedding-youtube-dl
     with youtube_dl.YoutubeDL(ydl_opts) as ydl:
         ydl.download([url])
+    # index the keyframes now so seeking and cutting never have to probe the file
+    vodindex.build(filename)
     return vodinf.get('created_at').timestamp()
 
 if __name__ == '__main__':
@@ -2,6 +2,7 @@ import subprocess
 import click
 import os
 import shutil
+import matchobserver
 
 
 @click.command(
@@ -11,7 +12,9 @@ import shutil
 @click.option('--outformat', default='frame%04d.jpg', help='Frame output filename. ex: frame%04.jpg')
 @click.option('--fps', default=1, help='Frames per second to export')
 @click.option('--ffmpeg_bin', default=None, help='Path to ffmpeg executable. Automatically searches PATH')
-def main(infile, outdir, outformat, fps, ffmpeg_bin):
+@click.option('--decode', default=matchobserver.DEFAULT_DECODE, type=click.Choice(sorted(matchobserver.DECODE_STRATEGIES)), help='Decode strategy, see benchmarks/decode.py')
+@click.option('--threads', default=None, type=int, help='Decoder threads. Picked by ffmpeg by default')
+def main(infile, outdir, outformat, fps, ffmpeg_bin, decode, threads):
 	# ensure outdir exists
 	os.makedirs(outdir, exist_ok=True)
 
@@ -21,11 +24,18 @@ def main(infile, outdir, outformat, fps, ffmpeg_bin):
 		if (ffmpeg_bin is None):
 			print('Unable to find ffmpeg. Please ensure it is installed and on your path. Or provide an absolute path with --ffmpeg')
 			sys.exit(1)
+	input_args, scale_filter = matchobserver.DECODE_STRATEGIES[decode]
+	if threads is not None:
+		input_args = input_args + ['-threads', str(threads)]
+	video_filter = 'fps={}'.format(fps)
+	if scale_filter is not None:
+		video_filter += ',' + scale_filter
 	ffmpeg_command = [
 		ffmpeg_bin,
 		'-hide_banner',
+	] + input_args + [
 		'-i', infile,
-		'-vf', 'fps={}'.format(fps),
+		'-vf', video_filter,
 		# '-an',
 		# '-sn',
 		# '-c:v', 'rawvideo',
@@ -1,10 +1,21 @@
+import hashlib
+import json
+import math
 import os
+import re
 import sys
 import click
+import functools
+import shutil
+import subprocess
+import threading
 import PIL
 import PIL.ImageEnhance
 import PIL.ImageOps
+import matchobserver
 import matchobserver.frc2017 as frc2017
+from matchobserver import observations
+import vodindex
 import time
 # from matchobserver.frc2017 import FRC2017VisionCore
 from multiprocessing import Pool
@@ -39,52 +50,48 @@ MATCH_DEFAULTS = {
 
 
 
+# Where VisionCore keeps the digit templates it learns between runs
+DIGITS_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'frcreplay')
+
 vc = None
 frames = []
 framedir = ""
-def setup(_framedir, _frames):
+digits_dir = None
+def setup(_framedir, _frames, _digits_dir=None):
 	global vc
 	global frames
 	global framedir
+	global digits_dir
 	frames = _frames
 	framedir = _framedir
+	digits_dir = _digits_dir
 
 
 	# Assume all frames are the same size
 	frame = PIL.Image.open(os.path.join(framedir, frames[0]))
 	width, height = frame.size
-	vc = frc2017.VisionCore(width, height)
+	vc = frc2017.VisionCore(width, height, digits_dir=digits_dir)
 
 
-count = 0
-def dowork(file):
-	global count
+def process_frame(frame, framenum):
 	info = {}
 	try:
 		start = time.time()
-		frame = PIL.Image.open(os.path.join(framedir, file)) #@todo load only portion of frame
-		info = vc.get_match_info(frame)
-		if info is None:
-			info = {}
-
-		info['frame'] = extract_digits(file)
-
-		if info is not None and 'type' in info:
-			if info['type'] == "game":
-				info['time'] = vc.get_match_time(frame)
-			if info['type'] == "outside":
-				info['type'] = vc.get_frame_type(frame)
-
-		if 'rect' in info:
-			del info['rect']
-
-
+		info = vc.observe(frame)
+		info['frame'] = framenum
 		info['_duration'] = time.time() - start
 	except Exception as e:
-		print('error processing frame {}'.format(extract_digits(file)), e)
+		print('error processing frame {}'.format(framenum), e)
+		info = {'frame': framenum}
 	finally:
 		return info
 
+count = 0
+def dowork(file):
+	global count
+	frame = PIL.Image.open(os.path.join(framedir, file)) #@todo load only portion of frame
+	return process_frame(frame, extract_digits(file))
+
 
 	# typ = vc.get_frame_type(frame)
 
@@ -97,48 +104,410 @@ def dowork(file):
 	# return (match_type, match_number)
 	return None
 
+DURATION_RE = re.compile(r'Duration: ([0-9]+):([0-9]+):([0-9.]+)')
 
-@click.command(help='Iterate through all frames')
+def video_filter(fps, roi_layout):
+	if roi_layout is None:
+		return 'fps={}'.format(fps)
+	return roi_layout.filtergraph('fps={}'.format(fps))
+
+def make_vision_core(width, height, roi_layout):
+	if roi_layout is None:
+		return frc2017.VisionCore(width, height, digits_dir=digits_dir)
+	return frc2017.VisionCore(roi_layout.base_width, roi_layout.base_height, roi_layout,
+		digits_dir)
+
+# Decode INFILE with ffmpeg and hand each frame to VisionCore straight from the
+# pipe. Frames are numbered from 1 like 2getframes.py's frame%04d.jpg output,
+# seeking straight to STARTFRAME instead of decoding everything before it.
+# With USEROI ffmpeg only hands over the bands of the frame VisionCore reads.
+def stream_frames(infile, fps, ffmpeg_bin, startframe=1, useroi=False):
+	global vc
+	startframe = max(startframe, 1)
+	roi_layout = frc2017.VisionCore.roi_layout() if useroi else None
+	ffmpeg_command = [
+		ffmpeg_bin,
+		'-hide_banner',
+		'-nostats',
+		'-ss', str((startframe - 1) / fps),
+		'-i', infile,
+		'-vf', video_filter(fps, roi_layout),
+	] + matchobserver.FFMPEG_OUTPUT_ARGS
+
+	print(' '.join(ffmpeg_command))
+
+	proc = subprocess.Popen(ffmpeg_command,
+		stdout=subprocess.PIPE,
+		stderr=subprocess.PIPE,
+		preexec_fn=os.setpgrp)
+	try:
+		width, height = matchobserver.read_video_resolution(proc.stderr)
+		# keep ffmpeg from blocking on a full stderr pipe
+		threading.Thread(target=proc.stderr.read, daemon=True).start()
+
+		# one core for every shard a process handles, so what it times and
+		# learns adds up
+		if vc is None:
+			vc = make_vision_core(width, height, roi_layout)
+		frames = matchobserver.read_frames(proc.stdout, width, height)
+		for framenum, frame in enumerate(frames, startframe):
+			yield process_frame(frame, framenum)
+	finally:
+		proc.kill()
+		proc.wait()
+
+def video_duration(infile, ffmpeg_bin):
+	proc = subprocess.run([ffmpeg_bin, '-hide_banner', '-i', infile],
+		stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	match = DURATION_RE.search(proc.stderr.decode('utf-8', 'replace'))
+	if match is None:
+		raise Exception('Failed to identify duration of {}'.format(infile))
+	hours, minutes, seconds = match.groups()
+	return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+# Decode only the frame at FRAMENUM, using input seeking so ffmpeg starts from
+# the nearest keyframe instead of the beginning of the file
+def grab_frame(infile, framenum, fps, ffmpeg_bin, roi_layout=None):
+	ffmpeg_command = [
+		ffmpeg_bin,
+		'-hide_banner',
+		'-nostats',
+		'-ss', str((framenum - 1) / fps),
+		'-i', infile,
+		'-frames:v', '1',
+	]
+	if roi_layout is not None:
+		ffmpeg_command += ['-vf', roi_layout.filtergraph('null')]
+	ffmpeg_command += matchobserver.FFMPEG_OUTPUT_ARGS
+
+	proc = subprocess.run(ffmpeg_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	match = matchobserver.VIDEO_RESOLUTION_RE.search(proc.stderr.decode('utf-8', 'replace'))
+	if match is None:
+		return None
+	width, height = int(match.group(1)), int(match.group(2))
+	if len(proc.stdout) < width * height * matchobserver.VIDEO_CHANNELS:
+		return None
+	return PIL.Image.frombuffer('RGB', (width, height), proc.stdout, 'raw', 'RGB', 0, 1)
+
+# Coarse-to-fine scan of a whole VOD. Rather than run VisionCore on every frame,
+# sample every STEP frames and bisect between neighbouring samples whose frame
+# type differs (preview -> game -> results ...) until the change is pinned down
+# to a single frame. STEP should stay well under the length of a match.
+# The coarse samples are moved onto the first frame at or after a keyframe
+# (from the VOD's index), so grabbing one decodes next to nothing.
+def seek_frames(infile, fps, ffmpeg_bin, step, startframe=1, endframe=sys.maxsize, useroi=False):
+	global vc
+	roi_layout = frc2017.VisionCore.roi_layout() if useroi else None
+	index = vodindex.load(infile, vodindex.find_ffprobe(ffmpeg_bin))
+	startframe = max(startframe, 1)
+	endframe = min(endframe, int(index.duration() * fps))
+	if endframe < startframe:
+		return []
+
+	seen = {}
+	def frame_type(framenum):
+		global vc
+		if framenum not in seen:
+			frame = grab_frame(infile, framenum, fps, ffmpeg_bin, roi_layout)
+			if frame is None:
+				seen[framenum] = {'frame': framenum}
+			else:
+				if vc is None:
+					vc = make_vision_core(frame.width, frame.height, roi_layout)
+				seen[framenum] = process_frame(frame, framenum)
+		return seen[framenum].get('type')
+
+	def refine(lo, hi):
+		if hi - lo <= 1:
+			return
+		mid = (lo + hi) // 2
+		typ = frame_type(mid)
+		if typ != frame_type(lo):
+			refine(lo, mid)
+		if typ != frame_type(hi):
+			refine(mid, hi)
+
+	samples = set([startframe, endframe])
+	for framenum in range(startframe, endframe + 1, step):
+		keyframe = math.ceil(index.keyframe_before((framenum - 1) / fps) * fps) + 1
+		samples.add(min(max(keyframe, startframe), endframe))
+	samples = sorted(samples)
+
+	vc = None
+	for lo, hi in zip(samples, samples[1:]):
+		if frame_type(lo) != frame_type(hi):
+			refine(lo, hi)
+
+	print('looked at {} of {} frames'.format(len(seen), endframe - startframe + 1))
+	return [seen[framenum] for framenum in sorted(seen)]
+
+# Collapse sorted observations into runs of the same frame type
+def segments(infos):
+	runs = []
+	for info in infos:
+		typ = info.get('type')
+		if len(runs) > 0 and runs[-1]['type'] == typ:
+			runs[-1]['endframe'] = info['frame']
+		else:
+			runs.append({'type': typ, 'startframe': info['frame'], 'endframe': info['frame']})
+		if 'match_type' in info:
+			runs[-1]['match_type'] = info['match_type']
+			runs[-1]['match_number'] = info['match_number']
+	return runs
+
+
+
+# Batch engine tuning. The per-frame cost is measured on the first few frames
+# and used to pick how many workers are worth spawning and how much work to
+# hand each one at a time.
+CALIBRATION_FRAMES = 3
+MIN_SECONDS_PER_WORKER = 10 # spawning a worker and loading VisionCore isn't free
+CHUNK_SECONDS = 5           # work per chunk of frame files
+SHARD_SECONDS = 60          # work per video shard, each one is a separate ffmpeg
+MIN_SHARD_FRAMES = 10
+CHUNKS_PER_WORKER = 4       # keep enough chunks around to balance the load
+
+video = None
+def setup_video(_video, _digits_dir=None):
+	global video
+	global digits_dir
+	video = _video
+	digits_dir = _digits_dir
+
+def dofile(file):
+	return [dowork(file)]
+
+# Decode and process the frames FIRST to LAST of the video with one ffmpeg
+def doshard(shard):
+	first, last = shard
+	infile, fps, ffmpeg_bin, useroi = video
+	results = []
+	infos = stream_frames(infile, fps, ffmpeg_bin, first, useroi)
+	try:
+		for info in infos:
+			if info['frame'] > last:
+				break
+			results.append(info)
+	finally:
+		infos.close()
+	return results
+
+# What a result log's observations depend on besides the frames themselves:
+# the input and settings they were made with and the VisionCore code that made
+# them. Kept next to the log so --resume can refuse to mix in stale results.
+def run_settings(framedir, fps, useroi):
+	code = hashlib.sha1()
+	package_dir = os.path.dirname(os.path.realpath(matchobserver.__file__))
+	for root, dirs, names in os.walk(package_dir):
+		dirs.sort()
+		for name in sorted(names):
+			if name.endswith('.py'):
+				with open(os.path.join(root, name), 'rb') as f:
+					code.update(f.read())
+	return {
+		'input': os.path.abspath(framedir),
+		'fps': fps,
+		'useroi': useroi,
+		'code': code.hexdigest(),
+	}
+
+def settings_path(path):
+	return path + '.settings'
+
+def read_settings(path):
+	if not os.path.isfile(settings_path(path)):
+		return None
+	with open(settings_path(path), 'r') as f:
+		return json.load(f)
+
+def write_settings(path, settings):
+	with open(settings_path(path), 'w') as f:
+		json.dump(settings, f)
+
+# Frame numbers already in the result log
+def read_result_log(path):
+	records, match_types = observations.load(path)
+	return set(records['frame'].tolist())
+
+# The result log back in frame order, ready for the state machine
+def ordered_results(path):
+	records, match_types = observations.load(path)
+	return observations.ordered(records), match_types
+
+def plan_batch(count, frame_cost, workers, chunksize, target_seconds, min_chunksize=1):
+	if workers <= 0:
+		workers = math.ceil(count * frame_cost / MIN_SECONDS_PER_WORKER)
+		workers = max(1, min(os.cpu_count() - 1, workers))
+	if chunksize <= 0:
+		balanced = math.ceil(count / (workers * CHUNKS_PER_WORKER))
+		chunksize = round(target_seconds / frame_cost) if frame_cost > 0 else balanced
+		chunksize = max(min_chunksize, min(chunksize, balanced), 1)
+	return workers, chunksize
+
+# Split sorted frame numbers into runs of consecutive frames at most SIZE long
+def shard_frames(framenums, size):
+	shards = []
+	for framenum in framenums:
+		if len(shards) > 0 and shards[-1][1] == framenum - 1 and \
+				shards[-1][1] - shards[-1][0] + 1 < size:
+			shards[-1][1] = framenum
+		else:
+			shards.append([framenum, framenum])
+	return [tuple(shard) for shard in shards]
+
+# WORKER's results for TASK in a pool process, with what the process's
+# VisionCore timed and learned doing it for this one to merge
+def pooled(worker, task):
+	return worker(task), vc.take_state()
+
+# Run WORKER over TASKS, appending every result to the observation log at
+# LOG_PATH as soon as it comes back, in whatever order the workers finish. The
+# digit templates learned and the time spent per stage, in the workers too,
+# are gathered in this process's VisionCore, then saved and reported.
+def run_batch(tasks, worker, initializer, initargs, workers, chunksize, log_path, total):
+	done = 0
+	with observations.ObservationLog(log_path) as log:
+		def record(results):
+			nonlocal done
+			log.append(results)
+			done += len(results)
+			print('{}/{} frames'.format(done, total))
+
+		if workers == 1:
+			# calibrate() already set this process up
+			for task in tasks:
+				record(worker(task))
+		else:
+			multiprocessing.set_start_method('spawn') # this is needed for CV to work on osx
+			with Pool(processes=workers, initializer=initializer, initargs=initargs) as p:
+				for results, state in p.imap_unordered(functools.partial(pooled, worker), tasks,
+						chunksize=chunksize):
+					record(results)
+					vc.merge_state(state)
+
+	if vc is not None:
+		vc.save_digits()
+		vc.timer.print_report()
+
+# Measure the cost of a frame by processing the first few in this process
+def calibrate(tasks, worker, initializer, initargs, log_path):
+	initializer(*initargs)
+	results = []
+	with observations.ObservationLog(log_path) as log:
+		for task in tasks:
+			results += worker(task)
+		log.append(results)
+	durations = [info['_duration'] for info in results if '_duration' in info]
+	if len(durations) == 0:
+		return 0
+	return sum(durations) / len(durations)
+
+
+@click.command(help='Iterate through all frames in FRAMEDIR. If FRAMEDIR is a video file the frames are decoded in memory instead of read from disk.')
 @click.argument('framedir')
-@click.option('--usemulti', default=False, help='Whether or not use multiprocessing')
-@click.option('--chunksize', default=10, help='')
+@click.option('--usemulti', is_flag=True, help='Whether or not use multiprocessing')
+@click.option('--workers', default=0, help='Number of worker processes. By default picked from the measured cost per frame')
+@click.option('--chunksize', default=0, help='Frames handed to a worker at a time (frames per shard for a video). By default picked from the measured cost per frame')
+@click.option('--resultlog', default=None, help='Observation log to write results to, replacing what was in it. Defaults to FRAMEDIR.obs')
+@click.option('--resume', is_flag=True, help='Keep the results already in the log and skip their frames. Refused if the log was made by different code or settings')
 @click.option('--startframe', default=0, help='')
 @click.option('--endframe', default=sys.maxsize, help='')
-def main(framedir, usemulti, chunksize, startframe, endframe):
+@click.option('--fps', default=1, help='Frames per second to process when FRAMEDIR is a video')
+@click.option('--ffmpeg_bin', default=None, help='Path to ffmpeg executable. Automatically searches PATH')
+@click.option('--useroi', is_flag=True, help='Only decode the regions of the frame VisionCore reads (video only)')
+@click.option('--digitsdir', default=DIGITS_DIR, help='Directory to keep the digit templates VisionCore learns in, between runs')
+@click.option('--seek', default=0, help='Sample every SEEK frames and bisect around changes instead of processing every frame (video only)')
+def main(framedir, usemulti, workers, chunksize, resultlog, resume, startframe, endframe, fps, ffmpeg_bin, useroi, digitsdir, seek):
+	global digits_dir
+	digits_dir = digitsdir
 
 	# startframe = 522
 	# endframe   = 845
 
-	files = []
-	# for name, file in test.items():
-	allfiles = os.listdir(framedir)
-	for file in allfiles:
-		# print(file, file == ".DS_Store")
-		if file == ".DS_Store":
-			continue
-		# return
-		framenum = extract_digits(file)
-		if startframe <= framenum <= endframe:
-			files.append(file)
-
-	print('there are {} frames'.format(len(files)))
-
-	if usemulti:
-		setupargs = [framedir, files]
-		multiprocessing.set_start_method('spawn') # this is needed for CV to work on osx
-		# start = time.time()
-		p = Pool(processes=(os.cpu_count()-1), initializer=setup, initargs=setupargs)
-		ret = p.map(dowork, files, chunksize=chunksize)
-		print(ret)
-		# print('all {} frames took {:2f}'.format(len(files), time.time() - start))
+	if resultlog is None:
+		resultlog = framedir.rstrip(os.sep) + '.obs'
+	settings = run_settings(framedir, fps, useroi)
+	if resume:
+		if os.path.isfile(resultlog) and read_settings(resultlog) != settings:
+			print('{} was made by different code or settings, run without --resume to start it over'.format(resultlog))
+			sys.exit(1)
+		done = read_result_log(resultlog)
+		if len(done) > 0:
+			print('resuming, {} frames already in {}'.format(len(done), resultlog))
 	else:
-		# start = time.time()
-		setup(framedir, files)
-		for file in files:
-			dowork(file)
-
-		# print('all {} frames took {:2f}'.format(count, time.time() - start))
-		# 7 frames in for loop takes ~4.8/5
+		observations.remove(resultlog)
+		done = set()
+	write_settings(resultlog, settings)
+
+	if os.path.isfile(framedir):
+		# If the user did not specify ffmpeg path, attempt to find with `which ffmpeg`
+		if ffmpeg_bin is None:
+			ffmpeg_bin = shutil.which('ffmpeg')
+			if (ffmpeg_bin is None):
+				print('Unable to find ffmpeg. Please ensure it is installed and on your path. Or provide an absolute path with --ffmpeg')
+				sys.exit(1)
+
+		if seek > 0:
+			infos = seek_frames(framedir, fps, ffmpeg_bin, seek, startframe, endframe, useroi)
+			with observations.ObservationLog(resultlog) as log:
+				log.append([info for info in infos if info['frame'] not in done])
+			for run in segments(infos):
+				print(run)
+			if vc is not None:
+				vc.save_digits()
+				vc.timer.print_report()
+			return
+
+		endframe = min(endframe, int(video_duration(framedir, ffmpeg_bin) * fps))
+		pending = [framenum for framenum in range(max(startframe, 1), endframe + 1)
+			if framenum not in done]
+		worker, initializer, initargs = doshard, setup_video, [(framedir, fps, ffmpeg_bin, useroi), digitsdir]
+		calibration = shard_frames(pending[:CALIBRATION_FRAMES], CALIBRATION_FRAMES)
+		pending = pending[CALIBRATION_FRAMES:]
+	else:
+		files = []
+		# for name, file in test.items():
+		allfiles = os.listdir(framedir)
+		for file in allfiles:
+			# print(file, file == ".DS_Store")
+			if file == ".DS_Store":
+				continue
+			# return
+			framenum = extract_digits(file)
+			if startframe <= framenum <= endframe and framenum not in done:
+				files.append(file)
+		files.sort(key=extract_digits)
+
+		print('there are {} frames'.format(len(files)))
+		if len(files) == 0:
+			return
+
+		worker, initializer, initargs = dofile, setup, [framedir, files, digitsdir]
+		calibration = files[:CALIBRATION_FRAMES]
+		pending = files[CALIBRATION_FRAMES:]
+
+	frame_cost = calibrate(calibration, worker, initializer, initargs, resultlog)
+	if not usemulti:
+		workers = 1
+
+	if worker is doshard:
+		workers, shard_size = plan_batch(len(pending), frame_cost, workers, chunksize,
+			SHARD_SECONDS, MIN_SHARD_FRAMES)
+		tasks, chunksize = shard_frames(pending, shard_size), 1
+	else:
+		workers, chunksize = plan_batch(len(pending), frame_cost, workers, chunksize,
+			CHUNK_SECONDS)
+		tasks = pending
+
+	print('{:.2f}s per frame, {} workers, chunks of {}'.format(
+		frame_cost, workers, shard_size if worker is doshard else chunksize))
+	# start = time.time()
+	run_batch(tasks, worker, initializer, initargs, workers, chunksize, resultlog, len(pending))
+	# print('all {} frames took {:2f}'.format(len(files), time.time() - start))
+	# 7 frames in for loop takes ~4.8/5
+
+	records, match_types = ordered_results(resultlog)
+	print('{} frames in {}'.format(len(records), resultlog))
 
 
 s = "test"
@@ -1,3 +1,159 @@
+import json
+import sys
+import time
+import click
+import numpy
+from numpy.lib.stride_tricks import sliding_window_view
+from matchobserver import matchstate
+from matchobserver import observations
+
+# Turns the noisy per frame observations written by 3processframes.py into
+# [Start of Match, End of Match, Score Posted] intervals. Everything works on
+# whole columns of the observation log at once, so a full event day segments in
+# a fraction of a second:
+#
+#   1. a rolling majority vote over the match id of the game frames
+#   2. run length encoding of the voted ids, splitting on gaps in the overlay
+#   3. fitting the countdown clock to each run, ignoring readings that disagree
+#   4. looking up the first results screen for the same match after it ends
+#
+# --online runs matchobserver.matchstate, the frame at a time version the live
+# recorder uses, over the same observations and prints its events instead.
+
+GAME = observations.FRAME_TYPES.index('game')
+RESULTS = observations.FRAME_TYPES.index('results')
+
+VOTE_WINDOW = 9 # game frames in the rolling match id vote
+MAX_GAP_SECONDS = 10 # longer gaps in the game overlay split a match
+MIN_MATCH_SECONDS = 20 # shorter runs of game frames are noise
+TIME_TOLERANCE_SECONDS = 2 # how far a time reading may be off the fitted clock
+MIN_AGREEING_TIMES = 3 # readings needed to trust a fitted clock
+RESULTS_SECONDS = 600 # how long after the end of a match to look for its score
+
+MATCH_CODE_BASE = 1 << 16 # match_number is an int16
+
+# One integer per record naming the match it shows, MISSING if unreadable
+def match_codes(records):
+	codes = records['match_type'].astype(numpy.int64) * MATCH_CODE_BASE + records['match_number']
+	missing = (records['match_type'] == observations.MISSING) | (records['match_number'] == observations.MISSING)
+	codes[missing] = observations.MISSING
+	return codes
+
+# Replace each code by the most common one in the WINDOW around it, ignoring
+# MISSING unless the whole window is
+def rolling_majority(codes, window=VOTE_WINDOW):
+	if len(codes) == 0:
+		return codes
+	half = window // 2
+	padded = numpy.pad(codes, half, mode='constant', constant_values=observations.MISSING)
+	windows = sliding_window_view(padded, 2 * half + 1)
+	votes = (windows[:, :, None] == windows[:, None, :]).sum(axis=2)
+	votes[windows == observations.MISSING] = 0
+	voted = windows[numpy.arange(len(codes)), votes.argmax(axis=1)]
+	voted[votes.max(axis=1) == 0] = observations.MISSING
+	return voted
+
+# Run length encode CODES, also breaking wherever FRAMES jumps by more than
+# MAX_GAP. Returns the first index of each run and one past its last.
+def runs(frames, codes, max_gap):
+	breaks = (codes[1:] != codes[:-1]) | (numpy.diff(frames) > max_gap)
+	starts = numpy.flatnonzero(numpy.concatenate(([True], breaks)))
+	ends = numpy.append(starts[1:], len(codes))
+	return starts, ends
+
+# Median of the STARTS that agree with the median of all of them
+def consensus(starts, tolerance):
+	if len(starts) == 0:
+		return None
+	agree = starts[numpy.abs(starts - numpy.median(starts)) <= tolerance]
+	if len(agree) < MIN_AGREEING_TIMES:
+		return None
+	return float(numpy.median(agree))
+
+# Fit the match clock to the time readings of one match. Every reading implies
+# the frame its period started on; readings over AUTON_TIME can only be teleop
+# and place the start of teleop, readings before that count down auto. Zeros
+# are left out since the clock sits on 0 between periods and after the match.
+# Returns the frames auto and teleop started on, either may be None.
+def fit_countdown(frames, times, fps, tolerance):
+	valid = (times > 0) & (times <= matchstate.TELEOP_TIME)
+	frames = frames[valid]
+	times = times[valid]
+	auto_starts = frames - (matchstate.AUTON_TIME - times) * fps
+	teleop_starts = frames - (matchstate.TELEOP_TIME - times) * fps
+
+	teleop_start = consensus(teleop_starts[times > matchstate.AUTON_TIME], tolerance)
+	if teleop_start is None:
+		in_auto = numpy.ones(len(frames), dtype=bool)
+	else:
+		in_auto = frames < teleop_start
+		teleop_start = consensus(teleop_starts[~in_auto], tolerance)
+	auto_start = consensus(auto_starts[in_auto & (times <= matchstate.AUTON_TIME)], tolerance)
+	return auto_start, teleop_start
+
+# Segment RECORDS (as returned by observations.ordered) into matches
+def segment(records, match_types, fps=1):
+	max_gap = MAX_GAP_SECONDS * fps
+	tolerance = TIME_TOLERANCE_SECONDS * fps
+
+	game = records[records['type'] == GAME]
+	frames = game['frame'].astype(numpy.int64)
+	times = game['time'].astype(numpy.int64)
+	codes = rolling_majority(match_codes(game))
+
+	starts, ends = runs(frames, codes, max_gap)
+	keep = codes[starts] != observations.MISSING
+	starts, ends = starts[keep], ends[keep]
+
+	# runs of the same match only split by noise are one match
+	if len(starts) > 0:
+		same = (codes[starts[1:]] == codes[starts[:-1]]) & \
+			(frames[starts[1:]] - frames[ends[:-1] - 1] <= max_gap)
+		first = numpy.concatenate(([True], ~same))
+		last = numpy.concatenate((~same, [True]))
+		starts, ends = starts[first], ends[last]
+
+	keep = frames[ends - 1] - frames[starts] >= MIN_MATCH_SECONDS * fps
+	starts, ends = starts[keep], ends[keep]
+
+	results = records[records['type'] == RESULTS]
+	result_frames = results['frame'].astype(numpy.int64)
+	result_codes = match_codes(results)
+
+	matches = []
+	for first, last in zip(starts, ends):
+		auto_start, teleop_start = fit_countdown(frames[first:last], times[first:last], fps, tolerance)
+		if auto_start is not None:
+			start = auto_start
+		elif teleop_start is not None:
+			start = teleop_start - matchstate.AUTON_TIME * fps
+		else:
+			start = frames[first]
+		if teleop_start is not None:
+			end = teleop_start + matchstate.TELEOP_TIME * fps
+		elif auto_start is not None:
+			end = auto_start + (matchstate.AUTON_TIME + matchstate.TELEOP_TIME) * fps
+		else:
+			end = frames[last - 1]
+		start, end = int(round(start)), int(round(end))
+
+		lo = numpy.searchsorted(result_frames, end, side='right')
+		hi = numpy.searchsorted(result_frames, end + RESULTS_SECONDS * fps, side='right')
+		posted = numpy.flatnonzero(result_codes[lo:hi] == codes[first])
+		score_posted = int(result_frames[lo + posted[0]]) if len(posted) > 0 else None
+
+		code = int(codes[first])
+		matches.append({
+			'match_type': match_types[code // MATCH_CODE_BASE],
+			'match_number': str(code % MATCH_CODE_BASE),
+			'start': start,
+			'end': end,
+			'score_posted': score_posted,
+			'start_time': (start - 1) / fps,
+			'end_time': (end - 1) / fps,
+			'score_time': (score_posted - 1) / fps if score_posted is not None else None,
+		})
+	return matches
 
 matchdata = [
 	{'match_type': 'Semifinal Match', 'match_number': '2', 'type': 'game', 'frame': 650, 'time': 0, '_duration': 0.9685509204864502},
@@ -203,8 +359,35 @@ matchdata = [
 	{'match_type': 'Semifinal Match', 'match_number': '2', 'type': 'results', 'frame': 850, '_duration': 0.8763220310211182}
 ]
 
+@click.command()
+@click.argument('resultlog', required=False, type=click.Path(exists=True, dir_okay=False))
+@click.option('--fps', default=1, help='Frames per second the observations were taken at')
+@click.option('--out', default=None, help='Write the intervals to this JSON file instead of stdout')
+@click.option('--online', is_flag=True, help='Print the events of the live state machine instead')
+def main(resultlog, fps, out, online):
+	if resultlog is None:
+		records, match_types = observations.from_dicts(matchdata)
+	else:
+		records, match_types = observations.load(resultlog)
+
+	if online:
+		infos = observations.to_dicts(observations.ordered(records), match_types)
+		for event in matchstate.replay(infos, fps):
+			print(event)
+		return
+
+	start = time.time()
+	matches = segment(observations.ordered(records), match_types, fps)
+	print('Segmented {} observations into {} matches in {:.3f}s'.format(
+		len(records), len(matches), time.time() - start), file=sys.stderr)
+
+	if out is None:
+		print(json.dumps(matches, indent=2))
+	else:
+		with open(out, 'w') as f:
+			json.dump(matches, f, indent=2)
+
 if __name__ == '__main__':
-	for match in matchdata:
-		pass
+	main()
 
 
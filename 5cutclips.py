@@ -0,0 +1,145 @@
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import click
+import rendition
+import vodindex
+
+# Cut every match in INTERVALS (the output of 4statemachine.py) out of a VOD
+# without transcoding. All the clips come out of a single ffmpeg process with
+# one output per clip, so the VOD is read once no matter how many matches it
+# holds. Stream copy can only start a clip on a keyframe, so each start is
+# moved back to the keyframe before it, looked up in the VOD's index (built by
+# 1download.py, or here the first time it's needed). The score screen is cut
+# as a separate output in the same pass and joined onto its match with the
+# concat demuxer, unless it's close enough to the end of the match to just run
+# the clip on. With --upload_rendition each clip also gets an upload rendition
+# (see frcreplay/rendition.py) next to it, --jobs at a time.
+
+def clip_name(outformat, match):
+	name = outformat.format(**match)
+	return re.sub(r'[^\w .()#-]', '_', name)
+
+# Work out the (start, end) ranges to copy for each match. Returns a list of
+# (match, clip range, score range or None). Times are seconds from the start of
+# the VOD, as in the intervals, the index (see vodindex.py) and -ss/-to, so the
+# ranges line up even when the VOD's timestamps don't start at 0.
+def plan_clips(matches, index, pre, post, score):
+	clips = []
+	for match in matches:
+		start = index.keyframe_before(max(match['start_time'] - pre, 0))
+		end = match['end_time'] + post
+
+		score_range = None
+		if match.get('score_time') is not None:
+			score_start = index.keyframe_before(match['score_time'])
+			if score_start <= end:
+				end = max(end, match['score_time'] + score)
+			else:
+				score_range = (score_start, match['score_time'] + score)
+		clips.append((match, (start, end), score_range))
+	return clips
+
+def output_args(clip_range, path):
+	start, end = clip_range
+	return [
+		'-map', '0',
+		'-ss', '{:.3f}'.format(start),
+		'-to', '{:.3f}'.format(end),
+		'-c', 'copy',
+		'-avoid_negative_ts', 'make_zero',
+		'-y', path,
+	]
+
+def concat(ffmpeg_bin, parts, path):
+	with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as listfile:
+		for part in parts:
+			listfile.write("file '{}'\n".format(os.path.abspath(part).replace("'", "'\\''")))
+	try:
+		subprocess.run([
+			ffmpeg_bin,
+			'-hide_banner',
+			'-v', 'error',
+			'-f', 'concat',
+			'-safe', '0',
+			'-i', listfile.name,
+			'-c', 'copy',
+			'-y', path,
+		], check=True)
+	finally:
+		os.unlink(listfile.name)
+
+@click.command(
+	help='Cut the matches in INTERVALS (from 4statemachine.py) out of INFILE into OUTDIR without transcoding.')
+@click.argument('infile', type=click.Path(exists=True, dir_okay=False))
+@click.argument('intervals', type=click.Path(exists=True, dir_okay=False))
+@click.argument('outdir')
+@click.option('--outformat', default='{match_type} {match_number}.mp4', help='Clip filename, formatted with the fields of each interval')
+@click.option('--pre', default=5.0, help='Seconds to keep before the start of a match')
+@click.option('--post', default=5.0, help='Seconds to keep after the end of a match')
+@click.option('--score', default=5.0, help='Seconds of the score screen to append')
+@click.option('--ffmpeg_bin', default=None, help='Path to ffmpeg executable. Automatically searches PATH')
+@click.option('--ffprobe_bin', default=None, help='Path to ffprobe executable. Defaults to the one next to ffmpeg, then searches PATH')
+@click.option('--upload_rendition', is_flag=True, help='Also transcode each clip to a faststart mp4 with a capped bitrate, for uploading')
+@click.option('--maxrate', default=rendition.MAX_BITRATE, help='Bitrate cap of upload renditions in kbit/s')
+@click.option('--jobs', default=rendition.WORKERS, help='Upload renditions to transcode at once')
+def main(infile, intervals, outdir, outformat, pre, post, score, ffmpeg_bin, ffprobe_bin, upload_rendition, maxrate, jobs):
+	os.makedirs(outdir, exist_ok=True)
+
+	if ffmpeg_bin is None:
+		ffmpeg_bin = shutil.which('ffmpeg')
+		if ffmpeg_bin is None:
+			print('Unable to find ffmpeg. Please ensure it is installed and on your path. Or provide an absolute path with --ffmpeg_bin')
+			sys.exit(1)
+	if ffprobe_bin is None:
+		ffprobe_bin = vodindex.find_ffprobe(ffmpeg_bin)
+
+	with open(intervals, 'r') as f:
+		matches = json.load(f)
+	if len(matches) == 0:
+		print('No matches in {}'.format(intervals))
+		return
+
+	clips = plan_clips(matches, vodindex.load(infile, ffprobe_bin), pre, post, score)
+
+	workdir = tempfile.mkdtemp(dir=outdir)
+	try:
+		ffmpeg_command = [ffmpeg_bin, '-hide_banner', '-nostats', '-i', infile]
+		joins = []
+		paths = []
+		for i, (match, clip_range, score_range) in enumerate(clips):
+			path = os.path.join(outdir, clip_name(outformat, match))
+			paths.append(path)
+			if score_range is None:
+				ffmpeg_command += output_args(clip_range, path)
+				continue
+
+			ext = os.path.splitext(path)[1]
+			parts = [os.path.join(workdir, '{}-match{}'.format(i, ext)),
+				os.path.join(workdir, '{}-score{}'.format(i, ext))]
+			ffmpeg_command += output_args(clip_range, parts[0])
+			ffmpeg_command += output_args(score_range, parts[1])
+			joins.append((parts, path))
+
+		print(' '.join(ffmpeg_command))
+		subprocess.run(ffmpeg_command, check=True)
+
+		for parts, path in joins:
+			concat(ffmpeg_bin, parts, path)
+	finally:
+		shutil.rmtree(workdir)
+
+	print('Cut {} matches into {}'.format(len(clips), outdir))
+
+	if upload_rendition:
+		pool = rendition.RenditionPool(jobs, ffmpeg_bin, maxrate)
+		for future in [pool.submit(path) for path in paths]:
+			print('Wrote {}'.format(future.result()))
+		pool.shutdown()
+
+if __name__ == '__main__':
+	main()
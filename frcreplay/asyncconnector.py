@@ -0,0 +1,167 @@
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# StreamConnector.run reads the stream 8 KiB at a time and hands every chunk
+# to on_data synchronously, so anything slow downstream (ffmpeg, the disk)
+# stalls the network read until Twitch drops us. AsyncStreamConnector reads
+# big chunks on an asyncio event loop and fans them out to sinks, each
+# draining its own bounded queue in its own task:
+#
+#   BLOCK        the reader waits for room, for consumers which can't lose data
+#   DROP_OLDEST  the oldest queued chunk is thrown away to make room
+#   DROP_NEWEST  the new chunk is thrown away
+#
+# streamlink only has blocking reads, so those run on a thread pool, but
+# everything else (including ffmpeg's pipes, see MatchObserver.start_async)
+# runs on the loop, so one loop can drive dozens of streams.
+
+import asyncio
+import concurrent.futures
+import traceback
+
+import streamlink
+
+import httpclient
+import streamconnector
+
+READ_SIZE = 1 << 20
+SINK_CHUNKS = 16 # chunks a sink may have queued
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+
+# Blocking network calls, shared by every connector on the loop
+READER_THREADS = 64
+_reader_executor = concurrent.futures.ThreadPoolExecutor(READER_THREADS)
+
+class BoundedSink:
+    def __init__(self, name, consume, policy=BLOCK, maxsize=SINK_CHUNKS):
+        self.name = name
+        self.policy = policy
+        self.dropped = 0
+        self._consume = consume
+        self._queue = asyncio.Queue(maxsize)
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def put(self, data):
+        if self.policy == BLOCK:
+            await self._queue.put(data)
+            return
+        if self._queue.full():
+            self.dropped += 1
+            if self.policy == DROP_NEWEST:
+                return
+            self._queue.get_nowait()
+        self._queue.put_nowait(data)
+
+    # Let the queued chunks drain, then stop
+    async def close(self):
+        if self._queue.full() and self.policy != BLOCK:
+            self._queue.get_nowait()
+        await self._queue.put(None)
+        await self._task
+
+    async def _run(self):
+        while True:
+            data = await self._queue.get()
+            if data is None:
+                break
+            try:
+                await self._consume(data)
+            except:
+                traceback.print_exc()
+
+class AsyncStreamConnector(streamconnector.StreamConnector):
+    # The sinks each chunk of the stream goes to, made fresh for every
+    # connection. By default everything goes to on_data.
+    def sinks(self):
+        return [BoundedSink('data', self.on_data_async)]
+
+    async def on_data_async(self, data):
+        self.on_data(data)
+
+    async def on_connected_async(self):
+        self.on_connected()
+
+    async def _call(self, function, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_reader_executor, function, *args)
+
+    async def run_async(self):
+        twitch_url = streamconnector.TWITCH_URL_TEMPLATE.format(self.twitch_id)
+        print('******** starting loop for event {}, stream {}'.format(self.event_id, twitch_url))
+
+        while True:
+            try:
+                self.on_connecting()
+
+                if not self.twitch_id.startswith('videos/'):
+                    live = await self._call(httpclient.liveness_poller().is_live,
+                                            self.twitch_id)
+                    if live is False:
+                        await asyncio.sleep(streamconnector.RECONNECT_OFFLINE_DELAY)
+                        continue
+
+                streams = await self._call(streamlink.streams, twitch_url)
+                if streamconnector.STREAM_QUALITY not in streams:
+                    await asyncio.sleep(streamconnector.RECONNECT_DC_DELAY)
+                    continue
+                s = await self._call(streams[streamconnector.STREAM_QUALITY].open)
+
+                try:
+                    await self.on_connected_async()
+                    print('******** connected to stream {} for event {}'.format(twitch_url,
+                                                                                self.event_id))
+                    sinks = self.sinks()
+                    for sink in sinks:
+                        sink.start()
+                    try:
+                        while True:
+                            data = await self._call(s.read, READ_SIZE)
+                            if len(data) == 0:
+                                break
+                            for sink in sinks:
+                                await sink.put(data)
+                    finally:
+                        for sink in sinks:
+                            await sink.close()
+                            if sink.dropped > 0:
+                                print('******** {} dropped {} chunks for event {}'.format(
+                                    sink.name, sink.dropped, self.event_id))
+                        self.on_disconnected()
+                        print('******** disconnected from stream {} for event {}'.format(
+                            twitch_url, self.event_id))
+                finally:
+                    await self._call(s.close)
+            except KeyboardInterrupt:
+                raise
+            except asyncio.CancelledError:
+                raise
+            except:
+                traceback.print_exc()
+
+            await asyncio.sleep(streamconnector.RECONNECT_DC_DELAY)
+
+    def run(self):
+        asyncio.run(self.run_async())
@@ -0,0 +1,119 @@
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Decode CPU cost of each of matchobserver.DECODE_STRATEGIES, as CPU seconds
+# spent by ffmpeg per hour of stream, on the given video (or on a synthetic
+# 720p h264 clip if none is given). Lower means more streams per box.
+#
+#   python -m benchmarks.decode [--seconds N] [--threads N] [video.mp4]
+
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import matchobserver
+import vodindex
+
+DEFAULT_SECONDS = 120
+SYNTHETIC_SOURCE = 'testsrc2=size=1280x720:rate=30'
+
+def find_ffmpeg():
+    if os.path.isfile(matchobserver.FFMPEG_BINARY):
+        return matchobserver.FFMPEG_BINARY
+    ffmpeg_bin = shutil.which('ffmpeg')
+    if ffmpeg_bin is None:
+        raise Exception('Unable to find ffmpeg')
+    return ffmpeg_bin
+
+# Encode SECONDS of a test pattern with a keyframe every 2 s, like a stream
+def synthetic_video(ffmpeg_bin, path, seconds):
+    subprocess.run([
+        ffmpeg_bin, '-v', 'error', '-y',
+        '-f', 'lavfi', '-i', SYNTHETIC_SOURCE, '-t', str(seconds),
+        '-c:v', 'libx264', '-preset', 'veryfast', '-g', '60', '-pix_fmt', 'yuv420p',
+        path,
+    ], check=True)
+
+def video_seconds(ffmpeg_bin, video):
+    proc = subprocess.run([
+        vodindex.find_ffprobe(ffmpeg_bin), '-v', 'error',
+        '-show_entries', 'format=duration', '-of', 'csv=p=0', video,
+    ], stdout=subprocess.PIPE, check=True)
+    return float(proc.stdout.decode('utf-8').strip())
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+# Run the extractor over the first SECONDS of VIDEO, throwing the frames away.
+# Returns (CPU seconds, wall seconds, frames).
+def time_decode(ffmpeg_bin, video, seconds, decode, threads):
+    command = matchobserver.ffmpeg_command(decode=decode, threads=threads, infile=video)
+    command = [ffmpeg_bin, '-v', 'error', '-t', str(seconds)] + command[1:]
+
+    cpu = children_cpu()
+    start = time.time()
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE)
+    size = 0
+    while True:
+        data = proc.stdout.read(1 << 20)
+        if len(data) == 0:
+            break
+        size += len(data)
+    proc.wait()
+    wall = time.time() - start
+    return children_cpu() - cpu, wall, size
+
+def main(args):
+    seconds = DEFAULT_SECONDS
+    threads = None
+    while len(args) > 1 and args[0] in ('--seconds', '--threads'):
+        if args[0] == '--seconds':
+            seconds = float(args[1])
+        else:
+            threads = int(args[1])
+        args = args[2:]
+
+    ffmpeg_bin = find_ffmpeg()
+    workdir = None
+    if len(args) > 0:
+        video = args[0]
+    else:
+        workdir = tempfile.mkdtemp()
+        video = os.path.join(workdir, 'synthetic.mp4')
+        print('encoding {} s synthetic clip'.format(seconds))
+        synthetic_video(ffmpeg_bin, video, seconds)
+
+    try:
+        seconds = min(seconds, video_seconds(ffmpeg_bin, video))
+        for decode in sorted(matchobserver.DECODE_STRATEGIES):
+            cpu, wall, size = time_decode(ffmpeg_bin, video, seconds, decode, threads)
+            print('{:11} {:7.1f} cpu s/stream hour {:7.1f}x realtime {:9.1f} MB piped'.format(
+                decode, cpu / seconds * 3600, seconds / wall, size / (1 << 20)))
+    finally:
+        if workdir is not None:
+            shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,90 @@
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Per-call OCR latency for every available engine, on the match time and match
+# label crops of the given frames (or of a synthetic frame if none are given).
+#
+#   python -m benchmarks.ocr [--calls N] [frame.jpg ...]
+
+import sys
+import time
+
+import PIL.Image
+import PIL.ImageDraw
+
+from matchobserver import frc2017
+from matchobserver import ocr
+
+DEFAULT_CALLS = 20
+
+def synthetic_frame():
+    frame = PIL.Image.new('RGB', (frc2017.BASE_WIDTH, frc2017.BASE_HEIGHT), 'black')
+    draw = PIL.ImageDraw.Draw(frame)
+    label_rect = frc2017.MATCH_LABEL_RECTS[0][0]
+    time_rect = frc2017.MATCH_TIME_RECT[0]
+    draw.rectangle(label_rect, fill='white')
+    draw.text((label_rect[0] + 5, label_rect[1] + 5), 'Qualification 12 of 74', fill='black')
+    draw.rectangle(time_rect, fill='white')
+    draw.text((time_rect[0] + 5, time_rect[1] + 5), '135', fill='black')
+    return frame
+
+def crops(frame):
+    x_scale = frame.width / frc2017.BASE_WIDTH
+    y_scale = frame.height / frc2017.BASE_HEIGHT
+    def scale(rect):
+        x1, y1, x2, y2 = rect
+        return (x1 * x_scale, y1 * y_scale, x2 * x_scale, y2 * y_scale)
+
+    return [
+        ('time', frc2017.NUMBER_TESSERACT_CONFIG, frame.crop(scale(frc2017.MATCH_TIME_RECT[0]))),
+        ('label', '', frame.crop(scale(frc2017.MATCH_LABEL_RECTS[0][0]))),
+    ]
+
+def time_engine(engine, config, images, calls):
+    # The first call pays for loading Tesseract, report it separately
+    start = time.time()
+    ocr.image_to_string(images[0], config, engine)
+    first = time.time() - start
+
+    start = time.time()
+    for i in range(calls):
+        ocr.image_to_string(images[i % len(images)], config, engine)
+    return first, (time.time() - start) / calls
+
+def main(args):
+    calls = DEFAULT_CALLS
+    if len(args) > 1 and args[0] == '--calls':
+        calls = int(args[1])
+        args = args[2:]
+
+    frames = [PIL.Image.open(path).convert('RGB') for path in args] or [synthetic_frame()]
+    regions = {}
+    for frame in frames:
+        for name, config, img in crops(frame):
+            regions.setdefault((name, config), []).append(img)
+
+    for (name, config), images in sorted(regions.items()):
+        for engine in sorted(ocr.ENGINES):
+            first, per_call = time_engine(engine, config, images, calls)
+            print('{:6} {:12} first call {:7.1f} ms, then {:7.1f} ms/call'.format(
+                name, engine, first * 1000, per_call * 1000))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,325 @@
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Throughput of every stage of match detection, from a decoded frame to the
+# clip cut, plus end to end frames/sec through VisionCore.observe and the match
+# state machine. The fixtures are the README's sample frames (a directory of
+# frame0522.jpg ... frame0845.jpg, or synthetic stand-ins drawn with the same
+# overlays when none is given), and optionally a recorded video for the ffmpeg
+# decode. Results are written as JSON; with --baseline the mean time of every
+# stage is checked against an earlier run and the exit status is 1 when any got
+# more than --tolerance slower, so VisionCore regressions show up in CI.
+#
+#   python -m benchmarks.pipeline [--frames DIR] [--video video.mp4] [--passes N]
+#       [--out results.json] [--baseline old.json] [--tolerance 0.2]
+
+import json
+import os
+import sys
+import time
+
+import numpy
+import PIL.Image
+import PIL.ImageDraw
+
+import matchobserver
+import vodindex
+from benchmarks import decode
+from benchmarks import ocr as ocr_benchmark
+from matchobserver import digits
+from matchobserver import frc2017
+from matchobserver import matchstate
+from matchobserver import ocr
+
+DEFAULT_PASSES = 5
+DEFAULT_TOLERANCE = 0.2
+VIDEO_SECONDS = 60
+
+# The README sample set, as (frame, what it shows, overlay to draw for the
+# synthetic stand-in). Overlays are ('game', match time) or ('outside', header).
+FIXTURES = [
+    ('frame0522', 'match preview', ('outside', 'Match Preview')),
+    ('frame0653', 'match start', ('game', 15)),
+    ('frame0667', 'teleop start', ('game', 135)),
+    ('frame0789', '14 s left in teleop', ('game', 14)),
+    ('frame0837', 'end of match', ('game', 0)),
+    ('frame0845', 'results posted', ('outside', 'Match Results')),
+]
+MATCH_LABEL = 'Semifinal Match 2'
+
+# Fake index of an event day of VOD for cut planning: 30 fps, a keyframe every
+# 2 s, 8 hours
+VOD_FPS = 30
+VOD_KEYFRAME_INTERVAL = 60
+VOD_HOURS = 8
+VOD_PACKET_SIZE = 20000
+
+def synthetic_frame(overlay):
+    frame = PIL.Image.new('RGB', (frc2017.BASE_WIDTH, frc2017.BASE_HEIGHT), 'black')
+    draw = PIL.ImageDraw.Draw(frame)
+    typ, value = overlay
+    if typ == 'game':
+        label_rect = frc2017.MATCH_LABEL_RECTS[0][0]
+        time_rect = frc2017.MATCH_TIME_RECT[0]
+        for (rect, side), color in zip(frc2017.ALLIANCE_RECTS,
+                                       (frc2017.RED_COLOR, frc2017.BLUE_COLOR)):
+            draw.rectangle(rect, fill=color)
+        draw.rectangle(label_rect, fill='white')
+        draw.text((label_rect[0] + 5, label_rect[1] + 5), MATCH_LABEL, fill='black')
+        draw.rectangle(time_rect, fill='white')
+        draw.text((time_rect[0] + 5, time_rect[1] + 5), str(value), fill='black')
+    else:
+        label_rect = frc2017.MATCH_LABEL_RECTS[1][0]
+        header_rect = frc2017.MATCH_RESULTS_RECTS[0][0]
+        draw.rectangle(label_rect, fill='white')
+        draw.text((label_rect[0] + 5, label_rect[1] + 5), MATCH_LABEL, fill='black')
+        draw.rectangle(header_rect, fill='white')
+        draw.text((header_rect[0] + 5, header_rect[1] + 5), value, fill='black')
+    return frame
+
+# (name, frame) for every fixture, read from FRAMES_DIR when it has them
+def load_fixtures(frames_dir=None):
+    fixtures = []
+    for name, description, overlay in FIXTURES:
+        path = None if frames_dir is None else os.path.join(frames_dir, name + '.jpg')
+        if path is not None and os.path.isfile(path):
+            frame = PIL.Image.open(path).convert('RGB')
+        else:
+            frame = synthetic_frame(overlay)
+        fixtures.append((name, frame))
+    return fixtures
+
+# Observations of one whole match at 1 fps as VisionCore reports them: the
+# preview, the autonomous and teleop countdowns and the results screen
+def synthetic_observations(first_frame=0):
+    infos = []
+    def add(info):
+        info['frame'] = first_frame + len(infos)
+        infos.append(info)
+
+    outside = {'match_type': 'Semifinal Match', 'match_number': '2'}
+    for i in range(10):
+        add(dict(outside, type='preview'))
+    for t in list(range(matchstate.AUTON_TIME, -1, -1)) + \
+            list(range(matchstate.TELEOP_TIME, -1, -1)):
+        add(dict(outside, type='game', time=t))
+    for i in range(10):
+        add(dict(outside, type='results'))
+    return infos
+
+def synthetic_vod_index():
+    count = VOD_HOURS * 3600 * VOD_FPS
+    packets = numpy.zeros(count, dtype=vodindex.INDEX_DTYPE)
+    packets['pts'] = numpy.arange(count) / VOD_FPS
+    packets['size'] = VOD_PACKET_SIZE
+    packets['pos'] = numpy.arange(count) * VOD_PACKET_SIZE
+    packets['key'] = numpy.arange(count) % VOD_KEYFRAME_INTERVAL == 0
+    return vodindex.VodIndex(packets)
+
+# Call FN on every item of ITEMS PASSES times. Returns the stage's results.
+def time_calls(fn, items, passes, unit='calls'):
+    start = time.perf_counter()
+    for i in range(passes):
+        for item in items:
+            fn(item)
+    total = time.perf_counter() - start
+    return stage_result(passes * len(items), total, unit)
+
+def stage_result(calls, total, unit='calls'):
+    return {
+        'unit': unit,
+        'calls': calls,
+        'total': total,
+        'mean': total / calls,
+        'per_second': calls / total if total > 0 else None,
+    }
+
+def bench_decode(fixtures, passes):
+    width, height = fixtures[0][1].size
+    buffers = [frame.tobytes() for name, frame in fixtures]
+    return time_calls(lambda data: matchobserver.decode_frame(data, width, height),
+                      buffers, passes, 'frames')
+
+def bench_ffmpeg_decode(video):
+    ffmpeg_bin = decode.find_ffmpeg()
+    seconds = min(VIDEO_SECONDS, decode.video_seconds(ffmpeg_bin, video))
+    cpu, wall, size = decode.time_decode(
+        ffmpeg_bin, video, seconds, matchobserver.DEFAULT_DECODE, None)
+    result = stage_result(seconds, wall, 'stream seconds')
+    result['cpu'] = cpu
+    return result
+
+def bench_crop(vision_core, fixtures, passes):
+    rects = [rect for rect, typ in vision_core._scaled_label_rects] + \
+        [rect for rect, typ in vision_core._scaled_results_rects] + \
+        [rect for rect, typ in vision_core._scaled_alliance_rects] + \
+        [vision_core._scaled_time_rect[0]]
+    def crop(frame):
+        for rect in rects:
+            frame.crop(rect).load()
+    return time_calls(crop, [frame for name, frame in fixtures], passes, 'frames')
+
+def bench_digits(fixtures, passes):
+    reader = digits.DigitReader()
+    images = [img for name, frame in fixtures
+              for region, config, img in ocr_benchmark.crops(frame) if region == 'time']
+    return time_calls(reader.read, images, passes, 'crops')
+
+def bench_ocr(fixtures, passes):
+    crops = [(config, img) for name, frame in fixtures
+             for region, config, img in ocr_benchmark.crops(frame)]
+    # Leave loading Tesseract out of it
+    for config, img in crops:
+        ocr.image_to_string(img, config)
+    return time_calls(lambda crop: ocr.image_to_string(crop[1], crop[0]), crops, passes, 'crops')
+
+def bench_feature_match(vision_core, fixtures, passes):
+    frames = [frame for name, frame in fixtures]
+    return time_calls(vision_core._find_label_rect, frames, passes, 'frames')
+
+def bench_state_machine(passes):
+    infos = synthetic_observations()
+    start = time.perf_counter()
+    for i in range(passes):
+        for event in matchstate.replay(infos, 1):
+            pass
+    return stage_result(passes * len(infos), time.perf_counter() - start, 'frames')
+
+def bench_cut(passes):
+    index = synthetic_vod_index()
+    duration = index.duration()
+    starts = numpy.linspace(0, duration - 300, 100 * passes)
+    def plan(start):
+        index.keyframe_before(start)
+        index.byte_range(start, start + matchstate.AUTON_TIME + matchstate.TELEOP_TIME)
+    return time_calls(plan, starts, 1, 'matches')
+
+# Raw frames through decode, observe and the state machine, the way a
+# background_process handles them, with the vision core's own breakdown of
+# where the time went
+def bench_end_to_end(fixtures, passes):
+    width, height = fixtures[0][1].size
+    vision_core = frc2017.VisionCore(width, height)
+    state = matchstate.MatchState(matchobserver.MATCH_DETECTOR_FPS)
+    buffers = [frame.tobytes() for name, frame in fixtures]
+
+    frame_counter = 0
+    start = time.perf_counter()
+    for i in range(passes):
+        for data in buffers:
+            frame_counter += 1
+            frame = matchobserver.decode_frame(data, width, height)
+            state.update(frame_counter, matchobserver.observe_frame(vision_core, frame))
+    result = stage_result(frame_counter, time.perf_counter() - start, 'frames')
+    result['vision_core'] = vision_core.timer.report()
+    return result
+
+def run(fixtures, passes, video=None):
+    width, height = fixtures[0][1].size
+    vision_core = frc2017.VisionCore(width, height)
+
+    stages = [
+        ('decode', lambda: bench_decode(fixtures, passes)),
+        ('crop', lambda: bench_crop(vision_core, fixtures, passes)),
+        ('digits', lambda: bench_digits(fixtures, passes)),
+        ('ocr', lambda: bench_ocr(fixtures, passes)),
+        ('feature_match', lambda: bench_feature_match(vision_core, fixtures, passes)),
+        ('state_machine', lambda: bench_state_machine(passes)),
+        ('cut', lambda: bench_cut(passes)),
+        ('end_to_end', lambda: bench_end_to_end(fixtures, passes)),
+    ]
+    if video is not None:
+        stages.insert(0, ('ffmpeg_decode', lambda: bench_ffmpeg_decode(video)))
+
+    results = {}
+    for name, bench in stages:
+        try:
+            results[name] = bench()
+        except Exception as e:
+            # eg. no tesseract or ffmpeg on this box, the other stages still count
+            results[name] = {'skipped': str(e)}
+
+    return {
+        'fixtures': [name for name, frame in fixtures],
+        'resolution': [width, height],
+        'passes': passes,
+        'stages': results,
+    }
+
+def print_results(results):
+    for name, stage in results['stages'].items():
+        if 'skipped' in stage:
+            print('{:14} skipped: {}'.format(name, stage['skipped']))
+        else:
+            print('{:14} {:8d} {:14} {:9.2f} ms each {:10.1f}/s'.format(
+                name, stage['calls'], stage['unit'], stage['mean'] * 1000,
+                stage['per_second'] or 0))
+
+# Stages whose mean time per call grew by more than TOLERANCE since BASELINE,
+# as (stage, baseline mean, mean)
+def regressions(results, baseline, tolerance):
+    slower = []
+    for name, stage in results['stages'].items():
+        old = baseline['stages'].get(name, {})
+        if 'mean' not in stage or 'mean' not in old:
+            continue
+        if stage['mean'] > old['mean'] * (1 + tolerance):
+            slower.append((name, old['mean'], stage['mean']))
+    return slower
+
+def main(args):
+    frames_dir = None
+    video = None
+    passes = DEFAULT_PASSES
+    out = None
+    baseline = None
+    tolerance = DEFAULT_TOLERANCE
+    while len(args) > 1 and args[0] in ('--frames', '--video', '--passes', '--out',
+                                        '--baseline', '--tolerance'):
+        if args[0] == '--frames':
+            frames_dir = args[1]
+        elif args[0] == '--video':
+            video = args[1]
+        elif args[0] == '--passes':
+            passes = int(args[1])
+        elif args[0] == '--out':
+            out = args[1]
+        elif args[0] == '--baseline':
+            baseline = args[1]
+        else:
+            tolerance = float(args[1])
+        args = args[2:]
+
+    results = run(load_fixtures(frames_dir), passes, video)
+    print_results(results)
+    if out is not None:
+        with open(out, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if baseline is not None:
+        with open(baseline, 'r') as f:
+            slower = regressions(results, json.load(f), tolerance)
+        for name, old, new in slower:
+            print('{} regressed: {:.3f} ms -> {:.3f} ms'.format(name, old * 1000, new * 1000))
+        if len(slower) > 0:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
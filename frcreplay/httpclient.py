@@ -0,0 +1,189 @@
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Every HTTP request the recorder makes goes through one shared requests
+# Session, so connections to Twitch, the upload services and the like are kept
+# alive and reused instead of paying for a new TLS handshake every time. Each
+# request is filed under an endpoint name with its latency and whether it
+# failed, for stats(). LivenessPoller asks Twitch about every watched channel
+# in one request per poll instead of one per channel.
+
+import collections
+import contextlib
+import threading
+import time
+import traceback
+
+import requests
+import requests.adapters
+
+POOL_CONNECTIONS = 16 # hosts to keep pools for
+POOL_SIZE = 64 # connections kept alive per host
+
+TWITCH_CLIENT_ID = '5j0r5b7qb7kro03fvka3o8kbq262wwm'
+TWITCH_STREAMS_ENDPOINT = 'https://api.twitch.tv/kraken/streams'
+MAX_CHANNELS_PER_POLL = 100 # the most channels the streams endpoint takes at once
+POLL_INTERVAL = 5
+POLL_TIMEOUT = 10 # seconds to wait on a poll, and for the first answer about a channel
+
+_session = None
+_session_lock = threading.Lock()
+
+def session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=POOL_CONNECTIONS,
+                                                    pool_maxsize=POOL_SIZE)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+class EndpointStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.seconds = 0
+        self.max_seconds = 0
+
+_stats = collections.defaultdict(EndpointStats)
+_stats_lock = threading.Lock()
+
+def record(endpoint, seconds, failed):
+    with _stats_lock:
+        stats = _stats[endpoint]
+        stats.requests += 1
+        stats.errors += failed
+        stats.seconds += seconds
+        stats.max_seconds = max(stats.max_seconds, seconds)
+
+# Requests, latency and errors (exceptions and 4xx/5xx responses) per endpoint
+def stats():
+    with _stats_lock:
+        return {endpoint: {
+            'requests': stats.requests,
+            'errors': stats.errors,
+            'mean': stats.seconds / stats.requests,
+            'max': stats.max_seconds,
+        } for endpoint, stats in _stats.items()}
+
+def print_stats():
+    for endpoint, stats in sorted(stats().items()):
+        print('******** {:20} {:8d} requests {:6d} errors {:8.0f} ms mean {:8.0f} ms max'.format(
+            endpoint, stats['requests'], stats['errors'], stats['mean'] * 1000,
+            stats['max'] * 1000))
+
+# Time a call made through some other client (eg. python-twitter) under ENDPOINT
+@contextlib.contextmanager
+def timed(endpoint):
+    start = time.time()
+    try:
+        yield
+    except:
+        record(endpoint, time.time() - start, True)
+        raise
+    record(endpoint, time.time() - start, False)
+
+def request(endpoint, method, url, **kwargs):
+    start = time.time()
+    try:
+        r = session().request(method, url, **kwargs)
+    except:
+        record(endpoint, time.time() - start, True)
+        raise
+    record(endpoint, time.time() - start, r.status_code >= 400)
+    return r
+
+def get(endpoint, url, **kwargs):
+    return request(endpoint, 'GET', url, **kwargs)
+
+def post(endpoint, url, **kwargs):
+    return request(endpoint, 'POST', url, **kwargs)
+
+def put(endpoint, url, **kwargs):
+    return request(endpoint, 'PUT', url, **kwargs)
+
+# Polls whether every watched Twitch channel is live, MAX_CHANNELS_PER_POLL to
+# a request, every POLL_INTERVAL seconds from a thread of its own
+class LivenessPoller:
+    def __init__(self, interval=POLL_INTERVAL):
+        self._interval = interval
+        self._lock = threading.Condition()
+        self._channels = set()
+        self._live = {}
+        self._thread = None
+
+    # Whether CHANNEL is live as of the last poll, or None if it couldn't be
+    # found out. Channels are watched from their first call on, which waits
+    # for the next poll.
+    def is_live(self, channel):
+        channel = channel.lower()
+        with self._lock:
+            if channel not in self._channels:
+                self._channels.add(channel)
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, daemon=True)
+                    self._thread.start()
+                self._lock.notify_all()
+                self._lock.wait_for(lambda: channel in self._live, POLL_TIMEOUT)
+            return self._live.get(channel)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                channels = sorted(self._channels)
+            live = {}
+            for i in range(0, len(channels), MAX_CHANNELS_PER_POLL):
+                batch = channels[i:i + MAX_CHANNELS_PER_POLL]
+                try:
+                    live.update(poll_channels(batch))
+                except:
+                    traceback.print_exc()
+                    live.update((channel, None) for channel in batch)
+
+            with self._lock:
+                self._live.update((channel, is_live) for channel, is_live in live.items()
+                                  if channel in self._channels)
+                self._lock.notify_all()
+                # new channels get polled straight away
+                self._lock.wait_for(lambda: not self._channels.issubset(self._live),
+                                    self._interval)
+
+# {channel: whether it's live} for CHANNELS, in one request
+def poll_channels(channels):
+    r = get('twitch-streams', TWITCH_STREAMS_ENDPOINT, params={
+        'channel': ','.join(channels),
+        'limit': len(channels),
+        'client_id': TWITCH_CLIENT_ID,
+    }, timeout=POLL_TIMEOUT)
+    r.raise_for_status()
+    live_channels = set(stream['channel']['name'].lower() for stream in r.json()['streams'])
+    return {channel: channel in live_channels for channel in channels}
+
+_poller = None
+
+# The liveness poller shared by every connector in the process
+def liveness_poller():
+    global _poller
+    with _session_lock:
+        if _poller is None:
+            _poller = LivenessPoller()
+        return _poller
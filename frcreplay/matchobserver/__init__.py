@@ -18,157 +18,487 @@
 # You should have received a copy of the GNU Affero General Public License along
 # with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
 import collections
 import multiprocessing
 import io
 import os
+import queue
 import re
 import subprocess
+import threading
 import time
 import traceback
 
-import PIL
+import PIL.Image
+
+from matchobserver import lagmonitor, matchstate
 
 MATCH_DETECTOR_FPS = 1 / 3
 FFMPEG_BINARY = '/usr/bin/ffmpeg'
+FFMPEG_OUTPUT_ARGS = ['-an', '-sn', '-c:v', 'rawvideo', '-pix_fmt', 'rgb24', '-f', 'rawvideo', '-']
 FFMPEG_COMMAND = [
     FFMPEG_BINARY, '-i', '-', '-vf',
     'fps={}'.format(MATCH_DETECTOR_FPS),
-    '-an', '-sn', '-c:v', 'rawvideo', '-pix_fmt', 'rgb24', '-f', 'rawvideo', '-'
-]
+] + FFMPEG_OUTPUT_ARGS
+
+# Ways of decoding the stream, as (ffmpeg input args, filter to run after the
+# fps filter). The fps filter only drops frames after they're decoded, so
+# 'nokey' has the decoder skip everything but keyframes (streams usually have
+# one every 2 s, plenty at MATCH_DETECTOR_FPS), and 'half' scales down while
+# the frame is still YUV so the RGB conversion and the pipe only see a quarter
+# of the pixels. h264 has no -lowres, so scaling is the closest we get to
+# decoding at a lower resolution.
+DECODE_STRATEGIES = {
+    'full': ([], None),
+    'nokey': (['-skip_frame', 'nokey'], None),
+    'half': ([], 'scale=iw/2:ih/2'),
+    'nokey-half': (['-skip_frame', 'nokey'], 'scale=iw/2:ih/2'),
+}
+DEFAULT_DECODE = 'full'
 
 MATCH_ID_TEMPLATE = '#{} {}'
 
+# Seconds to keep recording after a match ends if its results never come up
 MATCH_END_TIMEOUT = 60
 
 VIDEO_CHANNELS = 3
 
-VIDEO_RESOLUTION_RE = re.compile('(?:rgb|bgr)24, ([0-9]+)x([0-9]+)[, ]')
-
-def background_process(event_id, vision_core_class, info_stream, frame_stream, match_id_queue):
-    match_id = None
-    match_id_counter = collections.Counter()
-    frame_counter = 0
+MAX_QUEUED_FRAMES = 20 # decoded frames a background_process holds before dropping the oldest
+METRICS_INTERVAL = 10 # seconds between lag metrics sent back from a background_process
 
-    change_timestamp = -1
-    end_timestamp = -1
+VIDEO_RESOLUTION_RE = re.compile('(?:rgb|bgr)24, ([0-9]+)x([0-9]+)[, ]')
 
-    video_width = None
-    video_height = None
+# With SHOW_PTS, ffmpeg_command keeps the stream's own timestamps (-copyts) and
+# logs the PTS of every frame it hands over with the showinfo filter, so match
+# events can be placed at exact positions in the stream. The frames are picked
+# with select rather than fps, which would retime them onto its own grid.
+SHOWINFO_PTS_RE = re.compile(r'\bn: *[0-9]+ +pts: *-?[0-9]+ +pts_time: *(-?[0-9.]+)')
+PTS_TIMEOUT = 10 # seconds to wait for the showinfo line of a frame
 
+# Scan ffmpeg's stderr for the resolution of the raw output stream. Frame
+# timestamps logged before it are put on PTS_QUEUE.
+def read_video_resolution(info_stream, pts_queue=None):
     while True:
         info_line = info_stream.readline().decode('utf-8')
         if len(info_line) == 0:
             break
 
+        match = SHOWINFO_PTS_RE.search(info_line)
+        if match:
+            if pts_queue is not None:
+                pts_queue.put(float(match.group(1)))
+            continue
+
         print(info_line)
 
         match = VIDEO_RESOLUTION_RE.search(info_line)
         if match:
-            video_width = int(match.group(1))
-            video_height = int(match.group(2))
+            return (int(match.group(1)), int(match.group(2)))
+
+    raise Exception('Failed to identify video resolution')
+
+# Put the timestamp of each frame ffmpeg logs on PTS_QUEUE, then None at the end
+def read_frame_pts(info_stream, pts_queue):
+    while True:
+        info_line = info_stream.readline().decode('utf-8', 'replace')
+        if len(info_line) == 0:
+            break
+        match = SHOWINFO_PTS_RE.search(info_line)
+        if match:
+            pts_queue.put(float(match.group(1)))
+    pts_queue.put(None)
+
+def next_pts(pts_queue):
+    try:
+        return pts_queue.get(timeout=PTS_TIMEOUT)
+    except queue.Empty:
+        return None
+
+# Stream seconds of every sampled frame on one clock, for the match state: the
+# frame's PTS, or for a frame ffmpeg gave none, the last PTS plus the frames
+# since at FPS (just FRAME_COUNTER / FPS until there's been a PTS). Sampled
+# frames aren't exactly 1 / FPS apart (see DECODE_STRATEGIES), so counting
+# frames drifts over a match.
+class StreamClock:
+    def __init__(self, fps=MATCH_DETECTOR_FPS):
+        self.fps = fps
+        self.on_pts = False
+        self._frame_counter = 0
+        self._seconds = 0
+
+    def seconds(self, frame_counter, pts):
+        if pts is None:
+            return self._seconds + (frame_counter - self._frame_counter) / self.fps
+        self.on_pts = True
+        self._frame_counter = frame_counter
+        self._seconds = pts
+        return pts
+
+# Yield the raw data of fixed-size rgb24 frames from ffmpeg's stdout until the
+# stream ends
+def read_frame_data(frame_stream, video_width, video_height):
+    frame_size = video_width * video_height * VIDEO_CHANNELS
+    frame_reader = io.BufferedReader(frame_stream)
+
+    while True:
+        # print('reading frame data')
+        data = frame_reader.read(frame_size)
+        if len(data) < frame_size:
             break
+        yield data
+
+def decode_frame(data, video_width, video_height):
+    return PIL.Image.frombuffer('RGB', (video_width, video_height), data, 'raw', 'RGB', 0, 1)
+
+# Yield fixed-size rgb24 frames from ffmpeg's stdout until the stream ends
+def read_frames(frame_stream, video_width, video_height):
+    for data in read_frame_data(frame_stream, video_width, video_height):
+        # print('decoding frame data')
+        yield decode_frame(data, video_width, video_height)
+
+# A vision core for VIDEO_WIDTH x VIDEO_HEIGHT frames, which are packed ROI
+# frames when ROI_LAYOUT is given
+def make_vision_core(vision_core_class, video_width, video_height, roi_layout=None):
+    if roi_layout is None:
+        return vision_core_class(video_width, video_height)
+    if (video_width, video_height) != (roi_layout.width, roi_layout.height):
+        raise Exception('Expected {}x{} ROI frames'.format(roi_layout.width, roi_layout.height))
+    return vision_core_class(roi_layout.base_width, roi_layout.base_height, roi_layout)
+
+# Queue match EVENTS, adding the stream timestamp of each if their seconds are
+# stream PTS (ON_PTS, see StreamClock)
+def queue_events(event_id, events, event_queue, on_pts=False):
+    for event in events:
+        event['match_id'] = MATCH_ID_TEMPLATE.format(event_id, event['match_id'])
+        if on_pts:
+            event['pts'] = event['seconds']
+        print('******** {} {}'.format(event['event'], event['match_id']))
+        event_queue.put(event)
+
+# The live ffmpeg command, optionally cropping frames down to ROI_LAYOUT's bands.
+# DECODE picks one of DECODE_STRATEGIES and THREADS the number of decoder
+# threads (ffmpeg picks when None). INFILE is the stream fed to stdin by default.
+def ffmpeg_command(roi_layout=None, decode=DEFAULT_DECODE, threads=None, infile='-', fps=None,
+                   show_pts=False):
+    fps = MATCH_DETECTOR_FPS if fps is None else fps
+    input_args, scale_filter = DECODE_STRATEGIES[decode]
+    output_args = FFMPEG_OUTPUT_ARGS
+    if threads is not None:
+        input_args = input_args + ['-threads', str(threads)]
+
+    if show_pts:
+        input_args = input_args + ['-copyts']
+        output_args = ['-vsync', '0'] + output_args
+        video_filter = "select='isnan(prev_selected_t)+gte(t-prev_selected_t,{})',showinfo".format(
+            1 / fps)
+    else:
+        video_filter = 'fps={}'.format(fps)
+    if scale_filter is not None:
+        video_filter += ',' + scale_filter
+    if roi_layout is not None:
+        video_filter = roi_layout.filtergraph(video_filter)
+    return [FFMPEG_BINARY] + input_args + ['-i', infile, '-vf', video_filter] + output_args
+
+# Observe FRAME the way the lag monitor planned: CHEAP frames only get the full
+# observe if the vision core's cheap look can't rule out a match
+def observe_frame(vision_core, frame, action=lagmonitor.FULL):
+    if action == lagmonitor.CHEAP:
+        match_info = vision_core.cheap_observe(frame)
+        if match_info is not None:
+            return match_info
+    return vision_core.observe(frame)
+
+# Take frames off ffmpeg as fast as it decodes them, as (frame counter, data,
+# pts, time.time() decoded) on FRAME_QUEUE, a deque of at most MAX_QUEUED_FRAMES
+# that loses its oldest frames when the observer is behind. That way ffmpeg's
+# stdout never fills up and feed never blocks the stream. None marks the end.
+def read_frames_eagerly(frame_stream, video_width, video_height, pts_queue, frame_queue,
+                        frame_ready, monitor):
+    try:
+        for frame_counter, data in enumerate(
+                read_frame_data(frame_stream, video_width, video_height), 1):
+            pts = next_pts(pts_queue)
+            monitor.decoded(frame_counter)
+            with frame_ready:
+                if len(frame_queue) == frame_queue.maxlen:
+                    monitor.dropped()
+                frame_queue.append((frame_counter, data, pts, time.time()))
+                frame_ready.notify()
+    finally:
+        with frame_ready:
+            frame_queue.append(None)
+            frame_ready.notify()
+
+def background_process(event_id, vision_core_class, info_stream, frame_stream, event_queue,
+                       roi_layout=None, metrics_queue=None):
+    match_state = matchstate.MatchState(MATCH_DETECTOR_FPS)
+    monitor = lagmonitor.LagMonitor(MATCH_DETECTOR_FPS)
+    clock = StreamClock()
+    metrics_sent = time.time()
+
+    pts_queue = queue.Queue()
+    video_width, video_height = read_video_resolution(info_stream, pts_queue)
+    threading.Thread(target=read_frame_pts, args=(info_stream, pts_queue), daemon=True).start()
 
     # video_width=1920
     # video_height=1080
 
-    if video_width is None:
-        raise Exception('Failed to identify video resolution')
     #info_stream.close()
     print('******** identified {}x{} resolution'.format(video_width, video_height))
 
-    vision_core = vision_core_class(video_width, video_height)
+    vision_core = make_vision_core(vision_core_class, video_width, video_height, roi_layout)
 
-    frame_size = video_width * video_height * VIDEO_CHANNELS
-    frame_reader = io.BufferedReader(frame_stream)
+    frame_queue = collections.deque(maxlen=MAX_QUEUED_FRAMES)
+    frame_ready = threading.Condition()
+    threading.Thread(target=read_frames_eagerly,
+                     args=(frame_stream, video_width, video_height, pts_queue, frame_queue,
+                           frame_ready, monitor),
+                     daemon=True).start()
 
     while True:
         try:
-            # print('reading frame data')
-            data = frame_reader.read(frame_size)
-            if len(data) < frame_size:
+            with frame_ready:
+                while len(frame_queue) == 0:
+                    frame_ready.wait()
+                item = frame_queue.popleft()
+            if item is None:
                 break
+            frame_counter, data, pts, decoded_at = item
+            seconds = clock.seconds(frame_counter, pts)
 
-            # print('decoding frame data')
-            frame = PIL.Image.frombuffer('RGB', (video_width, video_height), data, 'raw', 'RGB',
-                                         0, 1)
+            action = monitor.plan(frame_counter, match_state, seconds)
+            if action == lagmonitor.SKIP:
+                continue
 
             print('start processing frame {}'.format(frame_counter))
-            frame_counter += 1
-
-            # process_start_time = time.time()
-            new_match_id, match_info = vision_core.process_frame(frame)
-            # print('frame_process_time = {}'.format(time.time() - process_start_time))
-
-            if new_match_id is None:
-                if match_id is not None:
-                    if end_timestamp == -1:
-                        end_timestamp = time.time()
-                    elif time.time() - end_timestamp >= MATCH_END_TIMEOUT:
-                        end_timestamp = -1
-                        match_id_counter.clear()
-                        match_id = None
-                        match_id_queue.put(None)
-            elif len(new_match_id) > 0:
-                new_match_id = MATCH_ID_TEMPLATE.format(event_id, new_match_id)
-                match_id_counter[new_match_id] += 1
-                match_id = match_id_counter.most_common(1)[0][0]
-                match_id_queue.put(match_id)
-
-            if match_id is not None:
-                print('{} {}'.format(match_id, match_info))
+            process_start_time = time.time()
+            match_info = observe_frame(vision_core,
+                                       decode_frame(data, video_width, video_height), action)
+            monitor.processed(frame_counter, match_info, decoded_at,
+                              time.time() - process_start_time, seconds)
+
+            queue_events(event_id, match_state.update(frame_counter, match_info, seconds),
+                         event_queue, clock.on_pts)
+
+            if match_state.match_id is not None:
+                print('{} {} {}'.format(match_state.match_id, match_state.state, match_info))
+
+            if metrics_queue is not None and time.time() - metrics_sent >= METRICS_INTERVAL:
+                metrics_queue.put(monitor.metrics())
+                metrics_sent = time.time()
         except KeyboardInterrupt:
             raise
         except:
             traceback.print_exc()
 
 class MatchObserver:
-    def __init__(self, event_id, game_id):
+    # With a VISION_POOL (see visionpool.py) frames go to its shared workers
+    # instead of a background_process of our own
+    def __init__(self, event_id, game_id, use_roi=False, decode=DEFAULT_DECODE,
+                 decode_threads=None, vision_pool=None):
         self._event_id = event_id
+        self._vision_pool = vision_pool
         self._frame_extractor = None
+        self._use_roi = use_roi
+        self._decode = decode
+        self._decode_threads = decode_threads
+        self._lag_monitor = None
+        self._metrics_queue = None
+        self._metrics = {}
 
         # if game_id == 'FTC-2017':
         #     import matchobserver.ftc2017
         #     self._vision_core_class = ftc2017.FTC2017VisionCore
         # el
         if game_id == 'FRC-2017':
-            import matchobserver.frc2017
-            self._vision_core_class = frc2017.FRC2017VisionCore
+            from matchobserver import frc2017
+            self._vision_core_class = frc2017.VisionCore
         else:
             raise Exception('Unrecognized game id: ' + game_id)
         print('***** ready for game_id ' + game_id)
 
     def start(self):
-        self._match_id_queue = multiprocessing.Queue()
-        self._frame_extractor = subprocess.Popen(FFMPEG_COMMAND,
+        self._event_queue = multiprocessing.Queue()
+        self._lag_monitor = lagmonitor.LagMonitor(MATCH_DETECTOR_FPS)
+        roi_layout = self._vision_core_class.roi_layout() if self._use_roi else None
+        self._frame_extractor = subprocess.Popen(ffmpeg_command(roi_layout, self._decode,
+                                                                self._decode_threads,
+                                                                show_pts=True),
                                                  stdin=subprocess.PIPE,
                                                  stdout=subprocess.PIPE,
                                                  stderr=subprocess.PIPE,
                                                  preexec_fn=os.setpgrp)
 
+        if self._vision_pool is not None:
+            threading.Thread(target=self._feed_vision_pool,
+                             args=(self._frame_extractor, self._event_queue, roi_layout),
+                             daemon=True).start()
+            return
+
+        self._metrics_queue = multiprocessing.Queue()
         multiprocessing.Process(
                 target=background_process,
                 args=(self._event_id,
                       self._vision_core_class,
                       self._frame_extractor.stderr,
                       self._frame_extractor.stdout,
-                      self._match_id_queue)
+                      self._event_queue,
+                      roi_layout,
+                      self._metrics_queue)
         ).start()
 
+    # Register a stream with the vision pool which tracks the match state as
+    # results come back. Returns the match state and the stream's clock.
+    def _add_pool_stream(self, stream_id, event_queue, video_width, video_height, roi_layout):
+        match_state = matchstate.MatchState(MATCH_DETECTOR_FPS)
+        clock = StreamClock()
+        monitor = self._lag_monitor
+
+        def on_result(frame_counter, match_info, tag, elapsed):
+            seconds, decoded_at = tag
+            monitor.processed(frame_counter, match_info, decoded_at, elapsed, seconds)
+            queue_events(self._event_id, match_state.update(frame_counter, match_info, seconds),
+                         event_queue, clock.on_pts)
+
+        # streams in the middle of a match go first
+        def priority():
+            return 1 if match_state.state == matchstate.IDLE else 0
+
+        self._vision_pool.add_stream(stream_id, self._event_id, self._vision_core_class,
+                                     video_width, video_height, roi_layout, on_result, priority)
+        return (match_state, clock)
+
+    # Hand frame FRAME_COUNTER, with the timestamp PTS, to the vision pool,
+    # unless the lag monitor says to skip it
+    def _submit(self, stream_id, match_state, clock, frame_counter, data, pts):
+        seconds = clock.seconds(frame_counter, pts)
+        self._lag_monitor.decoded(frame_counter)
+        action = self._lag_monitor.plan(frame_counter, match_state, seconds)
+        if action != lagmonitor.SKIP:
+            self._vision_pool.submit(stream_id, frame_counter, data, (seconds, time.time()),
+                                     action)
+
+    # Hand the frames ffmpeg decodes to the vision pool
+    def _feed_vision_pool(self, frame_extractor, event_queue, roi_layout):
+        stream_id = '{}:{}'.format(self._event_id, frame_extractor.pid)
+        try:
+            pts_queue = queue.Queue()
+            video_width, video_height = read_video_resolution(frame_extractor.stderr, pts_queue)
+            print('******** identified {}x{} resolution'.format(video_width, video_height))
+            threading.Thread(target=read_frame_pts, args=(frame_extractor.stderr, pts_queue),
+                             daemon=True).start()
+
+            match_state, clock = self._add_pool_stream(stream_id, event_queue, video_width,
+                                                       video_height, roi_layout)
+            try:
+                frames = read_frame_data(frame_extractor.stdout, video_width, video_height)
+                for frame_counter, data in enumerate(frames, 1):
+                    self._submit(stream_id, match_state, clock, frame_counter, data,
+                                 next_pts(pts_queue))
+            finally:
+                self._vision_pool.remove_stream(stream_id)
+        except:
+            traceback.print_exc()
+
+    # Like start, but with ffmpeg's pipes driven by the running asyncio event
+    # loop (see asyncconnector.py). Needs a vision pool.
+    async def start_async(self):
+        if self._vision_pool is None:
+            raise Exception('start_async needs a vision pool')
+
+        self._event_queue = multiprocessing.Queue()
+        self._lag_monitor = lagmonitor.LagMonitor(MATCH_DETECTOR_FPS)
+        roi_layout = self._vision_core_class.roi_layout() if self._use_roi else None
+        self._frame_extractor = await asyncio.create_subprocess_exec(
+            *ffmpeg_command(roi_layout, self._decode, self._decode_threads, show_pts=True),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            preexec_fn=os.setpgrp)
+        asyncio.ensure_future(self._feed_vision_pool_async(self._frame_extractor,
+                                                           self._event_queue, roi_layout))
+
+    async def _feed_vision_pool_async(self, frame_extractor, event_queue, roi_layout):
+        stream_id = '{}:{}'.format(self._event_id, frame_extractor.pid)
+        pts_queue = asyncio.Queue()
+        resolution = asyncio.get_running_loop().create_future()
+
+        async def read_info():
+            while True:
+                info_line = (await frame_extractor.stderr.readline()).decode('utf-8', 'replace')
+                if len(info_line) == 0:
+                    break
+                match = SHOWINFO_PTS_RE.search(info_line)
+                if match:
+                    pts_queue.put_nowait(float(match.group(1)))
+                    continue
+                match = VIDEO_RESOLUTION_RE.search(info_line)
+                if match and not resolution.done():
+                    resolution.set_result((int(match.group(1)), int(match.group(2))))
+            if not resolution.done():
+                resolution.set_exception(Exception('Failed to identify video resolution'))
+            pts_queue.put_nowait(None)
+
+        try:
+            asyncio.ensure_future(read_info())
+            video_width, video_height = await resolution
+            print('******** identified {}x{} resolution'.format(video_width, video_height))
+
+            match_state, clock = self._add_pool_stream(stream_id, event_queue, video_width,
+                                                       video_height, roi_layout)
+            try:
+                frame_size = video_width * video_height * VIDEO_CHANNELS
+                frame_counter = 0
+                while True:
+                    try:
+                        data = await frame_extractor.stdout.readexactly(frame_size)
+                    except asyncio.IncompleteReadError:
+                        break
+                    frame_counter += 1
+                    try:
+                        pts = await asyncio.wait_for(pts_queue.get(), PTS_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        pts = None
+                    self._submit(stream_id, match_state, clock, frame_counter, data, pts)
+            finally:
+                self._vision_pool.remove_stream(stream_id)
+        except:
+            traceback.print_exc()
+
     def stop(self):
         if self._frame_extractor is not None:
             self._frame_extractor.terminate()
             self._frame_extractor = None
-        self._match_id_queue = None
+        self._event_queue = None
 
     def feed(self, data):
         self._frame_extractor.stdin.write(data)
 
-    def has_update(self):
-        return not self._match_id_queue.empty()
+    # Write DATA to an ffmpeg started by start_async, waiting while its pipe is full
+    async def feed_async(self, data):
+        if self._frame_extractor is None:
+            return
+        self._frame_extractor.stdin.write(data)
+        await self._frame_extractor.stdin.drain()
+
+    # Lag and load of the observer (see lagmonitor.py), as of the last report
+    # from its background_process
+    def metrics(self):
+        if self._metrics_queue is not None:
+            while not self._metrics_queue.empty():
+                self._metrics = self._metrics_queue.get_nowait()
+            return self._metrics
+        if self._lag_monitor is not None:
+            return self._lag_monitor.metrics()
+        return {}
 
-    def get_latest(self):
-        new_match_id = None
-        while not self._match_id_queue.empty(): # why is there a while? It seems if there were more than one in the queue it would loose the old ones
-            new_match_id = self._match_id_queue.get_nowait()
-        return new_match_id
+    def has_update(self):
+        return not self._event_queue.empty()
+
+    # Match events (see matchstate.py) confirmed since the last call, oldest first
+    def get_events(self):
+        events = []
+        while not self._event_queue.empty():
+            events.append(self._event_queue.get_nowait())
+        return events
@@ -0,0 +1,152 @@
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# The match time and scores are drawn in a fixed font at a fixed position, so
+# instead of OCR we can threshold the crop, split it into glyphs on empty
+# columns, and correlate each glyph against one template per digit. Templates
+# are learned from crops whose value we already know (eg. when Tesseract
+# readings agree), so a reader calibrates itself as it runs.
+
+import os
+
+import numpy
+
+GLYPH_WIDTH = 12
+GLYPH_HEIGHT = 20
+MIN_GLYPH_COLUMNS = 2
+MIN_MATCH_SCORE = 0.8
+
+# Ink is whichever side of the mean grey level the fewest pixels fall on, so
+# this works for light digits on a dark box and the other way around
+def binarize(img):
+    grey = numpy.asarray(img.convert('L'), dtype=numpy.float32)
+    ink = grey > grey.mean()
+    if ink.sum() > ink.size / 2:
+        ink = ~ink
+    return ink
+
+# Split a binarized crop into glyphs on runs of empty columns, trimming each to
+# the rows it has ink in
+def segment(ink):
+    columns = numpy.concatenate(([False], ink.any(axis=0), [False]))
+    edges = numpy.flatnonzero(columns[1:] != columns[:-1]).reshape(-1, 2)
+
+    glyphs = []
+    for x1, x2 in edges:
+        if x2 - x1 < MIN_GLYPH_COLUMNS:
+            continue
+        glyph = ink[:, x1:x2]
+        rows = numpy.flatnonzero(glyph.any(axis=1))
+        glyphs.append(glyph[rows[0]:rows[-1] + 1])
+    return glyphs
+
+# Nearest neighbour resize of every glyph to GLYPH_WIDTH x GLYPH_HEIGHT, as
+# zero mean, unit length rows ready for correlation. Solid glyphs (eg. a 1 in
+# some fonts) come out all zeros, see solid.
+def features(glyphs):
+    out = numpy.zeros((len(glyphs), GLYPH_HEIGHT * GLYPH_WIDTH), dtype=numpy.float32)
+    for i, glyph in enumerate(glyphs):
+        height, width = glyph.shape
+        ys = numpy.arange(GLYPH_HEIGHT) * height // GLYPH_HEIGHT
+        xs = numpy.arange(GLYPH_WIDTH) * width // GLYPH_WIDTH
+        out[i] = glyph[ys[:, None], xs[None, :]].ravel()
+    out -= out.mean(axis=1, keepdims=True)
+    norms = numpy.linalg.norm(out, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return out / norms
+
+# Which glyphs are all ink. Those have nothing to correlate, so they're matched
+# by how often each digit was learned from a solid glyph instead.
+def solid(glyphs):
+    return numpy.array([glyph.all() for glyph in glyphs], dtype=bool)
+
+class DigitReader:
+    def __init__(self, path=None):
+        self._sums = numpy.zeros((10, GLYPH_HEIGHT * GLYPH_WIDTH), dtype=numpy.float32)
+        self._counts = numpy.zeros(10, dtype=numpy.int32)
+        self._solid = numpy.zeros(10, dtype=numpy.int32)
+        self._templates = numpy.zeros_like(self._sums)
+        self._taken = self._learned()
+        if path is not None and os.path.isfile(path):
+            self.load(path)
+
+    # Read the number in IMG, or None unless every glyph confidently matches a
+    # learned digit
+    def read(self, img):
+        glyphs = segment(binarize(img))
+        if len(glyphs) == 0:
+            return None
+
+        scores = features(glyphs) @ self._templates.T
+        scores[solid(glyphs)] = self._solid / numpy.maximum(self._counts, 1)
+        digits = scores.argmax(axis=1)
+        if (scores[numpy.arange(len(digits)), digits] < MIN_MATCH_SCORE).any():
+            return None
+        return int(''.join(str(digit) for digit in digits))
+
+    # Add the glyphs of IMG to the templates, given the number it shows
+    def learn(self, img, value):
+        glyphs = segment(binarize(img))
+        digits = [int(digit) for digit in str(value)]
+        if len(glyphs) != len(digits):
+            return False
+
+        for digit, feature, is_solid in zip(digits, features(glyphs), solid(glyphs)):
+            self._sums[digit] += feature
+            self._counts[digit] += 1
+            self._solid[digit] += is_solid
+        self._templates = features_from_sums(self._sums)
+        return True
+
+    def _learned(self):
+        return (self._sums.copy(), self._counts.copy(), self._solid.copy())
+
+    # What's been learned since the last call (or since loading), for merging
+    # into a reader in another process
+    def take_learned(self):
+        learned = self._learned()
+        taken = tuple(now - before for now, before in zip(learned, self._taken))
+        self._taken = learned
+        return taken
+
+    def merge_learned(self, learned):
+        sums, counts, solid = learned
+        self._sums = self._sums + sums
+        self._counts = self._counts + counts
+        self._solid = self._solid + solid
+        self._templates = features_from_sums(self._sums)
+
+    def save(self, path):
+        numpy.savez(path, sums=self._sums, counts=self._counts, solid=self._solid)
+
+    def load(self, path):
+        data = numpy.load(path)
+        self._sums = data['sums']
+        self._counts = data['counts']
+        # templates saved before solid glyphs were told apart have none
+        if 'solid' in data.files:
+            self._solid = data['solid']
+        self._templates = features_from_sums(self._sums)
+        self._taken = self._learned()
+
+def features_from_sums(sums):
+    norms = numpy.linalg.norm(sums, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return sums / norms
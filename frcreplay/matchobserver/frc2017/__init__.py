@@ -32,7 +32,12 @@ import PIL
 import PIL.ImageEnhance
 import PIL.ImageOps
 import PIL.ImageDraw
-import pytesseract
+
+from matchobserver import digits
+from matchobserver import ocr
+from matchobserver.phash import HashCache
+from matchobserver.roi import RoiLayout
+from matchobserver.timing import StageTimer
 
 # The below constants use this size as a reference.
 # If the video is different a scale is applied in the constructor
@@ -87,9 +92,30 @@ FIRST_PORTION_THRESHOLD = 10
 MATCH_ENDED_COLOR = (236, 54, 11)
 MATCH_ENDED_THRESHOLD = 100
 
+# Cheap checks run before any OCR. The FMS bar has solid alliance colored boxes
+# either side of the match time, and the labels and screen headers are text on
+# a flat background, while camera footage is neither.
+ALLIANCE_RECTS = [
+    ((560, 655, 600, 700), 'left'),
+    ((680, 655, 720, 700), 'right'),
+]
+ALLIANCE_COLOR_THRESHOLD = 80
+
+TEXT_HISTOGRAM_SHIFT = 4 # 256 grey levels down to 16 bins
+TEXT_BACKGROUND_RATIO = 0.45 # at least this much of the rect is one grey level
+TEXT_INK_RATIO = 0.02 # and at least this much is far from it
+TEXT_INK_DISTANCE = 3 # bins between background and ink, skips anti-aliasing
+
 AUTON_TIME = 15
 TELEOP_TIME = 135
 
+# Bands of the frame containing every rect read above, for decoding only the
+# regions of interest (see matchobserver/roi.py)
+ROI_BANDS = [
+    (0,  544, 800,  720), # FMS bar: game label, FIRST logo, match time, scores
+    (64, 48,  1216, 120), # preview/results screens: outside label, header
+]
+
 
 
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -100,6 +126,21 @@ FIRST_LOGO_FLANN_PARAMS = ({'algorithm': 0, 'trees': 5}, {'checks': 50})
 FIRST_LOGO_MATCH_RATIO = 0.7
 FIRST_LOGO_MIN_MATCH_COUNT = 10
 
+# Digit templates learned by the match time reader, in the digits directory
+# a VisionCore is given
+TIME_DIGITS_NAME = 'time-digits.npz'
+
+# Remembered OCR results for label and header crops which look the same. Each
+# entry holds its crop (see matchobserver/phash.py), a few MB all told.
+OCR_CACHE_SIZE = 64
+
+# Once the label has been found, check it is still there by correlating the
+# same rect against the patch it was read from. While it still matches but
+# can't be read, only fall back to the SURF logo search after this many frames
+# in a row without a label
+LABEL_CACHE_MIN_CORRELATION = 0.5
+FIRST_LOGO_SEARCH_MISSES = 5
+
 MATCH_LABEL_LEFT_PADDING = 15
 MATCH_LABEL_RIGHT_PADDING = 15
 
@@ -173,13 +214,13 @@ def interpret_as_number(text):
 
 # Image to number using tesseract the number config
 def read_number(img):
-    out = pytesseract.image_to_string(img, config=NUMBER_TESSERACT_CONFIG)
+    out = ocr.image_to_string(img, NUMBER_TESSERACT_CONFIG)
     return interpret_as_number(out)
 
 # Use tesseract to find text in a small image. Then check if that text matches
 # any of the MATCH_ID_FORMATS to determine what type of match.
 def read_match_id(cropped_frame):
-    text = pytesseract.image_to_string(cropped_frame)
+    text = ocr.image_to_string(cropped_frame)
     # print('txt: "{}"'.format(text))
 
     for regex, match_type in MATCH_ID_FORMATS:
@@ -201,10 +242,49 @@ def mean_color(img):
 def color_dist(color1, color2):
     return scipy.spatial.distance.euclidean(color1, color2)
 
+# Which alliance color an image is closest to, or None if it is neither
+def alliance_color(img):
+    color = mean_color(img)
+    red_dist = color_dist(color, RED_COLOR)
+    blue_dist = color_dist(color, BLUE_COLOR)
+    if min(red_dist, blue_dist) >= ALLIANCE_COLOR_THRESHOLD:
+        return None
+    return 'red' if red_dist < blue_dist else 'blue'
+
+def grey_array(img):
+    return numpy.asarray(img.convert('L'), dtype=numpy.float32)
+
+# Zero-mean normalized cross-correlation of two same sized grey arrays
+def normalized_correlation(a, b):
+    if a.shape != b.shape:
+        return 0
+    a = a - a.mean()
+    b = b - b.mean()
+    denominator = numpy.sqrt((a * a).sum() * (b * b).sum())
+    if denominator == 0:
+        return 0
+    return (a * b).sum() / denominator
+
+# Histogram test for text on a flat overlay background: one grey level
+# dominates and some pixels are well away from it
+def looks_like_text(img):
+    grey = numpy.asarray(img.convert('L'), dtype=numpy.uint8) >> TEXT_HISTOGRAM_SHIFT
+    histogram = numpy.bincount(grey.ravel(), minlength=256 >> TEXT_HISTOGRAM_SHIFT)
+    background = histogram.argmax()
+    if histogram[background] < TEXT_BACKGROUND_RATIO * grey.size:
+        return False
+    ink = histogram[:max(background - TEXT_INK_DISTANCE + 1, 0)].sum() + \
+          histogram[background + TEXT_INK_DISTANCE:].sum()
+    return ink >= TEXT_INK_RATIO * grey.size
+
 
 
 class VisionCore:
-    def __init__(self, video_width, video_height):
+    # When ROI_LAYOUT is given frames are packed by it and VIDEO_WIDTH,
+    # VIDEO_HEIGHT are the base size its bands are written against. DIGITS_DIR
+    # is where learned digit templates are loaded from and saved to, if anywhere.
+    def __init__(self, video_width, video_height, roi_layout=None, digits_dir=None):
+        self._roi_layout = roi_layout
 
         #@bb quicker than scaling the image?
 
@@ -214,10 +294,19 @@ class VisionCore:
         self._scaled_label_rects = self.rescale_rects(MATCH_LABEL_RECTS)
         self._scaled_results_rects = self.rescale_rects(MATCH_RESULTS_RECTS)
         self._scaled_time_rect = self.rescale_rects(MATCH_TIME_RECT)
+        self._scaled_alliance_rects = self.rescale_rects(ALLIANCE_RECTS)
 
         self._half_video_width = video_width / 2
         self._label_x2 = self._half_video_width - MATCH_LABEL_RIGHT_PADDING
 
+        # With only the ROI bands available, look for the logo in the FMS bar
+        logo_scan_y1 = 0 if roi_layout is None else ROI_BANDS[0][1]
+        logo_scan_y2 = video_height if roi_layout is None else ROI_BANDS[0][3]
+        self._logo_scan_rect = self._map_rect(
+            (0, logo_scan_y1, video_width * FIRST_LOGO_SCAN_RATIO, logo_scan_y2))
+        self._label_x2 = self._map_rect(
+            (self._label_x2, logo_scan_y1, self._label_x2, logo_scan_y1))[0]
+
         # setup to be able to search for FIRST Logo location
         logo = FIRST_LOGO_TEMPLATE_PATH
         template = cv2.cvtColor(cv2.imread(logo), cv2.COLOR_BGR2RGB)
@@ -227,6 +316,37 @@ class VisionCore:
         self._template_keypoints, self._template_descriptors = \
             self._feature_detector.detectAndCompute(template, None)
 
+        self.label_rect = None
+        self._label_patch = None
+        self._label_misses = 0
+        self.timer = StageTimer()
+        self._ocr_cache = HashCache(OCR_CACHE_SIZE)
+
+        self._digits_dir = digits_dir
+        self._time_reader = digits.DigitReader(self._digits_path(TIME_DIGITS_NAME))
+
+    def _digits_path(self, name):
+        if self._digits_dir is None:
+            return None
+        return os.path.join(self._digits_dir, name)
+
+    # Keep what the digit reader has learned for the next run
+    def save_digits(self):
+        if self._digits_dir is None:
+            return
+        os.makedirs(self._digits_dir, exist_ok=True)
+        self._time_reader.save(self._digits_path(TIME_DIGITS_NAME))
+
+    # What this core has timed and learned since the last call, for a core in
+    # another process (eg. the parent of a pool of them) to merge_state
+    def take_state(self):
+        return (self.timer.take(), self._time_reader.take_learned())
+
+    def merge_state(self, state):
+        timings, time_digits = state
+        self.timer.merge(timings)
+        self._time_reader.merge_learned(time_digits)
+
     def rescale_rects(self, rects):
         ret = []
         isList=True
@@ -239,15 +359,26 @@ class VisionCore:
                 x1 * self._x_scale, y1 * self._y_scale,
                 x2 * self._x_scale, y2 * self._y_scale
             ), typ))
+        ret = [(self._map_rect(rect), typ) for rect, typ in ret]
         if isList:
             return ret
         return ret[0]
 
+    @classmethod
+    def roi_layout(cls):
+        return RoiLayout(ROI_BANDS, BASE_WIDTH, BASE_HEIGHT)
+
+    # Where a rect of the full frame is in the frames we are given
+    def _map_rect(self, rect):
+        if self._roi_layout is None:
+            return rect
+        return self._roi_layout.map_rect(rect)
+
     def _get_match_info(self, frame):
         def process(rect, typ):
             newframe = frame.crop(rect)
             # newframe.show()
-            match_type, match_number = read_match_id(newframe)
+            match_type, match_number = self._ocr_cache.lookup(rect, newframe, read_match_id)
             # print('match', match_type, match_number)
             if match_type is not None \
                     and len(match_type) > 0 \
@@ -261,50 +392,144 @@ class VisionCore:
                 }
             return None
 
-        # Search known locations
+        with self.timer.time('score_bar'):
+            score_bar = self.has_score_bar(frame)
+
+        # Try wherever the label was last found, if it still looks the same
+        tried_rect = None
+        if self.label_rect is not None:
+            with self.timer.time('label_cache'):
+                correlation = normalized_correlation(
+                    grey_array(frame.crop(self.label_rect)), self._label_patch)
+            if correlation >= LABEL_CACHE_MIN_CORRELATION:
+                self.timer.count('label_cache_hit')
+                tried_rect = self.label_rect
+                with self.timer.time('label_ocr'):
+                    ret = process(self.label_rect, 'game')
+                if ret is not None:
+                    return ret
+            else:
+                self.timer.count('label_cache_miss')
+
+        # Search known locations, skipping any without text or just read above
         for rect, typ in self._scaled_label_rects:
-            ret = process(rect, typ)
+            if rect == tried_rect:
+                continue
+            if not (typ == 'game' and score_bar) and not looks_like_text(frame.crop(rect)):
+                continue
+            with self.timer.time('label_ocr'):
+                ret = process(rect, typ)
             if ret is not None:
                 return ret
-        # if not found use _find_label_rect
-        found_rect = self._find_label_rect(frame)
-        return process(found_rect, "game")
+
+        # if not found use _find_label_rect, which is only worth it with the FMS
+        # bar up. While the label still looks like the one last found it can
+        # wait for a few misses in a row; with no label found yet, or one that
+        # has gone, it's searched for straight away.
+        if not score_bar:
+            return None
+        self._label_misses += 1
+        if tried_rect is not None and self._label_misses < FIRST_LOGO_SEARCH_MISSES:
+            self.timer.count('logo_search_skipped')
+            return None
+        self._label_misses = 0
+        with self.timer.time('logo_search'):
+            found_rect = self._find_label_rect(frame)
+        if found_rect is None:
+            return None
+        with self.timer.time('label_ocr'):
+            return process(found_rect, "game")
+
+    # The FMS bar is up if the boxes beside the match time are one of each
+    # alliance color
+    def has_score_bar(self, frame):
+        colors = [alliance_color(frame.crop(rect)) for rect, side in self._scaled_alliance_rects]
+        return None not in colors and colors[0] != colors[1]
 
     def get_match_info(self, frame):
         ret = self._get_match_info(frame)
 
         if ret is not None and ret['type'] == "game":
             self.label_rect = ret['rect']
+            self._label_patch = grey_array(frame.crop(ret['rect']))
+            self._label_misses = 0
 
         return ret
 
+    # Read the match time with the digit reader, only falling back to tesseract
+    # when it can't. Whenever two tesseract readings agree they are taught to
+    # the digit reader, so it calibrates itself over the first few frames.
     def get_match_time(self, frame):
 
         match_time_img = frame.crop(self._scaled_time_rect[0])#self._crop_rel(frame, self.label_rect, MATCH_TIME_RECT)
         # match_time_img.show()
 
-        match_time1 = read_number(match_time_img)
-        # if match_time1 is not None:
-        #     return match_time1
+        match_time = self._time_reader.read(match_time_img)
+        if match_time is not None:
+            return match_time
 
         match_time_enhanced = \
             PIL.ImageEnhance.Contrast(match_time_img).enhance(MATCH_TIME_CONTRAST)
         # match_time_enhanced.show()
-        match_time2 = read_number(match_time_enhanced)
-        # if match_time2 is not None:
-        #     return match_time2
-
         match_time_thresholded = \
             match_time_enhanced \
             .convert('L') \
             .point(lambda x: 0 if x < MATCH_TIME_THRESHOLD else 255, '1')
         # match_time_thresholded.show()
-        match_time3 = read_number(match_time_thresholded)
 
-        # if match_time3 is not None:
-        #     return match_time3
+        readings = []
+        for img in (match_time_thresholded, match_time_enhanced, match_time_img):
+            match_time = read_number(img)
+            if match_time is not None and match_time in readings:
+                self._time_reader.learn(match_time_img, match_time)
+                return match_time
+            readings.append(match_time)
+
+        for match_time in readings:
+            if match_time is not None:
+                return match_time
+        return None
 
-        return (match_time1, match_time2, match_time3)
+    # The cheap look for frames an observer can't afford to observe: without the
+    # FMS bar or a preview/results screen up there's no match running or about
+    # to and nothing worth reading. None when either is up and the frame needs
+    # the full observe, so a preview under lag still gets seen.
+    def cheap_observe(self, frame):
+        with self.timer.time('cheap'):
+            if self.has_score_bar(frame):
+                return None
+            for rect, typ in self._scaled_results_rects:
+                if looks_like_text(frame.crop(rect)):
+                    return None
+        return {}
+
+    # Everything we can learn from a single frame: match id, whether the
+    # game overlay is up, the match clock, or the preview/results screen
+    def observe(self, frame):
+        hits = self._ocr_cache.hits
+        with self.timer.time('frame'):
+            info = self._observe(frame)
+        if self._ocr_cache.hits > hits:
+            self.timer.count('ocr_cache_hit')
+        return info
+
+    def _observe(self, frame):
+        info = self.get_match_info(frame)
+        if info is None:
+            info = {}
+
+        if 'type' in info:
+            if info['type'] == "game":
+                with self.timer.time('match_time'):
+                    info['time'] = self.get_match_time(frame)
+            if info['type'] == "outside":
+                with self.timer.time('frame_type'):
+                    info['type'] = self.get_frame_type(frame)
+
+        if 'rect' in info:
+            del info['rect']
+
+        return info
 
     def hasMatchStarted(self, frame):
         t = self.getMatchTime(frame)
@@ -330,7 +555,9 @@ class VisionCore:
         for rect, typ in self._scaled_results_rects:
             newframe = frame.crop(rect)
             # newframe.show()
-            text = pytesseract.image_to_string(newframe)
+            if not looks_like_text(newframe):
+                continue
+            text = self._ocr_cache.lookup(rect, newframe, ocr.image_to_string)
             # print('found', text)
             match = re.match(r'Match[^R]+Res', text, re.I)
             if match:
@@ -528,15 +755,15 @@ class VisionCore:
         x2 = rx2 * self._x_scale + self._half_video_width
         y2 = ry2 * self._y_scale + oy1
 
-        print('', rel_rect, (x1, y1, x2, y2))
+        # print('', rel_rect, (x1, y1, x2, y2))
 
         return frame.crop((x1, y1, x2, y2))
 
     # Attempt to find match label rectangle
     # Says something like: Qualification 1 of 74
     def _find_label_rect(self, frame):
-        frame_crop = (0, 0, frame.width * FIRST_LOGO_SCAN_RATIO, frame.height)
-        frame_array = numpy.array(frame.crop(frame_crop))
+        scan_x1, scan_y1 = self._logo_scan_rect[:2]
+        frame_array = numpy.array(frame.crop(self._logo_scan_rect))
         keypoints, descriptors = self._feature_detector.detectAndCompute(frame_array, None)
 
         if descriptors is None:
@@ -558,8 +785,8 @@ class VisionCore:
             t = cv2.estimateRigidTransform(src_pts, dst_pts, False)
             if t is not None:
                 scale = t[0, 0]
-                x1 = t[0, 2]
-                y1 = t[1, 2]
+                x1 = t[0, 2] + scan_x1
+                y1 = t[1, 2] + scan_y1
                 x2 = x1 + self._template_width * scale
                 y2 = y1 + self._template_height * scale
                 return (x2 + MATCH_LABEL_LEFT_PADDING, y1, self._label_x2, y2)
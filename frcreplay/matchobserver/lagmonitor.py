@@ -0,0 +1,128 @@
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Keeps track of how far a live observer has fallen behind its stream and
+# decides, frame by frame, how much work the observer can afford to spend. While
+# it keeps up every frame gets a full look. Once it's behind, frames between
+# matches are skipped and the rest only get the vision core's cheap check (is
+# the game overlay or a preview screen up at all?), and frames in a match are
+# looked at every other one, except around the points the clock says a
+# transition is due and while the preview screen says a match is about to
+# start. metrics() reports the lag and the vision time spent per second of
+# stream, for sizing hosts.
+
+import collections
+import threading
+import time
+
+from matchobserver import matchstate
+
+LAG_TARGET = 6 # seconds of stream an observer may be behind before it cuts back
+MAX_IDLE_STRIDE = 4 # between matches, at worst only every Nth frame is looked at
+TRANSITION_WINDOW = 10 # seconds either side of a due transition to look at every frame
+PREVIEW_WINDOW = 30 # seconds after a preview screen to look at every frame
+SMOOTHING = 0.1 # weight of the newest sample in the moving averages
+
+FULL = 'full'
+CHEAP = 'cheap'
+SKIP = 'skip'
+
+class LagMonitor:
+    def __init__(self, fps):
+        self._fps = fps
+        self._lock = threading.Lock()
+        self._decoded = 0
+        self._processed = 0
+        self._preview_seen = None
+        self._counts = collections.Counter()
+        self._busy = 0
+        self._observe_time = None
+        self._latency = None
+
+    # Seconds of stream between the newest decoded frame and the last one dealt with
+    def lag(self):
+        return max(0, self._decoded - self._processed) / self._fps
+
+    # FRAME_COUNTER came out of the decoder
+    def decoded(self, frame_counter):
+        with self._lock:
+            self._decoded = max(self._decoded, frame_counter)
+
+    # Decoded frames thrown away before they could be planned
+    def dropped(self, count=1):
+        with self._lock:
+            self._counts['dropped'] += count
+
+    # How to deal with FRAME_COUNTER, SECONDS into the stream on MATCH_STATE's
+    # clock (frame_counter / fps if not given): FULL, CHEAP or SKIP
+    def plan(self, frame_counter, match_state, seconds=None):
+        if seconds is None:
+            seconds = frame_counter / self._fps
+        due = match_state.next_transition()
+        if self.lag() <= LAG_TARGET:
+            action = FULL
+        elif due is not None and abs(seconds - due) <= TRANSITION_WINDOW:
+            action = FULL
+        elif match_state.state != matchstate.IDLE:
+            action = FULL if frame_counter % 2 == 0 else SKIP
+        elif self._preview_seen is not None and seconds - self._preview_seen <= PREVIEW_WINDOW:
+            action = FULL
+        else:
+            stride = min(MAX_IDLE_STRIDE, 1 + int(self.lag() / LAG_TARGET))
+            action = CHEAP if frame_counter % stride == 0 else SKIP
+
+        with self._lock:
+            self._counts[action] += 1
+            if action == SKIP:
+                self._processed = max(self._processed, frame_counter)
+        return action
+
+    # FRAME_COUNTER, decoded at the time.time() DECODED_AT, was observed as
+    # MATCH_INFO in ELAPSED seconds of vision time. SECONDS is as for plan.
+    def processed(self, frame_counter, match_info, decoded_at, elapsed, seconds=None):
+        with self._lock:
+            self._processed = max(self._processed, frame_counter)
+            if match_info.get('type') == 'preview':
+                self._preview_seen = frame_counter / self._fps if seconds is None else seconds
+            self._busy += elapsed
+            self._observe_time = moving_average(self._observe_time, elapsed)
+            self._latency = moving_average(self._latency, time.time() - decoded_at)
+
+    def metrics(self):
+        with self._lock:
+            stream_seconds = self._decoded / self._fps
+            return {
+                'decoded': self._decoded,
+                'processed': self._processed,
+                'lag': self.lag(),
+                'latency': self._latency,
+                'observe_time': self._observe_time,
+                # vision CPU per second of stream, roughly the cores a stream needs
+                'load': self._busy / stream_seconds if stream_seconds > 0 else None,
+                'full': self._counts[FULL],
+                'cheap': self._counts[CHEAP],
+                'skipped': self._counts[SKIP],
+                'dropped': self._counts['dropped'],
+            }
+
+def moving_average(average, sample):
+    if average is None:
+        return sample
+    return average + SMOOTHING * (sample - average)
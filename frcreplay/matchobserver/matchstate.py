@@ -0,0 +1,203 @@
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Online counterpart of 4statemachine.py for the live recorder. Observations go
+# in one frame at a time and match events come out as soon as they're
+# confirmed, in constant time and memory per frame:
+#
+#   start    the clock started counting down for a match (auto)
+#   teleop   the clock restarted at TELEOP_TIME
+#   end      teleop ran out, or the game overlay went away (aborted match)
+#   results  the results screen for the match came up
+#
+# Every event carries the frame it happened on (worked out from the clock, so
+# usually before the frame it was confirmed on), the same as 'seconds' into the
+# stream at the frame rate the machine was given, and the confirming frame and
+# its 'confirmed_seconds'. Seconds are frame / fps unless frames come with their
+# own (eg. their stream PTS).
+
+import collections
+
+AUTON_TIME = 15
+TELEOP_TIME = 135
+
+VOTE_WINDOW = 5 # frames in the rolling match id vote
+MIN_VOTES = 3 # votes a match id needs in the window
+CONFIRM_READINGS = 2 # consecutive time readings which have to agree on the clock
+TIME_TOLERANCE = 2 # seconds a reading may be off the clock it agrees with
+OVERLAY_TIMEOUT = 20 # seconds without a game frame before a running match is over
+RESULTS_TIMEOUT = 600 # seconds after the end of a match to wait for its results
+
+IDLE = 'idle'
+AUTO = 'auto'
+TELEOP = 'teleop'
+ENDED = 'ended'
+
+# '<match type> <match number>', or None unless the observation has both
+def observed_match_id(info):
+    if info.get('match_type') and info.get('match_number'):
+        return '{} {}'.format(info['match_type'], info['match_number'])
+    return None
+
+class MatchState:
+    def __init__(self, fps, vote_window=VOTE_WINDOW):
+        self._fps = fps
+
+        self._votes = collections.deque(maxlen=vote_window)
+        self._vote_counts = collections.Counter()
+
+        # (period, time the period started, readings agreeing on it)
+        self._clock = None
+        self._last_game = None
+
+        self.state = IDLE
+        self.match_id = None
+        self._seconds = None
+        self._start = None
+        self._teleop_start = None
+        self._end = None
+
+    # Add one frame's match id to the vote, returning the winner if it has enough
+    # votes. The window is bounded so this is constant time.
+    def _vote(self, match_id):
+        if len(self._votes) == self._votes.maxlen:
+            evicted = self._votes[0]
+            if evicted is not None:
+                self._vote_counts[evicted] -= 1
+                if self._vote_counts[evicted] == 0:
+                    del self._vote_counts[evicted]
+        self._votes.append(match_id)
+        if match_id is not None:
+            self._vote_counts[match_id] += 1
+
+        if len(self._vote_counts) == 0:
+            return None
+        match_id, votes = self._vote_counts.most_common(1)[0]
+        return match_id if votes >= MIN_VOTES else None
+
+    # Work out which period a reading of T at SECONDS belongs to and when that
+    # period started. Readings up to AUTON_TIME could be auto or the end of
+    # teleop, so they go with the clock already running if they agree with it.
+    # Returns (period, start) once CONFIRM_READINGS readings agree.
+    def _read_clock(self, seconds, t):
+        if t is None or t <= 0 or t > TELEOP_TIME:
+            return None
+
+        candidates = [(TELEOP, seconds - (TELEOP_TIME - t))]
+        if t <= AUTON_TIME:
+            candidates.insert(0, (AUTO, seconds - (AUTON_TIME - t)))
+
+        if self._clock is not None:
+            period, start, readings = self._clock
+            for candidate_period, candidate_start in candidates:
+                if candidate_period == period and abs(candidate_start - start) <= TIME_TOLERANCE:
+                    self._clock = (period, start, readings + 1)
+                    break
+            else:
+                self._clock = None
+
+        if self._clock is None:
+            period, start = candidates[-1] if self.state == TELEOP else candidates[0]
+            self._clock = (period, start, 1)
+
+        period, start, readings = self._clock
+        if readings < CONFIRM_READINGS:
+            return None
+        return (period, start)
+
+    def _event(self, name, seconds, frame):
+        return {
+            'event': name,
+            'match_id': self.match_id,
+            'frame': round(seconds * self._fps),
+            'seconds': seconds,
+            'confirmed': frame,
+            'confirmed_seconds': self._seconds,
+        }
+
+    # Stream seconds at which the clock says the next transition (teleop, or the
+    # end of the match) is due, or None outside a match
+    def next_transition(self):
+        if self.state == AUTO:
+            return self._start + AUTON_TIME
+        if self.state == TELEOP:
+            return self._teleop_start + TELEOP_TIME
+        return None
+
+    # Feed the observation INFO (as returned by VisionCore.observe) for FRAME,
+    # SECONDS into the stream (frame / fps if not given). Returns the list of
+    # events it confirmed, usually empty.
+    def update(self, frame, info, seconds=None):
+        if seconds is None:
+            seconds = frame / self._fps
+        self._seconds = seconds
+        events = []
+
+        voted = self._vote(observed_match_id(info))
+        clock = None
+        if info.get('type') == 'game':
+            self._last_game = seconds
+            clock = self._read_clock(seconds, info.get('time'))
+
+        if self.state in (IDLE, ENDED):
+            if clock is not None and voted is not None:
+                period, start = clock
+                match_start = start if period == AUTO else start - AUTON_TIME
+                if self._end is None or match_start > self._end:
+                    self.state = AUTO
+                    self.match_id = voted
+                    self._start = match_start
+                    self._teleop_start = None
+                    self._end = None
+                    events.append(self._event('start', match_start, frame))
+                    if period == TELEOP:
+                        self.state = TELEOP
+                        self._teleop_start = start
+                        events.append(self._event('teleop', start, frame))
+            elif self.state == ENDED:
+                if info.get('type') == 'results' and voted == self.match_id:
+                    self.state = IDLE
+                    events.append(self._event('results', seconds, frame))
+                elif seconds - self._end > RESULTS_TIMEOUT:
+                    self.state = IDLE
+        else:
+            if self.state == AUTO and clock is not None and clock[0] == TELEOP:
+                self.state = TELEOP
+                self._teleop_start = clock[1]
+                events.append(self._event('teleop', clock[1], frame))
+
+            if self.state == TELEOP and seconds >= self._teleop_start + TELEOP_TIME:
+                self._end = self._teleop_start + TELEOP_TIME
+            elif seconds - self._last_game > OVERLAY_TIMEOUT:
+                self._end = self._last_game
+            if self._end is not None:
+                self.state = ENDED
+                self._clock = None
+                events.append(self._event('end', self._end, frame))
+
+        return events
+
+# Run the state machine over a whole list of observation dicts with 'frame'
+# keys, eg. the output of 3processframes.py
+def replay(infos, fps):
+    state = MatchState(fps)
+    for info in sorted(infos, key=lambda info: info['frame']):
+        for event in state.update(info['frame'], info):
+            yield event
@@ -0,0 +1,180 @@
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Compact on-disk store of what VisionCore saw in each frame. Records are
+# fixed size numpy structured rows appended to a binary log, so a whole event
+# day of observations can be memory-mapped and sliced column by column without
+# parsing anything or running OCR again. Match type strings are interned into
+# a small append-only text file next to the log.
+#
+#   <path>        8 byte magic, then OBSERVATION_DTYPE records
+#   <path>.types  one match type per line, a record stores its line number
+
+import os
+
+import numpy
+
+MAGIC = b'FRCOBS1\0'
+
+OBSERVATION_DTYPE = numpy.dtype([
+    ('frame',        '<i4'),
+    ('type',         'i1'),
+    ('match_type',   'i1'),
+    ('match_number', '<i2'),
+    ('time',         '<i2'),
+    ('duration',     '<f4'),
+])
+
+# Values of the type column; index 0 is a frame we learned nothing from
+FRAME_TYPES = [None, 'game', 'outside', 'preview', 'results']
+
+MISSING = -1
+
+def _types_path(path):
+    return path + '.types'
+
+def _read_match_types(path):
+    if not os.path.isfile(_types_path(path)):
+        return []
+    with open(_types_path(path), 'r', encoding='utf-8') as types_file:
+        return [line.rstrip('\n') for line in types_file]
+
+# VALUE as an int for the FIELD column, or MISSING if it isn't a number or is
+# too long a run of OCR digits to fit
+def _to_int(value, field):
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return MISSING
+    limits = numpy.iinfo(OBSERVATION_DTYPE[field])
+    if value < limits.min or value > limits.max:
+        return MISSING
+    return value
+
+# Convert observation dicts (as returned by VisionCore.observe plus 'frame'
+# and '_duration') to records, interning match types into MATCH_TYPES
+def from_dicts(infos, match_types=None):
+    if match_types is None:
+        match_types = []
+    records = numpy.zeros(len(infos), dtype=OBSERVATION_DTYPE)
+    for record, info in zip(records, infos):
+        match_type = info.get('match_type')
+        if match_type is None:
+            match_type_index = MISSING
+        else:
+            if match_type not in match_types:
+                match_types.append(match_type)
+            match_type_index = match_types.index(match_type)
+
+        record['frame'] = info['frame']
+        record['type'] = FRAME_TYPES.index(info.get('type')) \
+            if info.get('type') in FRAME_TYPES else 0
+        record['match_type'] = match_type_index
+        record['match_number'] = _to_int(info.get('match_number'), 'match_number')
+        record['time'] = _to_int(info.get('time'), 'time')
+        record['duration'] = info.get('_duration', 0)
+    return records, match_types
+
+# The inverse of from_dicts, leaving out missing fields like VisionCore does
+def to_dicts(records, match_types):
+    infos = []
+    for record in records:
+        info = {}
+        if record['match_type'] != MISSING:
+            info['match_type'] = match_types[record['match_type']]
+        if record['match_number'] != MISSING:
+            info['match_number'] = str(record['match_number'])
+        if record['type'] != 0:
+            info['type'] = FRAME_TYPES[record['type']]
+        info['frame'] = int(record['frame'])
+        if record['time'] != MISSING:
+            info['time'] = int(record['time'])
+        info['_duration'] = float(record['duration'])
+        infos.append(info)
+    return infos
+
+# Delete the log at PATH, match types and all, if there is one
+def remove(path):
+    for file_path in (path, _types_path(path)):
+        if os.path.isfile(file_path):
+            os.unlink(file_path)
+
+# Memory-map the log at PATH. Returns the records (in the order they were
+# written) and the match type table.
+def load(path):
+    match_types = _read_match_types(path)
+    if not os.path.isfile(path) or os.path.getsize(path) <= len(MAGIC):
+        return numpy.zeros(0, dtype=OBSERVATION_DTYPE), match_types
+
+    with open(path, 'rb') as log:
+        if log.read(len(MAGIC)) != MAGIC:
+            raise Exception('{} is not an observation log'.format(path))
+
+    count = (os.path.getsize(path) - len(MAGIC)) // OBSERVATION_DTYPE.itemsize
+    records = numpy.memmap(path, dtype=OBSERVATION_DTYPE, mode='r', offset=len(MAGIC),
+                           shape=(count,))
+    return records, match_types
+
+# Records sorted by frame, keeping the last one written for any frame logged
+# more than once
+def ordered(records):
+    order = numpy.argsort(records['frame'], kind='stable')[::-1]
+    frames, first = numpy.unique(records['frame'][order], return_index=True)
+    return numpy.array(records[order[first]])
+
+class ObservationLog:
+    def __init__(self, path):
+        self._path = path
+        self._match_types = _read_match_types(path)
+
+        self._log = open(path, 'ab')
+        size = self._log.tell()
+        if size < len(MAGIC):
+            self._log.truncate(0)
+            self._log.write(MAGIC)
+        else:
+            # drop a torn record left behind by a crash
+            torn = (size - len(MAGIC)) % OBSERVATION_DTYPE.itemsize
+            if torn > 0:
+                self._log.truncate(size - torn)
+        self._log.flush()
+
+        self._types_file = open(_types_path(path), 'a', encoding='utf-8')
+
+    def append(self, infos):
+        known = len(self._match_types)
+        records, self._match_types = from_dicts(infos, self._match_types)
+        for match_type in self._match_types[known:]:
+            self._types_file.write(match_type + '\n')
+        # the types have to be on disk before any record referring to them
+        self._types_file.flush()
+
+        self._log.write(records.tobytes())
+        self._log.flush()
+
+    def close(self):
+        self._log.close()
+        self._types_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,103 @@
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# pytesseract forks the tesseract binary, writes a temp image and reloads the
+# traineddata on every call. When the tesserocr bindings are installed we keep a
+# Tesseract instance loaded through the C API instead, one per process, thread
+# and config, and hand it images directly.
+
+import os
+import threading
+
+import pytesseract
+
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+# Split a tesseract command line config such as '--psm 6 digits' into the page
+# segmentation mode, tessdata directory and config files it names
+def parse_config(config):
+    psm = None
+    tessdata_dir = None
+    configs = []
+
+    tokens = config.split()
+    while len(tokens) > 0:
+        token = tokens.pop(0)
+        if token in ('-psm', '--psm'):
+            psm = int(tokens.pop(0))
+        elif token == '--tessdata-dir':
+            tessdata_dir = tokens.pop(0)
+        else:
+            configs.append(token)
+
+    return (psm, tessdata_dir, configs)
+
+# Runs the tesseract binary for every call
+class PytesseractEngine:
+    def __init__(self, config):
+        self._config = config
+
+    def image_to_string(self, img):
+        return pytesseract.image_to_string(img, config=self._config)
+
+# Keeps Tesseract resident between calls
+class TesserocrEngine:
+    def __init__(self, config):
+        psm, tessdata_dir, configs = parse_config(config)
+
+        kwargs = {}
+        if psm is not None:
+            kwargs['psm'] = psm
+        if tessdata_dir is not None:
+            kwargs['path'] = tessdata_dir.rstrip('/') + '/'
+        if len(configs) > 0:
+            kwargs['configs'] = configs
+        self._api = tesserocr.PyTessBaseAPI(**kwargs)
+
+    def image_to_string(self, img):
+        self._api.SetImage(img)
+        return self._api.GetUTF8Text()
+
+ENGINES = {
+    'pytesseract': PytesseractEngine,
+}
+if tesserocr is not None:
+    ENGINES['tesserocr'] = TesserocrEngine
+
+DEFAULT_ENGINE = 'tesserocr' if tesserocr is not None else 'pytesseract'
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+# Tesseract instances aren't thread safe and don't survive a fork, so each
+# process and thread gets its own per config
+def get_engine(config='', engine=None):
+    engine = engine or DEFAULT_ENGINE
+    key = (os.getpid(), threading.get_ident(), engine, config)
+    if key not in _engines:
+        with _engines_lock:
+            _engines[key] = ENGINES[engine](config)
+    return _engines[key]
+
+def image_to_string(img, config='', engine=None):
+    return get_engine(config, engine).image_to_string(img)
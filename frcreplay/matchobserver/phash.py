@@ -0,0 +1,132 @@
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Perceptual hashing for memoizing OCR. Between matches the broadcast sits on
+# the same preview or results graphic for minutes, and during a match the label
+# doesn't change for 150 seconds, so most crops we OCR look just like one we
+# have OCRed before.
+
+import collections
+
+import numpy
+import PIL.Image
+
+HASH_WIDTH = 32
+HASH_HEIGHT = 8
+# Neighbouring cells must differ by this many grey levels to set a bit, so
+# compression noise on flat backgrounds doesn't flip the hash
+HASH_MIN_DELTA = 4
+
+# The hash alone is too coarse to tell "Match 12" from "Match 13", and so is a
+# quarter size thumbnail of the crop: a one digit change in a small font blurs
+# to a difference of 20 or 30 grey levels, well within compression noise. The
+# thumbnail only rules candidates out cheaply, a hit is confirmed against the
+# full resolution crop, where a changed glyph differs by 200 or more. There
+# compression leaves the odd pixel just as far out, but on its own, where a
+# changed glyph changes whole strokes, so only pixels over CROP_MAX_DIFF next
+# to another one are counted.
+THUMBNAIL_SCALE = 4
+THUMBNAIL_MAX_DIFF = 48
+CROP_MAX_DIFF = 96
+CROP_MAX_CHANGED = 8
+
+def thumbnail(img):
+    size = (max(img.width // THUMBNAIL_SCALE, 1), max(img.height // THUMBNAIL_SCALE, 1))
+    return numpy.asarray(img.convert('L').resize(size, PIL.Image.BILINEAR), dtype=numpy.int16)
+
+# Difference hash: shrink to a small grey grid and record where brightness
+# rises from one cell to the next
+def dhash(thumb):
+    small = PIL.Image.fromarray(thumb.astype(numpy.uint8)).resize(
+        (HASH_WIDTH + 1, HASH_HEIGHT), PIL.Image.BILINEAR)
+    grid = numpy.asarray(small, dtype=numpy.int16)
+    return numpy.packbits(grid[:, 1:] - grid[:, :-1] > HASH_MIN_DELTA).tobytes()
+
+def grey(img):
+    return numpy.asarray(img.convert('L'), dtype=numpy.uint8)
+
+def max_diff(a, b):
+    return numpy.abs(a.astype(numpy.int16) - b.astype(numpy.int16)).max()
+
+# Pixels differing by more than MAX_DIFF between A and B with a neighbour that
+# does too
+def changed_pixels(a, b, max_diff):
+    over = numpy.abs(a.astype(numpy.int16) - b.astype(numpy.int16)) > max_diff
+    neighbours = numpy.zeros_like(over)
+    neighbours[1:] |= over[:-1]
+    neighbours[:-1] |= over[1:]
+    neighbours[:, 1:] |= over[:, :-1]
+    neighbours[:, :-1] |= over[:, 1:]
+    return numpy.count_nonzero(over & neighbours)
+
+# Whether a cache entry was made from a crop looking just like the one given
+def similar(entry, thumb, crop):
+    return entry[0].shape == thumb.shape and entry[1].shape == crop.shape and \
+        max_diff(entry[0], thumb) <= THUMBNAIL_MAX_DIFF and \
+        changed_pixels(entry[1], crop, CROP_MAX_DIFF) <= CROP_MAX_CHANGED
+
+# Bounded LRU of results keyed on the region they were read from and the hash
+# of its pixels. Entries keep their full resolution crop, so MAXSIZE should
+# stay small.
+class HashCache:
+    def __init__(self, maxsize):
+        self._maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self._latest = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _find(self, region, key, thumb, crop):
+        for candidate in (key, self._latest.get(region)):
+            if candidate in self._entries and similar(self._entries[candidate], thumb, crop):
+                return candidate
+        return None
+
+    # Return COMPUTE(IMG), or the remembered result for a crop of REGION which
+    # looked the same. Besides the exact hash, the latest crop of the region is
+    # tried so noise flipping a bit of the hash doesn't cost an OCR. Either way
+    # the crop must match the remembered one at full resolution.
+    def lookup(self, region, img, compute):
+        thumb = thumbnail(img)
+        crop = grey(img)
+        key = (region, dhash(thumb))
+
+        found = self._find(region, key, thumb, crop)
+        if found is not None:
+            self._entries.move_to_end(found)
+            self._latest[region] = found
+            self.hits += 1
+            return self._entries[found][2]
+
+        self.misses += 1
+        value = compute(img)
+        self._entries[key] = (thumb, crop, value)
+        self._entries.move_to_end(key)
+        self._latest[region] = key
+        if len(self._entries) > self._maxsize:
+            (evicted_region, _), _ = self._entries.popitem(last=False)
+            # regions only stay as long as one of their entries does
+            if self._latest.get(evicted_region) not in self._entries:
+                self._latest.pop(evicted_region, None)
+        return value
+
+    def clear(self):
+        self._entries.clear()
+        self._latest.clear()
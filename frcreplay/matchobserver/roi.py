@@ -0,0 +1,79 @@
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# A vision core usually only reads a handful of rects out of each frame. Rather
+# than ship every decoded pixel through the pipe, ffmpeg crops out the bands of
+# the frame containing those rects and stacks them on top of each other:
+#
+#   +-------------------+          +-------------+--+
+#   |   ###########     |  band 0  |#############|  |  (padded to the widest band)
+#   |                   |   --->   +-------------+--+
+#   |                   |  band 1  |  ##         ## |
+#   |  ##          ##   |          +----------------+
+#   +-------------------+
+#
+# Bands are given in base coordinates (the size the vision core's constants are
+# written against) and ffmpeg scales each one to exactly that size, so the packed
+# layout is the same whatever the resolution of the stream.
+
+class RoiLayout:
+    def __init__(self, bands, base_width, base_height):
+        self.bands = [tuple(int(v) for v in band) for band in bands]
+        self.base_width = base_width
+        self.base_height = base_height
+
+        self.width = max(x2 - x1 for x1, y1, x2, y2 in self.bands)
+        self.height = sum(y2 - y1 for x1, y1, x2, y2 in self.bands)
+
+        self._offsets = []
+        offset = 0
+        for x1, y1, x2, y2 in self.bands:
+            self._offsets.append(offset)
+            offset += y2 - y1
+
+    def _band_filter(self, band):
+        x1, y1, x2, y2 = band
+        return 'crop=w=iw*{}:h=ih*{}:x=iw*{}:y=ih*{},scale={}:{},pad={}:{}:0:0'.format(
+            (x2 - x1) / self.base_width, (y2 - y1) / self.base_height,
+            x1 / self.base_width, y1 / self.base_height,
+            x2 - x1, y2 - y1,
+            self.width, y2 - y1)
+
+    # Build an ffmpeg -vf filtergraph which runs PREFIX (e.g. an fps filter) and
+    # then packs the bands into a single self.width x self.height frame
+    def filtergraph(self, prefix):
+        if len(self.bands) == 1:
+            return '{},{}'.format(prefix, self._band_filter(self.bands[0]))
+
+        chains = ['{},split={}{}'.format(
+            prefix, len(self.bands), ''.join('[in{}]'.format(i) for i in range(len(self.bands))))]
+        for i, band in enumerate(self.bands):
+            chains.append('[in{}]{}[band{}]'.format(i, self._band_filter(band), i))
+        chains.append('{}vstack=inputs={}'.format(
+            ''.join('[band{}]'.format(i) for i in range(len(self.bands))), len(self.bands)))
+        return ';'.join(chains)
+
+    # Translate a rect in base coordinates to where it ends up in the packed frame
+    def map_rect(self, rect):
+        x1, y1, x2, y2 = rect
+        for (bx1, by1, bx2, by2), offset in zip(self.bands, self._offsets):
+            if bx1 <= x1 and x2 <= bx2 and by1 <= y1 and y2 <= by2:
+                return (x1 - bx1, y1 - by1 + offset, x2 - bx1, y2 - by1 + offset)
+        raise Exception('Rect {} is not inside any ROI band'.format(rect))
@@ -0,0 +1,74 @@
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import contextlib
+import time
+
+# Accumulates how often and how long each named stage of frame processing ran,
+# plus plain event counters (cache hits and the like)
+class StageTimer:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._counts = collections.Counter()
+        self._totals = collections.Counter()
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._totals[stage] += time.perf_counter() - start
+            self._counts[stage] += 1
+
+    def count(self, event):
+        self._counts[event] += 1
+
+    # The counts and times since the last call (or reset), for merging into a
+    # timer in another process
+    def take(self):
+        taken = (self._counts, self._totals)
+        self.reset()
+        return taken
+
+    def merge(self, taken):
+        counts, totals = taken
+        self._counts.update(counts)
+        self._totals.update(totals)
+
+    def report(self):
+        report = {}
+        for stage, count in sorted(self._counts.items()):
+            report[stage] = {'count': count}
+            if stage in self._totals:
+                report[stage]['total'] = self._totals[stage]
+                report[stage]['mean'] = self._totals[stage] / count
+        return report
+
+    def print_report(self):
+        for stage, stats in self.report().items():
+            if 'total' in stats:
+                print('{:20} {:8d} x {:8.2f} ms = {:9.2f} s'.format(
+                    stage, stats['count'], stats['mean'] * 1000, stats['total']))
+            else:
+                print('{:20} {:8d}'.format(stage, stats['count']))
@@ -0,0 +1,217 @@
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# One bounded pool of vision workers shared by every stream a supervisor
+# follows, instead of a background_process per stream. Each stream is pinned to
+# one worker (the one with the fewest streams when it's first seen), so its vision
+# core and the caches in it live in exactly one process however many workers
+# there are, and it keeps that worker across reconnects. Each stream has at most
+# one frame being looked at at a time (so its results come back in order) and a
+# short queue of frames waiting; when the pool falls behind the oldest waiting
+# frames are dropped. Whenever a worker frees up it takes the oldest waiting
+# frame of its streams with the best priority, so streams in the middle of a
+# match get the CPU before idle ones. Frames go to a worker through a block of
+# shared memory of its own rather than being pickled down its pipe.
+
+import collections
+import functools
+import multiprocessing
+import multiprocessing.resource_tracker
+import multiprocessing.shared_memory
+import threading
+import time
+import traceback
+
+import matchobserver
+from matchobserver import lagmonitor
+
+MAX_PENDING_FRAMES = 4 # frames a stream may have waiting before old ones are dropped
+
+# Per worker vision cores, keyed by (core key, width, height). Cores keep
+# caches between frames, so a stream reuses its core across reconnects.
+_vision_cores = {}
+# The worker's shared memory block, as last attached
+_shared = None
+
+# The first SIZE bytes of the shared memory block NAME
+def _read_shared(name, size):
+    global _shared
+    if _shared is None or _shared.name != name:
+        if _shared is not None:
+            _shared.close()
+        _shared = multiprocessing.shared_memory.SharedMemory(name)
+        # the pool owns the block; without this the worker's resource tracker
+        # would unlink it when the worker exits
+        multiprocessing.resource_tracker.unregister(_shared._name, 'shared_memory')
+    return bytes(_shared.buf[:size])
+
+# Returns the observations and the seconds the worker spent on them
+def _observe(core_key, vision_core_class, video_width, video_height, roi_layout, shared_name,
+             size, action):
+    start = time.perf_counter()
+    key = (core_key, video_width, video_height)
+    if key not in _vision_cores:
+        _vision_cores[key] = matchobserver.make_vision_core(vision_core_class, video_width,
+                                                            video_height, roi_layout)
+    frame = matchobserver.decode_frame(_read_shared(shared_name, size), video_width,
+                                       video_height)
+    match_info = matchobserver.observe_frame(_vision_cores[key], frame, action)
+    return (match_info, time.perf_counter() - start)
+
+class _Stream:
+    def __init__(self, stream_id, core_key, vision_core_class, video_width, video_height,
+                 roi_layout, on_result, priority, worker):
+        self.stream_id = stream_id
+        self.args = (core_key, vision_core_class, video_width, video_height, roi_layout)
+        self.on_result = on_result
+        self.priority = priority
+        self.worker = worker
+        self.pending = collections.deque()
+
+# A single process pool and the shared memory frames are handed to it in
+class _Worker:
+    def __init__(self):
+        self.pool = multiprocessing.Pool(1)
+        self.shared = None
+        self.busy = False
+
+    # Copy DATA into the shared memory block, making it bigger if it has to be.
+    # Returns the name of the block.
+    def share(self, data):
+        if self.shared is None or self.shared.size < len(data):
+            self.close_shared()
+            self.shared = multiprocessing.shared_memory.SharedMemory(create=True,
+                                                                     size=len(data))
+        self.shared.buf[:len(data)] = data
+        return self.shared.name
+
+    def close_shared(self):
+        if self.shared is not None:
+            self.shared.close()
+            self.shared.unlink()
+            self.shared = None
+
+class VisionPool:
+    def __init__(self, workers=None, max_pending=MAX_PENDING_FRAMES):
+        self.workers = workers or multiprocessing.cpu_count()
+        self._max_pending = max_pending
+        self._streams = {}
+        # worker index of every core key seen
+        self._pinned = {}
+        self._lock = threading.Condition()
+        self._workers = None
+        self.dropped = 0
+
+    # Fork the workers. Do this before starting any other threads.
+    def start(self):
+        self._workers = [_Worker() for _ in range(self.workers)]
+        threading.Thread(target=self._dispatch, daemon=True).start()
+
+    def stop(self):
+        with self._lock:
+            workers = self._workers
+            self._workers = None
+            self._lock.notify_all()
+        if workers is not None:
+            for worker in workers:
+                worker.pool.terminate()
+                worker.close_shared()
+
+    # Register a stream. ON_RESULT(frame_counter, match_info, tag, elapsed) is
+    # called from a pool thread with the observations of each frame and the
+    # worker seconds they took, in order, and should be quick. PRIORITY() is
+    # polled when scheduling, lower goes first.
+    def add_stream(self, stream_id, core_key, vision_core_class, video_width, video_height,
+                   roi_layout, on_result, priority):
+        with self._lock:
+            if core_key not in self._pinned:
+                counts = [0] * self.workers
+                for index in self._pinned.values():
+                    counts[index] += 1
+                self._pinned[core_key] = counts.index(min(counts))
+            self._streams[stream_id] = _Stream(stream_id, core_key, vision_core_class,
+                                               video_width, video_height, roi_layout,
+                                               on_result, priority, self._pinned[core_key])
+
+    def remove_stream(self, stream_id):
+        with self._lock:
+            self._streams.pop(stream_id, None)
+
+    # Queue a frame of a stream. TAG is handed back to ON_RESULT with its result.
+    # ACTION is how the lag monitor wants it observed (see lagmonitor.py).
+    def submit(self, stream_id, frame_counter, data, tag=None, action=lagmonitor.FULL):
+        with self._lock:
+            stream = self._streams.get(stream_id)
+            if stream is None:
+                return
+            stream.pending.append((frame_counter, data, tag, time.time(), action))
+            if len(stream.pending) > self._max_pending:
+                stream.pending.popleft()
+                self.dropped += 1
+            self._lock.notify_all()
+
+    # The stream with a frame waiting and the best priority of those pinned
+    # to each idle worker, by worker index
+    def _next_streams(self):
+        best = {}
+        best_keys = {}
+        for stream in self._streams.values():
+            if self._workers[stream.worker].busy or len(stream.pending) == 0:
+                continue
+            key = (stream.priority(), stream.pending[0][3])
+            if stream.worker not in best or key < best_keys[stream.worker]:
+                best[stream.worker] = stream
+                best_keys[stream.worker] = key
+        return best
+
+    def _dispatch(self):
+        with self._lock:
+            while self._workers is not None:
+                streams = self._next_streams()
+                if len(streams) == 0:
+                    self._lock.wait()
+                    continue
+
+                for index, stream in streams.items():
+                    worker = self._workers[index]
+                    frame_counter, data, tag, queued, action = stream.pending.popleft()
+                    worker.busy = True
+                    worker.pool.apply_async(
+                        _observe, stream.args + (worker.share(data), len(data), action),
+                        callback=functools.partial(self._done, stream, frame_counter, tag),
+                        error_callback=functools.partial(self._failed, stream, frame_counter,
+                                                         tag))
+
+    def _done(self, stream, frame_counter, tag, result):
+        match_info, elapsed = result
+        try:
+            stream.on_result(frame_counter, match_info, tag, elapsed)
+        except:
+            traceback.print_exc()
+        finally:
+            with self._lock:
+                if self._workers is not None:
+                    self._workers[stream.worker].busy = False
+                self._lock.notify_all()
+
+    def _failed(self, stream, frame_counter, tag, error):
+        print('******** vision worker failed on frame {} of {}: {!r}'.format(
+            frame_counter, stream.stream_id, error))
+        self._done(stream, frame_counter, tag, ({}, 0))
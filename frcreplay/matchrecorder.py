@@ -20,7 +20,9 @@
 # You should have received a copy of the GNU Affero General Public License along
 # with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
 import collections
+import concurrent.futures
 import datetime
 import multiprocessing
 import os
@@ -28,105 +30,235 @@ import tempfile
 import time
 import traceback
 
+import asyncconnector
 import matchobserver
+import mpegts
+import rendition
+import ringbuffer
 import streamconnector
-# import videohandler
-
-PREMATCH_BUFFER_CHUNKS = 2048
+import uploadqueue
+
+PREROLL_TIME = 5 # seconds of stream to keep before a match starts
+# How late a match start may be reported: the observer up to its lag target
+# behind (see matchobserver/lagmonitor.py) plus the frames it takes to confirm
+# the clock, with room to spare. Starts reported later get less pre-roll.
+MAX_EVENT_DELAY = 20
+STREAM_BITRATE = 6000 # kbit/s, the most Twitch takes from a broadcaster
 SPLIT_AT_TIME = 60 * 8
+RESULTS_TAIL_TIME = 5 # seconds of the results screen to keep
 
 VIDEOS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'videos')
 RECORDING_DIR = os.path.join(VIDEOS_DIR, 'recording')
 READY_DIR = os.path.join(VIDEOS_DIR, 'ready')
-READY_FORMAT = os.path.join(READY_DIR, '{}---{}')
+READY_FORMAT = '{}---{}'
 
 os.makedirs(RECORDING_DIR, exist_ok=True)
 os.makedirs(READY_DIR, exist_ok=True)
 
 TITLE_FORMAT = '[{}] {}'
 
+# Recording (scanning, buffering and writing to disk) for every async recorder,
+# so a slow disk holds up its own streams' recorder sinks and not the loop
+RECORDER_THREADS = 16
+_recorder_executor = concurrent.futures.ThreadPoolExecutor(RECORDER_THREADS, 'recorder')
+
+# Bytes of a BITRATE kbit/s stream the pre-roll buffer has to hold, for the
+# pre-roll of a match start reported as late as it may be
+def prematch_buffer_size(bitrate=STREAM_BITRATE):
+    return (PREROLL_TIME + MAX_EVENT_DELAY) * bitrate * 1000 // 8
+
 class MatchRecorderStreamConnector(streamconnector.StreamConnector):
-    def __init__(self, event_id, twitch_id, twitter_user, game_id):
+    # Recorders sharing a host should share one UPLOAD_QUEUE (see uploadqueue.py),
+    # otherwise each starts its own on a journal of its own event. BITRATE is
+    # the highest the stream is expected to run at, in kbit/s, which sizes the
+    # pre-roll buffer.
+    def __init__(self, event_id, twitch_id, twitter_user, game_id, vision_pool=None,
+                 upload_queue=None, bitrate=STREAM_BITRATE):
         super().__init__(event_id, twitch_id)
         self._twitter_user = twitter_user
         self._game_id = game_id
-        self._match_observer = matchobserver.MatchObserver(event_id, game_id)
+        self._prematch_buffer_size = prematch_buffer_size(bitrate)
+        self._match_observer = matchobserver.MatchObserver(event_id, game_id,
+                                                           vision_pool=vision_pool)
+
+        # one directory per event, so recorders sharing a host leave each
+        # other's videos alone
+        self._recording_dir = os.path.join(RECORDING_DIR, event_id)
+        self._ready_dir = os.path.join(READY_DIR, event_id)
+        os.makedirs(self._recording_dir, exist_ok=True)
+        os.makedirs(self._ready_dir, exist_ok=True)
+
+        if upload_queue is None:
+            upload_queue = uploadqueue.UploadQueue(
+                os.path.join(VIDEOS_DIR, '{}.{}'.format(event_id, uploadqueue.JOURNAL_NAME)))
+            upload_queue.start()
+        self._upload_queue = upload_queue
+
+        # videos made before a restart. This runs once, not on every reconnect,
+        # so a video the queue has set aside stays aside until it's retried.
+        for ready_filename in sorted(os.listdir(self._ready_dir)):
+            # upload renditions are made next to their videos
+            if rendition.SUFFIX in ready_filename:
+                continue
+            self._upload_in_background(os.path.join(self._ready_dir, ready_filename))
 
     def on_connecting(self):
         self._match_id = None
         self._match_video = None
 
-        self._last_timestamp = 0
-        self._recording_timestamp = -1
+        self._recording_time = -1
+        self._stop_time = -1
+        # stream offsets the current video starts at and has been written up to
+        self._recording_offset = -1
+        self._written = -1
 
-        self._prematch_buffer = collections.deque(maxlen=PREMATCH_BUFFER_CHUNKS)
+        self._prematch_buffer = ringbuffer.RingBuffer(self._prematch_buffer_size)
+        self._pts_scanner = mpegts.PtsScanner()
+        # (pts, stream offset) of every video frame still in the buffer
+        self._frame_offsets = collections.deque()
 
-        for recording_filename in os.listdir(RECORDING_DIR):
+        for recording_filename in os.listdir(self._recording_dir):
             try:
-                os.unlink(os.path.join(RECORDING_DIR, recording_filename))
+                os.unlink(os.path.join(self._recording_dir, recording_filename))
             except:
                 traceback.print_exc()
 
-        for ready_filename in sorted(os.listdir(READY_DIR)):
-            self._upload_in_background(os.path.join(READY_DIR, ready_filename))
-
     def on_connected(self):
         self._match_observer.start()
 
     def on_disconnected(self):
         self._match_observer.stop()
-        self._handle_match_video()
-
-        self._match_id = None
-        self._match_video = None
-        self._recording_timestamp = -1
+        self._stop_recording()
 
     def on_data(self, data):
         self._match_observer.feed(data)
+        self._record(data)
+
+    # How far behind the stream the match observer is (see matchobserver/lagmonitor.py)
+    def metrics(self):
+        return self._match_observer.metrics()
+
+    # Times are stream PTS once the stream has shown us one, so that a match is
+    # cut where its events happened in the video however far behind the observer
+    # is. Until then (or for streams that aren't MPEG-TS) they're time.time().
+    def _uses_pts(self):
+        return len(self._frame_offsets) > 0
+
+    def _now(self):
+        if self._uses_pts():
+            return self._frame_offsets[-1][0]
+        return time.time()
+
+    # Stream offset of the first frame at or after TIME, or None if the stream
+    # hasn't got there yet
+    def _offset_after(self, time_):
+        if not self._uses_pts():
+            return self._prematch_buffer.end if time.time() >= time_ else None
+        if self._frame_offsets[-1][0] < time_:
+            return None
+        for pts, offset in self._frame_offsets:
+            if pts >= time_:
+                return offset
+
+    def _record(self, data):
+        frames = self._pts_scanner.feed(data)
+        if len(frames) > 0 or self._uses_pts():
+            self._prematch_buffer.append(data)
+            for offset, pts, random_access in frames:
+                # clips have to start on a keyframe if the stream flags them
+                if random_access or not self._pts_scanner.random_access_seen:
+                    self._prematch_buffer.mark(pts, offset)
+                self._frame_offsets.append((pts, offset))
+            # frames can stop turning up (eg. during an ad) until every one
+            # we had has left the buffer
+            start = self._prematch_buffer.start
+            while self._frame_offsets and self._frame_offsets[0][1] < start:
+                self._frame_offsets.popleft()
+        else:
+            self._prematch_buffer.append(data, time.time())
+
+        for event in self._match_observer.get_events():
+            self._on_match_event(event)
+
+        if self._match_id is None:
+            return
 
-        update_recording_state = False
-
-        new_match_id = None
-        if self._match_observer.has_update():
-            new_match_id = self._match_observer.get_latest()
-            update_recording_state = new_match_id != self._match_id
-
-        needs_split = self._match_id and \
-                      (not update_recording_state or self._match_id == new_match_id) and \
-                      self._recording_timestamp != -1 and \
-                      time.time() - self._recording_timestamp >= SPLIT_AT_TIME
-        if needs_split:
-            update_recording_state = True
-            new_match_id = self._match_id
-
-        if update_recording_state:
+        stop_offset = None
+        if self._stop_time != -1:
+            stop_offset = self._offset_after(self._stop_time)
+
+        if stop_offset is not None:
+            self._write_recording(stop_offset)
+            print('******** stopped recording video for match {}'.format(self._match_id))
+            self._stop_recording()
+        elif self._now() - self._recording_time >= SPLIT_AT_TIME:
+            print('******** splitting video for match {}'.format(self._match_id))
+            match_id = self._match_id
+            stop_time = self._stop_time
+            self._write_recording(self._prematch_buffer.end)
+            self._stop_recording()
+            self._start_recording(match_id, self._prematch_buffer.end)
+            self._stop_time = stop_time
+        else:
+            self._write_recording(self._prematch_buffer.end)
+
+    # Bring the video up to the stream offset END. Events can arrive after the
+    # bytes they refer to have been written, so this cuts what's already there
+    # back if it has to.
+    def _write_recording(self, end):
+        if end < self._written:
+            os.ftruncate(self._match_video.fileno(), end - self._recording_offset)
+        else:
+            self._prematch_buffer.write_to(self._match_video.fileno(), self._written, end)
+        self._written = end
+
+    # Start recording when a match starts and stop a little after its results
+    # come up, or MATCH_END_TIMEOUT after it ends if they never do
+    def _on_match_event(self, event):
+        # Times must stay on the recorder's clock. An event without a PTS (the
+        # observer never got one) is placed relative to now, less the time it
+        # took to confirm, which is on whichever clock _now is.
+        if self._uses_pts() and 'pts' in event:
+            event_time = event['pts']
+        else:
+            event_time = self._now() - (event['confirmed_seconds'] - event['seconds'])
+
+        if event['event'] == 'start':
             if self._match_id is not None:
-                if needs_split:
-                    print('******** splitting video for match {}'.format(self._match_id))
-                else:
-                    print('******** stopped recording video for match {}'.format(self._match_id))
-
-                self._handle_match_video()
-
-                self._match_id = None
-                self._match_video = None
-                self._recording_timestamp = -1
-
-            if new_match_id is not None:
-                self._match_id = new_match_id
-                self._match_video = tempfile.NamedTemporaryFile(suffix='.mp4', dir=RECORDING_DIR,
-                                                                delete=False)
-                self._recording_timestamp = time.time()
-
-                for chunk in self._prematch_buffer:
-                    self._match_video.write(chunk)
-                self._prematch_buffer.clear()
-
-                print('******** started recording video for match {}'.format(self._match_id))
+                self._write_recording(max(self._prematch_buffer.offset_at(event_time),
+                                          self._recording_offset))
+                print('******** stopped recording video for match {}'.format(self._match_id))
+                self._stop_recording()
+            self._start_recording(event['match_id'],
+                                  self._prematch_buffer.offset_at(event_time - PREROLL_TIME))
+        elif event['match_id'] != self._match_id:
+            return
+        elif event['event'] == 'end':
+            self._stop_time = event_time + matchobserver.MATCH_END_TIMEOUT
+        elif event['event'] == 'results':
+            self._stop_time = event_time + RESULTS_TAIL_TIME
+
+    # Start a new video for MATCH_ID from the stream offset OFFSET, which must
+    # still be in the buffer
+    def _start_recording(self, match_id, offset):
+        self._match_id = match_id
+        self._match_video = tempfile.NamedTemporaryFile(suffix='.mp4', dir=self._recording_dir,
+                                                        delete=False)
+        self._recording_time = self._now()
+        self._recording_offset = offset
+        self._written = offset
+
+        print('******** started recording video for match {}'.format(self._match_id))
+
+    def _stop_recording(self):
+        self._handle_match_video()
 
-        if self._match_video:
-            self._match_video.write(data)
-        self._prematch_buffer.append(data)
+        self._match_id = None
+        self._match_video = None
+        self._recording_time = -1
+        self._stop_time = -1
+        self._recording_offset = -1
+        self._written = -1
 
     def _handle_match_video(self):
         if self._match_id is None or self._match_video is None:
@@ -135,17 +267,34 @@ class MatchRecorderStreamConnector(streamconnector.StreamConnector):
         self._match_video.close()
 
         title = TITLE_FORMAT.format(datetime.date.today().isoformat(), self._match_id)
-        ready_path = READY_FORMAT.format(int(time.time()), title)
+        ready_path = os.path.join(self._ready_dir, READY_FORMAT.format(int(time.time()), title))
         os.rename(self._match_video.name, ready_path)
 
         self._upload_in_background(ready_path)
 
+    # Videos already queued (eg. ready ones found again after a restart) are ignored
     def _upload_in_background(self, ready_path):
-        print('upload in bg {}'.format(ready_path));
-        # multiprocessing.Process(
-        #         target=videohandler.upload_to_streamable_and_post_to_twitter,
-        #         args=(ready_path.split('---')[1], ready_path, self._twitter_user)
-        # ).start()
+        self._upload_queue.submit(ready_path, os.path.basename(ready_path).split('---', 1)[1],
+                                  self._twitter_user)
+
+# The same recorder on an asyncio event loop. The observer's ffmpeg may fall
+# behind and lose chunks, the recording may not.
+class AsyncMatchRecorderStreamConnector(asyncconnector.AsyncStreamConnector,
+                                        MatchRecorderStreamConnector):
+    def sinks(self):
+        return [
+            asyncconnector.BoundedSink('observer', self._match_observer.feed_async,
+                                       asyncconnector.DROP_OLDEST),
+            asyncconnector.BoundedSink('recorder', self._record_async, asyncconnector.BLOCK),
+        ]
+
+    async def on_connected_async(self):
+        await self._match_observer.start_async()
+
+    # The recorder sink awaits each chunk before taking the next, so a
+    # recorder's chunks are still recorded one at a time and in order
+    async def _record_async(self, data):
+        await asyncio.get_running_loop().run_in_executor(_recorder_executor, self._record, data)
 
 if __name__ == '__main__':
     EVENT_ID        = '2019nhsnh'
@@ -0,0 +1,250 @@
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# A local stand-in for the services match videos are uploaded and posted to,
+# to run uploadqueue.py and videohandler.py against without touching the real
+# ones. It answers Streamable style uploads, YouTube style resumable uploads
+# (with the OAuth token endpoint) and Twitter status updates, keeps what it was
+# sent, and can be told to fail requests, either with a 503 or by dropping the
+# connection halfway through reading the body the way a flaky venue network
+# would.
+#
+#   server = mockserver.MockServer()
+#   server.start()
+#   server.configure(videohandler)    # point videohandler's endpoints at it
+#   server.fail_next(3)               # the next three requests get a 503
+#   server.fail_next(1, mockserver.DROP)
+#   server.fail_randomly(0.2, mockserver.DROP)
+#   ...
+#   server.stop()
+#
+# or run it on its own with
+#
+#   python mockserver.py [port]
+
+import hashlib
+import http.server
+import itertools
+import json
+import random
+import re
+import sys
+import threading
+import urllib.parse
+
+ERROR = 'error'
+DROP = 'drop'
+
+READ_SIZE = 64 * 1024
+
+TITLE_FIELD_RE = re.compile(rb'name="title"\r\n\r\n(.*?)\r\n', re.S)
+CONTENT_RANGE_RE = re.compile(r'bytes (?:(\d+)-(\d+)|\*)/(\d+)')
+
+class _Session:
+    def __init__(self, title, total):
+        self.title = title
+        self.total = total
+        self.received = 0
+        self.sha256 = hashlib.sha256()
+        self.video_id = None # once complete
+
+class MockServer:
+    def __init__(self, port=0, seed=None):
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+        self._server.mock = self
+        self.url = 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+        self._lock = threading.Lock()
+        self._failures = []
+        self._failure_rate = 0
+        self._failure_mode = ERROR
+        self._random = random.Random(seed)
+        self._ids = itertools.count(1)
+        self._sessions = {}
+        self.requests = 0
+        self.failed = 0
+        self.uploads = []
+        self.tweets = []
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    # Point videohandler's endpoints at the server
+    def configure(self, videohandler):
+        videohandler.STREAMABLE_UPLOAD_ENDPOINT = self.url + '/upload'
+        videohandler.TWITTER_BASE_URL = self.url
+        videohandler.YOUTUBE_TOKEN_ENDPOINT = self.url + '/token'
+        videohandler.YOUTUBE_UPLOAD_ENDPOINT = self.url + '/youtube/upload?uploadType=resumable'
+
+    # Fail the next COUNT requests as MODE
+    def fail_next(self, count, mode=ERROR):
+        with self._lock:
+            self._failures += [mode] * count
+
+    # Fail each request with probability RATE as MODE
+    def fail_randomly(self, rate, mode=ERROR):
+        with self._lock:
+            self._failure_rate = rate
+            self._failure_mode = mode
+
+    # Forget every resumable session, as if they'd timed out
+    def expire_sessions(self):
+        with self._lock:
+            self._sessions = {}
+
+    # How this request should fail, or None
+    def _failure(self):
+        with self._lock:
+            self.requests += 1
+            mode = None
+            if len(self._failures) > 0:
+                mode = self._failures.pop(0)
+            elif self._random.random() < self._failure_rate:
+                mode = self._failure_mode
+            if mode is not None:
+                self.failed += 1
+            return mode
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        mock = self.server.mock
+        failure = mock._failure()
+        if failure == DROP:
+            self._drop()
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if failure == ERROR:
+            self._reply(503, {'error': 'injected failure'})
+            return
+
+        path = urllib.parse.urlsplit(self.path).path
+        if path == '/upload':
+            match = TITLE_FIELD_RE.search(body)
+            with mock._lock:
+                shortcode = 'mock{}'.format(next(mock._ids))
+                mock.uploads.append({
+                    'title': match.group(1).decode('utf-8') if match else None,
+                    'size': len(body),
+                    'link': shortcode,
+                })
+            self._reply(200, {'shortcode': shortcode, 'status': 1})
+        elif path == '/token':
+            self._reply(200, {'access_token': 'mock', 'expires_in': 3600})
+        elif path == '/youtube/upload':
+            metadata = json.loads(body.decode('utf-8'))
+            session = _Session(metadata['snippet']['title'],
+                               int(self.headers['X-Upload-Content-Length']))
+            with mock._lock:
+                session_id = str(next(mock._ids))
+                mock._sessions[session_id] = session
+            self._reply(200, {}, {'Location': '{}/youtube/session/{}'.format(mock.url,
+                                                                             session_id)})
+        elif path == '/statuses/update.json':
+            form = urllib.parse.parse_qs(body.decode('utf-8'))
+            text = form.get('status', [''])[0]
+            with mock._lock:
+                mock.tweets.append(text)
+                status_id = len(mock.tweets)
+            self._reply(200, {'id': status_id, 'text': text})
+        else:
+            self._reply(404, {'error': 'no such endpoint'})
+
+    def do_PUT(self):
+        mock = self.server.mock
+        failure = mock._failure()
+        length = int(self.headers.get('Content-Length', 0))
+        session_id = urllib.parse.urlsplit(self.path).path.rsplit('/', 1)[-1]
+        with mock._lock:
+            session = mock._sessions.get(session_id)
+        if session is None:
+            self.rfile.read(length)
+            self._reply(404, {'error': 'no such session'})
+            return
+        # like YouTube, a finished session answers with the video it made
+        if session.video_id is not None:
+            self.rfile.read(length)
+            self._reply(200, {'id': session.video_id})
+            return
+
+        # a dropped connection still leaves the server with what it got
+        if failure == DROP:
+            length //= 2
+        start = int(CONTENT_RANGE_RE.match(self.headers['Content-Range']).group(1) or 0)
+        remaining = length
+        while remaining > 0:
+            data = self.rfile.read(min(READ_SIZE, remaining))
+            if len(data) == 0:
+                break
+            remaining -= len(data)
+            if start == session.received:
+                session.sha256.update(data)
+                session.received += len(data)
+            start += len(data)
+        if failure == DROP:
+            self._drop()
+            return
+        if failure == ERROR:
+            self._reply(503, {'error': 'injected failure'})
+            return
+
+        if session.received < session.total:
+            headers = {}
+            if session.received > 0:
+                headers['Range'] = 'bytes=0-{}'.format(session.received - 1)
+            self._reply(308, None, headers)
+            return
+
+        with mock._lock:
+            video_id = 'mockvideo{}'.format(next(mock._ids))
+            session.video_id = video_id
+            mock.uploads.append({
+                'title': session.title,
+                'size': session.total,
+                'sha256': session.sha256.hexdigest(),
+                'link': video_id,
+            })
+        self._reply(201, {'id': video_id})
+
+    def _drop(self):
+        self.close_connection = True
+        self.connection.shutdown(2)
+
+    def _reply(self, code, data, headers={}):
+        body = b'' if data is None else json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+if __name__ == '__main__':
+    server = MockServer(int(sys.argv[1]) if len(sys.argv) > 1 else 0)
+    print('******** mock server listening on {}'.format(server.url))
+    server._server.serve_forever()
@@ -0,0 +1,117 @@
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Just enough MPEG-TS parsing to find where each video frame starts in a live
+# stream and what its presentation timestamp is, so the recorder can line the
+# bytes it buffers up with the timestamps ffmpeg reports for match events.
+# Only packets starting a PES packet are looked at in Python; picking them out
+# of a chunk is done on the whole chunk at once with numpy.
+
+import numpy
+
+TS_PACKET_SIZE = 188
+SYNC_BYTE = 0x47
+PTS_CLOCK = 90000
+PTS_WRAP = 1 << 33
+
+def parse_pts(data):
+    return ((data[0] >> 1) & 0x07) << 30 | data[1] << 22 | (data[2] >> 1) << 15 | \
+        data[3] << 7 | data[4] >> 1
+
+# Feed it the stream chunk by chunk. Returns, for every video PES packet that
+# starts in the chunk, (stream offset of its TS packet, PTS in seconds, whether
+# the packet is flagged as a random access point).
+class PtsScanner:
+    def __init__(self):
+        self._carry = b''
+        self._offset = 0 # stream offset of the start of _carry
+        self.video_pid = None
+        self.random_access_seen = False
+        self._last_pts = None
+        self._wrap_offset = 0
+
+    def feed(self, data):
+        buf = self._carry + bytes(data)
+        base = self._offset
+        found = []
+
+        position = 0
+        while len(buf) - position >= TS_PACKET_SIZE:
+            if buf[position] != SYNC_BYTE or \
+                    (len(buf) - position >= 2 * TS_PACKET_SIZE and
+                     buf[position + TS_PACKET_SIZE] != SYNC_BYTE):
+                position = self._resync(buf, position + 1)
+                continue
+
+            count = (len(buf) - position) // TS_PACKET_SIZE
+            packets = numpy.frombuffer(buf, numpy.uint8, count * TS_PACKET_SIZE,
+                                       position).reshape(count, TS_PACKET_SIZE)
+            in_sync = packets[:, 0] == SYNC_BYTE
+            if not in_sync.all():
+                count = int(numpy.argmin(in_sync))
+                packets = packets[:count]
+
+            for i in numpy.flatnonzero(packets[:, 1] & 0x40):
+                packet_offset = position + int(i) * TS_PACKET_SIZE
+                pes = self._parse_packet(buf, packet_offset)
+                if pes is not None:
+                    found.append((base + packet_offset,) + pes)
+            position += count * TS_PACKET_SIZE
+
+        self._carry = buf[position:]
+        self._offset = base + position
+        return found
+
+    def _resync(self, buf, position):
+        while position < len(buf) and buf[position] != SYNC_BYTE:
+            position += 1
+        return position
+
+    def _parse_packet(self, buf, offset):
+        pid = (buf[offset + 1] & 0x1f) << 8 | buf[offset + 2]
+        if self.video_pid is not None and pid != self.video_pid:
+            return None
+
+        adaptation_field_control = (buf[offset + 3] >> 4) & 0x03
+        payload = offset + 4
+        random_access = False
+        if adaptation_field_control & 0x02:
+            adaptation_length = buf[offset + 4]
+            random_access = adaptation_length > 0 and bool(buf[offset + 5] & 0x40)
+            payload += 1 + adaptation_length
+        if not adaptation_field_control & 0x01 or payload + 14 > offset + TS_PACKET_SIZE:
+            return None
+
+        # PES start code, then a video stream id
+        if buf[payload:payload + 3] != b'\x00\x00\x01' or buf[payload + 3] & 0xf0 != 0xe0:
+            return None
+        if not buf[payload + 7] & 0x80:
+            return None
+        self.video_pid = pid
+
+        pts = parse_pts(buf[payload + 9:payload + 14])
+        if self._last_pts is not None and pts + self._wrap_offset < self._last_pts - PTS_WRAP // 2:
+            self._wrap_offset += PTS_WRAP
+        pts += self._wrap_offset
+        self._last_pts = pts
+
+        if random_access:
+            self.random_access_seen = True
+        return (pts / PTS_CLOCK, random_access)
@@ -0,0 +1,127 @@
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Upload renditions of cut clips. Recorded clips are the stream's bytes copied
+# straight out (MPEG-TS in a file called .mp4), which the upload services then
+# have to transcode themselves before anyone can watch. A rendition is an H.264
+# MP4 with a capped bitrate and the moov atom at the front (faststart), made by
+# one ffmpeg per clip, so it plays as soon as it's up.
+#
+# Transcoding takes whole cores, so renditions run in a small pool of their own
+# and every ffmpeg is started at the lowest CPU priority (SCHED_IDLE through
+# chrt where it's available, nice 19 otherwise): they only ever get the CPU the
+# live vision workers leave over. The priority is set by a wrapper command
+# rather than in the forked child, which isn't safe with other threads running.
+
+import concurrent.futures
+import multiprocessing
+import os
+import shutil
+import subprocess
+import threading
+
+FFMPEG_BINARY = '/usr/bin/ffmpeg'
+WORKERS = max(1, multiprocessing.cpu_count() // 4)
+THREADS = 2 # encoder threads per ffmpeg
+NICENESS = 19
+PRESET = 'veryfast'
+CRF = 23
+MAX_BITRATE = 4500 # kbit/s
+AUDIO_BITRATE = '128k'
+SUFFIX = '.upload.mp4'
+
+def rendition_path(path):
+    return os.path.splitext(path)[0] + SUFFIX
+
+def ffmpeg_command(infile, outfile, ffmpeg_bin=FFMPEG_BINARY, max_bitrate=MAX_BITRATE,
+                   threads=THREADS):
+    return [
+        ffmpeg_bin,
+        '-hide_banner',
+        '-nostats',
+        '-v', 'error',
+        '-i', infile,
+        '-map', '0:v:0',
+        '-map', '0:a:0?',
+        '-c:v', 'libx264',
+        '-preset', PRESET,
+        '-crf', str(CRF),
+        '-maxrate', '{}k'.format(max_bitrate),
+        '-bufsize', '{}k'.format(2 * max_bitrate),
+        '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac',
+        '-b:a', AUDIO_BITRATE,
+        '-movflags', '+faststart',
+        '-threads', str(threads),
+        '-f', 'mp4',
+        '-y', outfile,
+    ]
+
+# Command to prefix COMMAND with so it runs at the lowest CPU priority
+def lower_priority(command):
+    if shutil.which('chrt') is not None:
+        return ['chrt', '--idle', '0'] + command
+    if shutil.which('nice') is not None:
+        return ['nice', '-n', str(NICENESS)] + command
+    return command
+
+# Make the rendition of INFILE at OUTFILE, which only appears once it's complete
+def transcode(infile, outfile, ffmpeg_bin=FFMPEG_BINARY, max_bitrate=MAX_BITRATE):
+    partial = outfile + '.part'
+    try:
+        subprocess.run(lower_priority(ffmpeg_command(infile, partial, ffmpeg_bin, max_bitrate)),
+                       check=True)
+        os.replace(partial, outfile)
+    finally:
+        if os.path.exists(partial):
+            os.unlink(partial)
+    return outfile
+
+class RenditionPool:
+    def __init__(self, workers=None, ffmpeg_bin=FFMPEG_BINARY, max_bitrate=MAX_BITRATE):
+        workers = workers or WORKERS
+        self.workers = workers
+        self._ffmpeg_bin = ffmpeg_bin
+        self._max_bitrate = max_bitrate
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers)
+
+    # Start on the rendition of INFILE. Returns a future of its path.
+    def submit(self, infile, outfile=None):
+        return self._executor.submit(transcode, infile, outfile or rendition_path(infile),
+                                     self._ffmpeg_bin, self._max_bitrate)
+
+    # Make the rendition of INFILE, waiting for a free worker first
+    def transcode(self, infile, outfile=None):
+        return self.submit(infile, outfile).result()
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# The rendition pool shared by everything in the process. Whichever call makes
+# it picks how many ffmpegs run at once, WORKERS if it doesn't say.
+def pool(workers=None):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = RenditionPool(workers)
+        return _pool
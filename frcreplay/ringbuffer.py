@@ -0,0 +1,118 @@
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Fixed-size ring buffer over one preallocated bytearray, for keeping the last
+# few minutes of a stream around. Appends can be tagged with a timestamp, or
+# timestamps marked at positions inside what was appended (eg. where each
+# keyframe starts), so the buffer can be read back from a point in time (eg. 5 s
+# before a match started) straight into a file with a single os.writev of at
+# most two memoryviews. Appending copies the chunk in with slice assignment and
+# allocates nothing per chunk apart from its timestamp mark.
+#
+# Positions are absolute byte offsets into the stream, so they stay valid
+# while the buffer wraps around until the data they point at is overwritten.
+
+import bisect
+import os
+
+class RingBuffer:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._buffer = bytearray(capacity)
+        self._view = memoryview(self._buffer)
+        self.end = 0
+        # timestamps and offsets of the marks, the ones from _first on still
+        # being in the buffer. Dropped marks are only trimmed off now and then,
+        # so marking stays constant time and offset_at can bisect.
+        self._mark_times = []
+        self._mark_offsets = []
+        self._first = 0
+
+    # Offset of the oldest byte still in the buffer
+    @property
+    def start(self):
+        return max(0, self.end - self.capacity)
+
+    def append(self, data, timestamp=None):
+        data = memoryview(data)
+        if len(data) > self.capacity:
+            self.end += len(data) - self.capacity
+            data = data[-self.capacity:]
+
+        position = self.end % self.capacity
+        first = min(len(data), self.capacity - position)
+        self._view[position:position + first] = data[:first]
+        self._view[:len(data) - first] = data[first:]
+
+        if timestamp is not None:
+            self._add_mark(timestamp, self.end)
+        self.end += len(data)
+
+        start = self.start
+        while self._first < len(self._mark_offsets) and self._mark_offsets[self._first] < start:
+            self._first += 1
+        if self._first > len(self._mark_offsets) // 2:
+            del self._mark_times[:self._first]
+            del self._mark_offsets[:self._first]
+            self._first = 0
+
+    def _add_mark(self, timestamp, offset):
+        self._mark_times.append(timestamp)
+        self._mark_offsets.append(offset)
+
+    # Mark OFFSET, which must be past every earlier mark, as being at TIMESTAMP
+    def mark(self, timestamp, offset):
+        if offset >= self.start:
+            self._add_mark(timestamp, offset)
+
+    # Offset of the mark at or just before TIMESTAMP, or of the oldest mark in
+    # the buffer if TIMESTAMP is older than that
+    def offset_at(self, timestamp):
+        if self._first == len(self._mark_offsets):
+            return self.end
+        i = bisect.bisect_right(self._mark_times, timestamp, self._first)
+        return self._mark_offsets[max(i - 1, self._first)]
+
+    # Memoryviews over the bytes from OFFSET up to END (the end of the buffer
+    # by default). There are two when the range wraps around.
+    def views(self, offset, end=None):
+        if end is None:
+            end = self.end
+        offset = max(offset, self.start)
+        end = min(end, self.end)
+        if end <= offset:
+            return []
+
+        position = offset % self.capacity
+        length = end - offset
+        if position + length <= self.capacity:
+            return [self._view[position:position + length]]
+        return [self._view[position:], self._view[:length - (self.capacity - position)]]
+
+    # Write the bytes from OFFSET to END to the file descriptor FD
+    def write_to(self, fd, offset, end=None):
+        views = self.views(offset, end)
+        while len(views) > 0:
+            written = os.writev(fd, views)
+            while len(views) > 0 and written >= len(views[0]):
+                written -= len(views[0])
+                views.pop(0)
+            if written > 0:
+                views[0] = views[0][written:]
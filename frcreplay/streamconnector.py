@@ -22,14 +22,14 @@ import io
 import time
 import traceback
 
-import requests
 import streamlink
 
+import httpclient
+
 RECONNECT_OFFLINE_DELAY = 5
 RECONNECT_DC_DELAY = 1
 
 TWITCH_URL_TEMPLATE = 'https://www.twitch.tv/{}'
-TWITCH_ONLINE_ENDPOINT = 'https://api.twitch.tv/kraken/streams/{}?client_id=5j0r5b7qb7kro03fvka3o8kbq262wwm&callback=badge.drawStream'
 
 STREAM_QUALITY = 'best'
 
@@ -58,12 +58,11 @@ class StreamConnector:
             try:
                 self.on_connecting()
 
-                if not self.twitch_id.startswith('videos/'):
-                    r = requests.get(TWITCH_ONLINE_ENDPOINT.format(self.twitch_id))
-                    r.raise_for_status()
-                    if '"stream":null,' in r.text:
-                        time.sleep(RECONNECT_OFFLINE_DELAY)
-                        continue
+                # if Twitch can't say whether the channel is live, streamlink will
+                if not self.twitch_id.startswith('videos/') and \
+                        httpclient.liveness_poller().is_live(self.twitch_id) is False:
+                    time.sleep(RECONNECT_OFFLINE_DELAY)
+                    continue
 
                 streams = streamlink.streams(twitch_url)
                 if STREAM_QUALITY not in streams:
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Follows many event streams from one host. Each stream gets a
+# MatchRecorderStreamConnector running in its own thread (they spend their
+# time waiting on the network), and all of them share one VisionPool, so the
+# number of vision workers is fixed however many streams there are and streams
+# in the middle of a match are looked at first.
+#
+#   python supervisor.py streams.json
+#
+# where streams.json looks like
+#
+#   {
+#       "workers": 8,
+#       "streams": [
+#           {"event_id": "2019nhsnh", "twitch_id": "firstinspires_nh",
+#            "twitter_user": null, "game_id": "FRC-2017"},
+#           ...
+#       ]
+#   }
+#
+# "workers" is optional and defaults to one per CPU. A stream can give its
+# highest "bitrate" in kbit/s, which sizes its pre-roll buffer (6000 by
+# default, see matchrecorder.py). Every stream's videos go
+# through one upload queue, journaled to "upload_journal" (videos/uploads.journal
+# by default) by "upload_workers" threads and sent to "uploader" (one of
+# videohandler.UPLOADERS, Streamable by default). With "rendition": true an
+# upload rendition of each video (see rendition.py) is made and uploaded
+# instead, by at most "rendition_workers" ffmpegs at a time. With "async": true
+# every stream is driven by one asyncio event loop (see asyncconnector.py)
+# instead of a thread each.
+
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+
+from matchobserver.visionpool import VisionPool
+import httpclient
+import matchrecorder
+import rendition
+import uploadqueue
+
+STREAM_KEYS = ['event_id', 'twitch_id', 'twitter_user', 'game_id']
+
+STATUS_INTERVAL = 60
+
+# One line per stream on how far behind its observer is and how much vision
+# time it takes per second of stream, to size hosts by
+def print_metrics(connectors):
+    for connector in connectors:
+        metrics = connector.metrics()
+        if metrics.get('load') is None:
+            continue
+        print('******** {}: {:.0f} s behind, {:.2f} s latency, load {:.2f}, '
+              '{} full, {} cheap, {} skipped, {} dropped'.format(
+                  connector.event_id, metrics['lag'], metrics['latency'] or 0, metrics['load'],
+                  metrics['full'], metrics['cheap'], metrics['skipped'], metrics['dropped']))
+
+def load_config(path):
+    with open(path, 'r') as config_file:
+        config = json.load(config_file)
+
+    event_ids = set()
+    for stream in config.get('streams', []):
+        for key in STREAM_KEYS:
+            if key not in stream:
+                raise Exception('Stream {} in {} has no {}'.format(stream, path, key))
+        if stream['event_id'] in event_ids:
+            raise Exception('Event {} is listed twice in {}'.format(stream['event_id'], path))
+        event_ids.add(stream['event_id'])
+    return config
+
+def run(config):
+    vision_pool = VisionPool(config.get('workers'))
+    # the workers have to be forked before any connector threads exist
+    vision_pool.start()
+    print('******** started {} vision workers'.format(vision_pool.workers))
+
+    upload_queue = uploadqueue.UploadQueue(
+        config.get('upload_journal',
+                   os.path.join(matchrecorder.VIDEOS_DIR, uploadqueue.JOURNAL_NAME)),
+        config.get('upload_workers', uploadqueue.WORKERS),
+        uploader=config.get('uploader', uploadqueue.UPLOADER),
+        transcode=config.get('rendition', False))
+    rendition.pool(config.get('rendition_workers'))
+    upload_queue.start()
+
+    if config.get('async'):
+        try:
+            asyncio.run(run_async(config, vision_pool, upload_queue))
+        finally:
+            vision_pool.stop()
+            upload_queue.stop()
+        return
+
+    threads = []
+    connectors = []
+    for stream in config['streams']:
+        connector = matchrecorder.MatchRecorderStreamConnector(
+            stream['event_id'],
+            stream['twitch_id'],
+            stream['twitter_user'],
+            stream['game_id'],
+            vision_pool=vision_pool,
+            upload_queue=upload_queue,
+            bitrate=stream.get('bitrate', matchrecorder.STREAM_BITRATE))
+        thread = threading.Thread(target=connector.run, name=stream['event_id'], daemon=True)
+        thread.start()
+        threads.append(thread)
+        connectors.append(connector)
+
+    try:
+        while True:
+            time.sleep(STATUS_INTERVAL)
+            print('******** {} of {} streams running, {} frames dropped, '
+                  '{} uploads pending, {} abandoned'.format(
+                sum(thread.is_alive() for thread in threads), len(threads),
+                vision_pool.dropped, upload_queue.pending(), upload_queue.abandoned()))
+            print_metrics(connectors)
+            httpclient.print_stats()
+    finally:
+        vision_pool.stop()
+        upload_queue.stop()
+
+async def run_async(config, vision_pool, upload_queue):
+    connectors = [matchrecorder.AsyncMatchRecorderStreamConnector(
+        stream['event_id'],
+        stream['twitch_id'],
+        stream['twitter_user'],
+        stream['game_id'],
+        vision_pool=vision_pool,
+        upload_queue=upload_queue,
+        bitrate=stream.get('bitrate', matchrecorder.STREAM_BITRATE))
+        for stream in config['streams']]
+
+    async def report():
+        while True:
+            await asyncio.sleep(STATUS_INTERVAL)
+            print_metrics(connectors)
+            httpclient.print_stats()
+
+    await asyncio.gather(report(), *[connector.run_async() for connector in connectors])
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print('usage: {} streams.json'.format(sys.argv[0]))
+        sys.exit(1)
+    run(load_config(sys.argv[1]))
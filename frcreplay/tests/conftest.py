@@ -0,0 +1,55 @@
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Run with `python -m pytest tests` from the frcreplay directory. The modules
+# under test import each other from there, the way the recorder runs.
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+CREDENTIALS = {
+    'youtube': {'client_id': 'mock', 'client_secret': 'mock', 'refresh_token': 'mock'},
+    'twitter': {'mock': {'consumer_key': 'mock', 'consumer_secret': 'mock',
+                         'access_token_key': 'mock', 'access_token_secret': 'mock'}},
+}
+
+# A mockserver.MockServer with videohandler pointed at it, and put back after.
+# Skips the test without python-twitter, which videohandler imports.
+@pytest.fixture
+def server(monkeypatch):
+    pytest.importorskip('twitter')
+    import mockserver
+    import videohandler
+
+    for name in ('STREAMABLE_UPLOAD_ENDPOINT', 'TWITTER_BASE_URL', 'YOUTUBE_TOKEN_ENDPOINT',
+                 'YOUTUBE_UPLOAD_ENDPOINT'):
+        monkeypatch.setattr(videohandler, name, getattr(videohandler, name))
+    monkeypatch.setattr(videohandler, '_credentials', CREDENTIALS)
+    monkeypatch.setattr(videohandler, '_twitter_apis', {})
+
+    server = mockserver.MockServer(seed=1)
+    server.start()
+    server.configure(videohandler)
+    yield server
+    server.stop()
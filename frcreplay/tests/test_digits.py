@@ -0,0 +1,69 @@
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import numpy
+import PIL.Image
+
+from matchobserver import digits
+
+# 5 x 9 glyphs, drawn as ink (#) on a dark box. The 1 is a solid bar.
+GLYPHS = {
+    '1': ['#'] * 9,
+    '7': ['#####'] + ['    #'] * 8,
+    '0': ['#####'] + ['#   #'] * 7 + ['#####'],
+}
+
+def number(text):
+    rows = [' '.join(GLYPHS[digit][row].ljust(len(GLYPHS[digit][0])) for digit in text)
+            for row in range(9)]
+    pixels = numpy.zeros((13, len(rows[0]) + 4), dtype=numpy.uint8)
+    for y, row in enumerate(rows):
+        for x, cell in enumerate(row):
+            if cell == '#':
+                pixels[y + 2, x + 2] = 255
+    return PIL.Image.fromarray(pixels).resize((pixels.shape[1] * 3, pixels.shape[0] * 3),
+                                              PIL.Image.NEAREST)
+
+def test_solid_glyphs_are_read():
+    reader = digits.DigitReader()
+    assert reader.learn(number('107'), 107)
+    assert reader.learn(number('70'), 70)
+    assert reader.read(number('17')) == 17
+    assert reader.read(number('11')) == 11
+    assert reader.read(number('710')) == 710
+
+def test_solid_glyphs_survive_saving(tmp_path):
+    reader = digits.DigitReader()
+    reader.learn(number('107'), 107)
+    reader.save(str(tmp_path / 'digits.npz'))
+    assert digits.DigitReader(str(tmp_path / 'digits.npz')).read(number('101')) == 101
+
+# as 3processframes.py gathers what its workers learned
+def test_learned_digits_merge():
+    parent = digits.DigitReader()
+    parent.learn(number('107'), 107)
+    worker = digits.DigitReader()
+    worker.learn(number('17'), 17)
+    parent.merge_learned(worker.take_learned())
+    worker.learn(number('70'), 70)
+    parent.merge_learned(worker.take_learned())
+    assert parent.take_learned()[1].tolist() == [2, 2, 0, 0, 0, 0, 0, 3, 0, 0]
+    assert worker.take_learned()[1].sum() == 0
+    assert parent.read(number('1071')) == 1071
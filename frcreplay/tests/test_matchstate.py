@@ -0,0 +1,62 @@
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import queue
+
+import matchobserver
+from matchobserver import matchstate
+
+MATCH_INFO = {'type': 'game', 'match_type': 'Qualification', 'match_number': '12'}
+
+# A match starting at PTS 1000 in a stream sampled every 3.5 s instead of the 3
+# s the observer asks for, with some frames missing their PTS
+def test_events_are_placed_by_pts():
+    state = matchstate.MatchState(matchobserver.MATCH_DETECTOR_FPS)
+    clock = matchobserver.StreamClock()
+    events = queue.Queue()
+    for frame_counter in range(1, 60):
+        pts = 990 + 3.5 * frame_counter
+        seconds = clock.seconds(frame_counter, None if frame_counter % 7 == 0 else pts)
+        assert abs(seconds - pts) <= 0.5
+        match_time = None
+        if pts >= 1000:
+            match_time = 1000 + matchstate.AUTON_TIME - pts
+            if match_time <= 0:
+                match_time += matchstate.TELEOP_TIME
+            match_time = round(match_time)
+        info = dict(MATCH_INFO, time=match_time)
+        matchobserver.queue_events('2017test', state.update(frame_counter, info, seconds),
+                                   events, clock.on_pts)
+
+    events = [events.get_nowait() for _ in range(events.qsize())]
+    assert [event['event'] for event in events] == ['start', 'teleop', 'end']
+    for event, pts in zip(events, (1000, 1000 + matchstate.AUTON_TIME,
+                                   1000 + matchstate.AUTON_TIME + matchstate.TELEOP_TIME)):
+        assert abs(event['pts'] - pts) <= 1
+        assert event['confirmed_seconds'] >= event['seconds']
+
+def test_seconds_count_frames_without_pts():
+    state = matchstate.MatchState(matchobserver.MATCH_DETECTOR_FPS)
+    clock = matchobserver.StreamClock()
+    for frame_counter in range(1, 5):
+        seconds = clock.seconds(frame_counter, None)
+        assert seconds == frame_counter / matchobserver.MATCH_DETECTOR_FPS
+        state.update(frame_counter, dict(MATCH_INFO, time=20 - 3 * frame_counter), seconds)
+    assert not clock.on_pts
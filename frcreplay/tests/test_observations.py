@@ -0,0 +1,36 @@
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from matchobserver import observations
+
+def test_out_of_range_numbers_are_missing():
+    infos = [
+        {'frame': 1, 'type': 'game', 'match_type': 'Qualification', 'match_number': '1351351',
+         'time': 1351351},
+        {'frame': 2, 'type': 'game', 'match_type': 'Qualification', 'match_number': '12',
+         'time': 135},
+    ]
+    records, match_types = observations.from_dicts(infos)
+    assert list(records['match_number']) == [observations.MISSING, 12]
+    assert list(records['time']) == [observations.MISSING, 135]
+
+    infos = observations.to_dicts(records, match_types)
+    assert 'match_number' not in infos[0] and 'time' not in infos[0]
+    assert infos[1]['match_number'] == '12' and infos[1]['time'] == 135
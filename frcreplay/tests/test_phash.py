@@ -0,0 +1,82 @@
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import io
+
+import numpy
+import PIL.Image
+import PIL.ImageDraw
+
+from matchobserver import phash
+
+def label(text):
+    img = PIL.Image.new('RGB', (465, 50), 'white')
+    PIL.ImageDraw.Draw(img).text((5, 5), text, fill='black')
+    return img
+
+# IMG as a broadcast might deliver it: recompressed, with a few stray pixels
+def noisy(img, quality=30, outliers=40, seed=0):
+    jpeg = io.BytesIO()
+    img.save(jpeg, 'JPEG', quality=quality)
+    pixels = numpy.array(PIL.Image.open(io.BytesIO(jpeg.getvalue())).convert('RGB'))
+    rng = numpy.random.default_rng(seed)
+    ys = rng.integers(pixels.shape[0], size=outliers)
+    xs = rng.integers(pixels.shape[1], size=outliers)
+    pixels[ys, xs] = 255 - pixels[ys, xs]
+    return PIL.Image.fromarray(pixels)
+
+def test_one_digit_change_is_read_again():
+    cache = phash.HashCache(16)
+    region = (160, 560, 625, 610)
+    for text in ['Qualification 12 of 74', 'Qualification 13 of 74',
+                 'Qualification 1 of 74', 'Qualification 7 of 74']:
+        assert cache.lookup(region, label(text), lambda img: text) == text
+    assert cache.hits == 0
+
+def test_same_label_is_a_hit():
+    cache = phash.HashCache(16)
+    region = (160, 560, 625, 610)
+    cache.lookup(region, label('Semifinal Match 2'), lambda img: 'Semifinal Match 2')
+    assert cache.lookup(region, label('Semifinal Match 2'), lambda img: None) == \
+        'Semifinal Match 2'
+    assert cache.hits == 1
+
+def test_noisy_copies_are_hits():
+    cache = phash.HashCache(16)
+    region = (160, 560, 625, 610)
+    cache.lookup(region, noisy(label('Qualification 12 of 74'), 75), lambda img: 12)
+    for seed in range(1, 6):
+        assert cache.lookup(region, noisy(label('Qualification 12 of 74'), seed=seed),
+                            lambda img: None) == 12
+    assert cache.hits == 5
+
+def test_noisy_one_digit_change_is_read_again():
+    cache = phash.HashCache(16)
+    region = (160, 560, 625, 610)
+    for seed, number in enumerate([12, 13, 1, 82]):
+        text = 'Qualification {} of 74'.format(number)
+        assert cache.lookup(region, noisy(label(text), seed=seed), lambda img: number) == number
+    assert cache.hits == 0
+
+def test_size_is_bounded():
+    cache = phash.HashCache(4)
+    for y in range(100):
+        cache.lookup((0, y, 465, y + 50), label('Semifinal Match {}'.format(y)), lambda img: y)
+    assert len(cache._entries) == 4 and len(cache._latest) == 4
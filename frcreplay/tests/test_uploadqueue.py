@@ -0,0 +1,124 @@
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+
+import mockserver
+import uploadqueue
+
+TWITTER_USER = 'mock'
+
+# Wait up to TIMEOUT seconds for CONDITION to hold
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+def video(tmp_path, name, size=100000):
+    path = tmp_path / '123---{}'.format(name)
+    path.write_bytes(os.urandom(size))
+    return str(path)
+
+def journal_ops(journal_path, op):
+    with open(journal_path, 'r', encoding='utf-8') as journal_file:
+        return sum(1 for line in journal_file if '"op": "{}"'.format(op) in line)
+
+def test_restart_carries_on_without_repeating_steps(server, tmp_path):
+    journal_path = str(tmp_path / uploadqueue.JOURNAL_NAME)
+    path = video(tmp_path, 'Q1')
+
+    # no tweets allowed, so the video stops after its upload
+    queue = uploadqueue.UploadQueue(journal_path, 1, {'twitter': (1e-9, 0)})
+    queue.start()
+    assert queue.submit(path, 'Q1', TWITTER_USER)
+    wait_for(lambda: len(server.uploads) == 1)
+    wait_for(lambda: journal_ops(journal_path, 'done') == 1)
+    queue.stop()
+    # and the process died writing its next record
+    with open(journal_path, 'a', encoding='utf-8') as journal_file:
+        journal_file.write('{"op": "fai')
+
+    queue = uploadqueue.UploadQueue(journal_path, 1, {})
+    queue.start()
+    assert not queue.submit(path, 'Q1', TWITTER_USER)
+    wait_for(lambda: queue.completed == 1)
+    queue.stop()
+    assert len(server.uploads) == 1
+    assert server.tweets == ['Q1 https://streamable.com/{}'.format(server.uploads[0]['link'])]
+    assert not os.path.exists(path)
+
+    queue = uploadqueue.UploadQueue(journal_path, 1, {})
+    queue.start()
+    assert queue.pending() == 0
+    assert not queue.submit(path, 'Q1', TWITTER_USER)
+    queue.stop()
+    assert len(server.uploads) == 1 and len(server.tweets) == 1
+
+def test_failed_steps_back_off(server, tmp_path, monkeypatch):
+    delays = []
+    def retry_delay(attempts):
+        delays.append(attempts)
+        return 0.01
+    monkeypatch.setattr(uploadqueue, 'retry_delay', retry_delay)
+    journal_path = str(tmp_path / uploadqueue.JOURNAL_NAME)
+    path = video(tmp_path, 'Q2')
+
+    queue = uploadqueue.UploadQueue(journal_path, 1, {})
+    queue.start()
+    server.fail_next(3)
+    queue.submit(path, 'Q2', None)
+    wait_for(lambda: queue.completed == 1)
+    queue.stop()
+    assert delays == [1, 2, 3]
+    assert queue.failures == 3 and journal_ops(journal_path, 'failed') == 3
+    assert len(server.uploads) == 1 and server.tweets == []
+
+def test_retry_delay_grows_to_its_cap(monkeypatch):
+    monkeypatch.setattr(uploadqueue.random, 'uniform', lambda low, high: high)
+    assert [uploadqueue.retry_delay(attempts) for attempts in (1, 2, 3)] == \
+        [uploadqueue.RETRY_BASE_DELAY * 2 ** i for i in range(3)]
+    assert uploadqueue.retry_delay(100) == uploadqueue.RETRY_MAX_DELAY
+
+def test_video_is_set_aside_after_max_attempts(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(uploadqueue, 'MAX_ATTEMPTS', 3)
+    monkeypatch.setattr(uploadqueue, 'retry_delay', lambda attempts: 0.01)
+    journal_path = str(tmp_path / uploadqueue.JOURNAL_NAME)
+    path = video(tmp_path, 'Q3')
+
+    queue = uploadqueue.UploadQueue(journal_path, 1, {})
+    queue.start()
+    server.fail_randomly(1, mockserver.DROP)
+    queue.submit(path, 'Q3', None)
+    wait_for(lambda: queue.abandoned() == 1)
+    time.sleep(0.1)
+    assert queue.failures == 3 and queue.pending() == 0
+    assert os.path.exists(path)
+    # found again (eg. by a recorder) it stays aside
+    assert not queue.submit(path, 'Q3', None)
+    assert queue.failures == 3
+
+    server.fail_randomly(0)
+    assert queue.retry() == 1
+    wait_for(lambda: queue.completed == 1)
+    queue.stop()
+    assert queue.abandoned() == 0
+    assert len(server.uploads) == 1 and not os.path.exists(path)
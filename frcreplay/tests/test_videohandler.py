@@ -0,0 +1,129 @@
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+
+import pytest
+
+import httpclient
+import mockserver
+
+videohandler = pytest.importorskip('videohandler')
+
+CHUNK_SIZE = 256 * 1024
+
+@pytest.fixture
+def uploader(monkeypatch):
+    uploader = videohandler.YoutubeUploader()
+    monkeypatch.setattr(uploader, 'chunk_size', CHUNK_SIZE)
+    return uploader
+
+@pytest.fixture
+def video(tmp_path):
+    path = tmp_path / '123---Q1'
+    path.write_bytes(os.urandom(10 * CHUNK_SIZE + 1234))
+    return str(path)
+
+def sha256(path):
+    with open(path, 'rb') as video_file:
+        return hashlib.sha256(video_file.read()).hexdigest()
+
+# Content-Range headers of every chunk and query PUT
+@pytest.fixture
+def ranges(monkeypatch):
+    ranges = []
+    put = httpclient.put
+    def recording_put(endpoint, url, **kwargs):
+        ranges.append(kwargs['headers']['Content-Range'])
+        return put(endpoint, url, **kwargs)
+    monkeypatch.setattr(httpclient, 'put', recording_put)
+    return ranges
+
+class Crash(Exception):
+    pass
+
+def test_resumes_from_saved_offset(server, uploader, video, ranges):
+    states = []
+    def save_state(state):
+        states.append(state)
+        if len(states) == 3:
+            raise Crash()
+    with pytest.raises(Crash):
+        uploader.upload('Q1', video, {}, save_state)
+    state = states[-1]
+    assert state['offset'] == 2 * CHUNK_SIZE
+
+    del ranges[:]
+    link = uploader.upload('Q1', video, state, states.append)
+    total = os.path.getsize(video)
+    assert ranges[:2] == ['bytes */{}'.format(total), 'bytes {}-{}/{}'.format(
+        2 * CHUNK_SIZE, 3 * CHUNK_SIZE - 1, total)]
+    assert len(server.uploads) == 1
+    assert link == 'https://youtu.be/{}'.format(server.uploads[0]['link'])
+    assert server.uploads[0]['sha256'] == sha256(video)
+
+def test_survives_dropped_connections(server, uploader, video):
+    server.fail_randomly(0.25, mockserver.DROP)
+    states = [{}]
+    for _ in range(100):
+        try:
+            link = uploader.upload('Q1', video, states[-1], states.append)
+            break
+        except Exception:
+            pass
+    else:
+        pytest.fail('never finished uploading')
+    assert server.failed > 0
+    # every attempt carried on from where the last one got to
+    offsets = [state['offset'] for state in states[1:]]
+    assert offsets == sorted(offsets)
+    assert len(set(state['session'] for state in states[1:])) == 1
+    assert len(server.uploads) == 1
+    assert server.uploads[0]['sha256'] == sha256(video)
+    assert link == 'https://youtu.be/{}'.format(server.uploads[0]['link'])
+
+def test_expired_session_starts_over(server, uploader, video, ranges):
+    states = []
+    def save_state(state):
+        states.append(state)
+        if len(states) == 3:
+            raise Crash()
+    with pytest.raises(Crash):
+        uploader.upload('Q1', video, {}, save_state)
+    server.expire_sessions()
+
+    del ranges[:]
+    uploader.upload('Q1', video, states[-1], states.append)
+    assert ranges[1].startswith('bytes 0-')
+    assert states[3] == {'session': states[3]['session'], 'offset': 0}
+    assert states[3]['session'] != states[0]['session']
+    assert len(server.uploads) == 1
+    assert server.uploads[0]['sha256'] == sha256(video)
+
+# eg. a crash after the last chunk but before the queue journaled the upload
+def test_finished_session_is_not_uploaded_again(server, uploader, video, ranges):
+    state = {}
+    link = uploader.upload('Q1', video, {}, state.update)
+
+    del ranges[:]
+    assert uploader.upload('Q1', video, state, state.update) == link
+    assert ranges == ['bytes */{}'.format(os.path.getsize(video))]
+    assert len(server.uploads) == 1
@@ -0,0 +1,69 @@
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import threading
+
+from matchobserver import visionpool
+
+WIDTH = 64
+HEIGHT = 36
+
+# Says which process it's in, how many frames it has seen and the frame's
+# first pixel
+class CountingCore:
+    def __init__(self, video_width, video_height):
+        self.frames = 0
+
+    def observe(self, frame):
+        self.frames += 1
+        return {'pid': os.getpid(), 'frames': self.frames, 'pixel': frame.getpixel((0, 0))}
+
+def test_streams_stay_on_one_worker():
+    pool = visionpool.VisionPool(2)
+    pool.start()
+    results = {}
+    finished = threading.Semaphore(0)
+    try:
+        for stream_id in ('a', 'b', 'c'):
+            def on_result(frame_counter, match_info, tag, elapsed, stream_id=stream_id):
+                results.setdefault(stream_id, []).append((frame_counter, match_info))
+                finished.release()
+            pool.add_stream(stream_id, stream_id, CountingCore, WIDTH, HEIGHT, None, on_result,
+                            lambda: 0)
+        for frame_counter in range(1, 11):
+            for stream_id in ('a', 'b', 'c'):
+                pool.submit(stream_id, frame_counter, bytes([frame_counter]) * WIDTH * HEIGHT * 3)
+            for _ in range(3):
+                assert finished.acquire(timeout=10)
+    finally:
+        pool.stop()
+
+    pids = set()
+    for stream_id, stream_results in results.items():
+        frame_counters = [frame_counter for frame_counter, _ in stream_results]
+        assert frame_counters == list(range(1, 11))
+        assert len(set(match_info['pid'] for _, match_info in stream_results)) == 1
+        # one core, which saw every frame of the stream
+        assert [match_info['frames'] for _, match_info in stream_results] == frame_counters
+        assert [match_info['pixel'] for _, match_info in stream_results] == \
+            [(n, n, n) for n in frame_counters]
+        pids.add(stream_results[0][1]['pid'])
+    assert len(pids) == 2
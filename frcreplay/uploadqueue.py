@@ -0,0 +1,466 @@
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Durable queue of recorded match videos to upload and post. Every video goes
+# through a list of steps (upload it, tweet the link, delete the file), and
+# each step that completes is appended to a journal on disk and fsynced before
+# the next one starts. After a restart the journal is replayed and every
+# unfinished video carries on from the step it was on, so a journaled step is
+# never redone and a video that's been submitted once is never queued again;
+# only a crash in the middle of a step can repeat it. Failed steps are retried
+# with exponential backoff and full jitter, up to MAX_ATTEMPTS times, after which
+# the video is set aside (and its file kept) until the queue is restarted or
+# retry() is called. A fixed number of worker threads do the work, and each
+# destination has a token bucket so a backlog (eg. after a reconnect) can't
+# blow through its rate limit or quota. Steps can journal their progress too,
+# which resumable uploads (see videohandler.Uploader) use to carry on where the
+# last attempt got to.
+#
+# mockserver.py stands in for the real services to run the queue against.
+
+import collections
+import concurrent.futures
+import functools
+import heapq
+import itertools
+import json
+import os
+import random
+import threading
+import time
+import traceback
+
+JOURNAL_NAME = 'uploads.journal'
+WORKERS = 2
+RETRY_BASE_DELAY = 5 # seconds before the first retry, doubled with every failure after
+RETRY_MAX_DELAY = 60 * 60
+MAX_ATTEMPTS = 20 # failures of one step before a video is set aside
+FINISHED_TO_KEEP = 1000 # finished videos remembered when the journal is compacted
+
+UPLOADER = 'streamable' # one of videohandler.UPLOADERS
+
+# (tokens per second, burst) per destination
+RATE_LIMITS = {
+    'streamable': (1 / 30, 4),
+    # the default YouTube API quota of 10000 units a day covers 6 uploads
+    'youtube': (6 / (24 * 60 * 60), 6),
+    'twitter': (1 / 60, 5),
+}
+
+# Steps are called with the job and a function which journals the step's
+# progress so far, handed back as job['progress'][step] on the next attempt.
+# A step can also return a concurrent.futures.Future, to run somewhere other
+# than the queue's worker threads; the step completes with it.
+# videohandler needs credentials and the service client libraries, so it's
+# only imported once there's something to upload.
+#
+# The optional transcode step makes an upload rendition (see rendition.py),
+# which is what gets uploaded when there is one. It runs in the rendition pool,
+# so minutes long encodes don't hold up the uploads and tweets.
+def transcode_step(job, save_progress):
+    import rendition
+    return rendition.pool().submit(job['path'])
+
+def upload_step(job, save_progress):
+    import videohandler
+    return videohandler.UPLOADERS[job['uploader']].upload(
+        videohandler.STREAMABLE_TITLE_FORMAT.format(job['title'], job['twitter_user']),
+        job['results'].get('transcode') or job['path'], job['progress'].get('upload', {}),
+        save_progress)
+
+def upload_destination(job):
+    return job['uploader']
+
+def tweet_step(job, save_progress):
+    import videohandler
+    videohandler.twitter_post(job['title'], job['results']['upload'], job['twitter_user'])
+
+def delete_step(job, save_progress):
+    for path in (job['path'], job['results'].get('transcode')):
+        try:
+            if path is not None:
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+# name -> (destination whose rate limit it counts against, or a function of
+# the job returning it, and the step's function returning a result to journal)
+STEPS = {
+    'transcode': (None, transcode_step),
+    'upload': (upload_destination, upload_step),
+    'tweet': ('twitter', tweet_step),
+    'delete': (None, delete_step),
+}
+
+def job_steps(twitter_user, transcode=False):
+    steps = ['transcode'] if transcode else []
+    steps.append('upload')
+    if twitter_user is not None:
+        steps.append('tweet')
+    steps.append('delete')
+    return steps
+
+# Seconds to wait before retrying a step which has failed ATTEMPTS times
+def retry_delay(attempts):
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempts - 1)))
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.time()
+
+    # Take a token if there is one and return 0, otherwise return the seconds
+    # until there will be
+    def take(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self.rate
+
+# Append-only file of JSON records, one per line:
+#
+#   submit    a video was queued, with its path, title, twitter_user and steps
+#   progress  a step got partway, with its state to resume from
+#   done      a step completed, with its result
+#   failed    a step failed, with the error
+#   abandoned a step failed MAX_ATTEMPTS times, the video waits for a retry
+#   retry     an abandoned video was given another MAX_ATTEMPTS
+#   finished  every step completed
+class Journal:
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    # Replay the journal. Returns (unfinished jobs by id in submission order,
+    # ids of finished ones, oldest first).
+    def load(self):
+        jobs = collections.OrderedDict()
+        finished = collections.OrderedDict()
+        if not os.path.isfile(self.path):
+            return (jobs, finished)
+
+        with open(self.path, 'r', encoding='utf-8') as journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the tail of a write cut short by a crash
+                    continue
+                apply_record(jobs, finished, record)
+        return (jobs, finished)
+
+    # Rewrite the journal with just what's needed to carry on
+    def compact(self, jobs, finished):
+        self.close()
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as temp_file:
+            for job_id in itertools.islice(finished, max(0, len(finished) - FINISHED_TO_KEEP),
+                                           None):
+                temp_file.write(json.dumps({'op': 'finished', 'id': job_id}) + '\n')
+            for job in jobs.values():
+                for record in job_records(job):
+                    temp_file.write(json.dumps(record) + '\n')
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_path, self.path)
+
+    def append(self, record):
+        if self._file is None:
+            self._file = open(self.path, 'a', encoding='utf-8')
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+def apply_record(jobs, finished, record):
+    op = record['op']
+    job_id = record['id']
+    if op == 'submit':
+        if job_id not in finished:
+            jobs[job_id] = {
+                'id': job_id,
+                'path': record['path'],
+                'title': record['title'],
+                'twitter_user': record['twitter_user'],
+                'steps': record['steps'],
+                'uploader': record.get('uploader', UPLOADER),
+                'results': {},
+                'progress': {},
+                'attempts': 0,
+                'abandoned': False,
+            }
+    elif op == 'finished':
+        jobs.pop(job_id, None)
+        finished[job_id] = True
+    elif job_id in jobs:
+        job = jobs[job_id]
+        if op == 'progress':
+            job['progress'][record['step']] = record['state']
+        elif op == 'done':
+            job['results'][record['step']] = record['result']
+            job['progress'].pop(record['step'], None)
+            job['attempts'] = 0
+        elif op == 'failed':
+            job['attempts'] += 1
+        elif op == 'abandoned':
+            job['abandoned'] = True
+        elif op == 'retry':
+            job['abandoned'] = False
+            job['attempts'] = 0
+
+# The records which bring a job back to where it is
+def job_records(job):
+    records = [{
+        'op': 'submit',
+        'id': job['id'],
+        'path': job['path'],
+        'title': job['title'],
+        'twitter_user': job['twitter_user'],
+        'steps': job['steps'],
+        'uploader': job['uploader'],
+    }]
+    for step in job['steps']:
+        if step in job['results']:
+            records.append({'op': 'done', 'id': job['id'], 'step': step,
+                            'result': job['results'][step]})
+        elif step in job['progress']:
+            records.append({'op': 'progress', 'id': job['id'], 'step': step,
+                            'state': job['progress'][step]})
+    for _ in range(job['attempts']):
+        records.append({'op': 'failed', 'id': job['id'], 'step': next_step(job), 'error': None})
+    if job['abandoned']:
+        records.append({'op': 'abandoned', 'id': job['id']})
+    return records
+
+def next_step(job):
+    for step in job['steps']:
+        if step not in job['results']:
+            return step
+    return None
+
+class UploadQueue:
+    def __init__(self, journal_path, workers=WORKERS, rate_limits=RATE_LIMITS, steps=STEPS,
+                 uploader=UPLOADER, transcode=False):
+        self.workers = workers
+        self.uploader = uploader
+        # whether to upload renditions instead of the recorded videos
+        self.transcode = transcode
+        self._journal = Journal(journal_path)
+        self._steps = steps
+        self._buckets = {destination: TokenBucket(rate, burst)
+                         for destination, (rate, burst) in rate_limits.items()}
+        self._lock = threading.Condition()
+        self._jobs = collections.OrderedDict()
+        self._finished = collections.OrderedDict()
+        # (time.time() to run at, sequence, job id) of every job not being worked on
+        self._schedule = []
+        self._sequence = itertools.count()
+        self._threads = []
+        self._running = False
+        self.completed = 0
+        self.failures = 0
+
+    # Pick up whatever the journal says is unfinished, abandoned videos
+    # included, and start the workers
+    def start(self):
+        with self._lock:
+            self._jobs, self._finished = self._journal.load()
+            self._journal.compact(self._jobs, self._finished)
+            for job in self._jobs.values():
+                if job['abandoned']:
+                    self._retry(job)
+                else:
+                    self._schedule_job(job, time.time())
+            self._running = True
+
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name='upload-{}'.format(i),
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        print('******** upload queue started with {} unfinished videos'.format(len(self._jobs)))
+
+    # Waits for the steps in progress to finish
+    def stop(self):
+        with self._lock:
+            self._running = False
+            self._lock.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._journal.close()
+
+    # Queue the video at PATH unless it has been already (abandoned videos
+    # included, see retry). Returns whether it was queued.
+    def submit(self, path, title, twitter_user):
+        job_id = os.path.abspath(path)
+        with self._lock:
+            if job_id in self._jobs or job_id in self._finished:
+                return False
+
+            record = {
+                'op': 'submit',
+                'id': job_id,
+                'path': job_id,
+                'title': title,
+                'twitter_user': twitter_user,
+                'steps': job_steps(twitter_user, self.transcode),
+                'uploader': self.uploader,
+            }
+            self._journal.append(record)
+            apply_record(self._jobs, self._finished, record)
+            self._schedule_job(self._jobs[job_id], time.time())
+            print('******** queued upload of {}'.format(title))
+            return True
+
+    # Give every abandoned video (or just the one at PATH) another
+    # MAX_ATTEMPTS. Returns how many were.
+    def retry(self, path=None):
+        with self._lock:
+            jobs = [job for job in self._jobs.values() if job['abandoned'] and
+                    (path is None or job['id'] == os.path.abspath(path))]
+            for job in jobs:
+                self._retry(job)
+            return len(jobs)
+
+    def _retry(self, job):
+        record = {'op': 'retry', 'id': job['id']}
+        self._journal.append(record)
+        apply_record(self._jobs, self._finished, record)
+        self._schedule_job(job, time.time())
+        print('******** retrying upload of {}'.format(job['title']))
+
+    def pending(self):
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if not job['abandoned'])
+
+    def abandoned(self):
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if job['abandoned'])
+
+    def _schedule_job(self, job, at):
+        heapq.heappush(self._schedule, (at, next(self._sequence), job['id']))
+        self._lock.notify()
+
+    # Wait for a job whose time has come and whose next step's destination has
+    # a token to spare. Returns (job, step), or (None, None) once stopped.
+    def _next_job(self):
+        while self._running:
+            if len(self._schedule) == 0:
+                self._lock.wait()
+                continue
+
+            now = time.time()
+            at, _, job_id = self._schedule[0]
+            if at > now:
+                self._lock.wait(at - now)
+                continue
+            heapq.heappop(self._schedule)
+
+            job = self._jobs[job_id]
+            step = next_step(job)
+            destination = self._steps[step][0]
+            if callable(destination):
+                destination = destination(job)
+            if destination in self._buckets:
+                wait = self._buckets[destination].take(now)
+                if wait > 0:
+                    self._schedule_job(job, now + wait)
+                    continue
+            return (job, step)
+        return (None, None)
+
+    def _work(self):
+        while True:
+            with self._lock:
+                job, step = self._next_job()
+            if job is None:
+                return
+
+            try:
+                result = self._steps[step][1](job, functools.partial(self._progress, job, step))
+            except Exception as e:
+                traceback.print_exc()
+                self._failed(job, step, e)
+                continue
+            if isinstance(result, concurrent.futures.Future):
+                result.add_done_callback(functools.partial(self._future_done, job, step))
+            else:
+                self._done(job, step, result)
+
+    def _future_done(self, job, step, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            traceback.print_exception(type(e), e, e.__traceback__)
+            self._failed(job, step, e)
+        else:
+            self._done(job, step, result)
+
+    def _done(self, job, step, result):
+        with self._lock:
+            record = {'op': 'done', 'id': job['id'], 'step': step, 'result': result}
+            self._journal.append(record)
+            apply_record(self._jobs, self._finished, record)
+
+            if next_step(job) is not None:
+                self._schedule_job(job, time.time())
+                return
+            self._finish(job)
+            self.completed += 1
+            print('******** finished uploading {}'.format(job['title']))
+
+    def _progress(self, job, step, state):
+        with self._lock:
+            record = {'op': 'progress', 'id': job['id'], 'step': step, 'state': state}
+            self._journal.append(record)
+            apply_record(self._jobs, self._finished, record)
+
+    def _failed(self, job, step, error):
+        with self._lock:
+            record = {'op': 'failed', 'id': job['id'], 'step': step, 'error': repr(error)}
+            self._journal.append(record)
+            apply_record(self._jobs, self._finished, record)
+            self.failures += 1
+
+            if job['attempts'] >= MAX_ATTEMPTS:
+                print('******** setting {} aside after {} failed attempts to {}'.format(
+                    job['title'], job['attempts'], step))
+                record = {'op': 'abandoned', 'id': job['id']}
+                self._journal.append(record)
+                apply_record(self._jobs, self._finished, record)
+                return
+            delay = retry_delay(job['attempts'])
+            print('******** {} of {} failed, retrying in {:.0f} s'.format(step, job['title'],
+                                                                          delay))
+            self._schedule_job(job, time.time() + delay)
+
+    def _finish(self, job):
+        record = {'op': 'finished', 'id': job['id']}
+        self._journal.append(record)
+        apply_record(self._jobs, self._finished, record)
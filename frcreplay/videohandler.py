@@ -18,45 +18,290 @@
 # You should have received a copy of the GNU Affero General Public License along
 # with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import abc
 import json
 import os
+import threading
+import time
 import traceback
 
-import requests
 import requests_toolbelt.multipart.encoder
 import retrying
 import twitter
 
+import httpclient
+
 VIDEOS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'videos')
 
 RETRY_DELAY = 60000
 
 STREAMABLE_UPLOAD_ENDPOINT = 'https://api.streamable.com/upload'
 STREAMABLE_LINK_FORMAT = 'https://streamable.com/{}'
+TWITTER_BASE_URL = None # python-twitter's default unless set
+
+YOUTUBE_TOKEN_ENDPOINT = 'https://oauth2.googleapis.com/token'
+YOUTUBE_UPLOAD_ENDPOINT = \
+    'https://www.googleapis.com/upload/youtube/v3/videos?uploadType=resumable&part=snippet,status'
+YOUTUBE_LINK_FORMAT = 'https://youtu.be/{}'
+
+CHUNK_SIZE = 8 * 1024 * 1024 # bytes per request of a resumable upload, a multiple of 256 KiB
+THROUGHPUT_SMOOTHING = 0.2 # weight of the newest chunk in the throughput average
 
-with open('credentials.json', 'r', encoding='utf-8') as credentials_file:
-    CREDENTIALS = json.load(credentials_file)
+CREDENTIALS_PATH = 'credentials.json'
+_credentials = None
 
 TWEET_FORMAT = '{} {}'
 STREAMABLE_TITLE_FORMAT = '{} (twitter.com/{})'
 
-@retrying.retry(wait_fixed=RETRY_DELAY)
-def upload_to_streamable(title, path):
-    try:
-        print('******** uploading video for {} to streamable'.format(title))
-        traceback.print_stack()
+# Read on first use, so the module can be imported (eg. by uploadqueue.py, or
+# against mockserver.py) without credentials around
+def credentials():
+    global _credentials
+    if _credentials is None:
+        with open(CREDENTIALS_PATH, 'r', encoding='utf-8') as credentials_file:
+            _credentials = json.load(credentials_file)
+    return _credentials
 
+# One attempt at uploading the video at PATH. Returns its link.
+def streamable_upload(title, path):
+    print('******** uploading video for {} to streamable'.format(title))
+    with open(path, 'rb') as video_file:
         encoder = requests_toolbelt.multipart.encoder.MultipartEncoder(
-                fields={'title':title, 'files[]': ('video.mp4', open(path, 'rb'), 'video/mp4')})
-        r = requests.post(STREAMABLE_UPLOAD_ENDPOINT,
-                          data=encoder, headers={'Content-Type': encoder.content_type})
-        print('******** streamable response for {}: {}'.format(title, r.text))
-        r.raise_for_status()
+                fields={'title':title, 'files[]': ('video.mp4', video_file, 'video/mp4')})
+        r = httpclient.post('streamable-upload', STREAMABLE_UPLOAD_ENDPOINT,
+                            data=encoder, headers={'Content-Type': encoder.content_type})
+    print('******** streamable response for {}: {}'.format(title, r.text))
+    r.raise_for_status()
+
+    data = json.loads(r.text)
+    link = STREAMABLE_LINK_FORMAT.format(data['shortcode'])
+    print('******** streamable link for {}: {}'.format(title, link))
+    return link
+
+# Upload throughput of one destination, as a moving average over requests
+class ThroughputMeter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.seconds = 0
+        self.rate = None # bytes per second
+
+    def add(self, sent, seconds):
+        with self._lock:
+            self.bytes += sent
+            self.seconds += seconds
+            if seconds > 0:
+                rate = sent / seconds
+                self.rate = rate if self.rate is None else \
+                    self.rate + THROUGHPUT_SMOOTHING * (rate - self.rate)
+
+# Uploaders by name, see UPLOADERS below. An uploader puts the video at PATH up
+# under TITLE and returns its link. STATE is whatever it last passed to
+# SAVE_STATE on an earlier attempt at the same video ({} at first), which the
+# upload queue keeps in its journal, so an upload cut short can carry on from
+# where it got to instead of from the start. Subclasses implement upload.
+class Uploader(abc.ABC):
+    def __init__(self):
+        self.throughput = ThroughputMeter()
 
-        data = json.loads(r.text)
-        link = STREAMABLE_LINK_FORMAT.format(data['shortcode'])
-        print('******** streamable link for {}: {}'.format(title, link))
+    @abc.abstractmethod
+    def upload(self, title, path, state, save_state):
+        pass
+
+# One multipart POST of the whole file, streamed from disk. Can't resume.
+class StreamableUploader(Uploader):
+    def upload(self, title, path, state, save_state):
+        start = time.time()
+        link = streamable_upload(title, path)
+        self.throughput.add(os.path.getsize(path), time.time() - start)
         return link
+
+# LENGTH bytes of FILE from OFFSET, read as they're sent so a chunk is never
+# held in memory
+class FileSlice:
+    def __init__(self, file, offset, length):
+        self._file = file
+        self._file.seek(offset)
+        self._remaining = length
+
+    def __len__(self):
+        return self._remaining
+
+    def read(self, size=-1):
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._file.read(size)
+        self._remaining -= len(data)
+        return data
+
+# The resumable protocol YouTube uses: a POST with the video's metadata opens a
+# session, then the file goes up in CHUNK_SIZE PUTs with Content-Range headers,
+# each answered by a 308 with the Range the server has so far until the last
+# one gets the created video back. After a failure an empty PUT with
+# 'Content-Range: bytes */<size>' asks the session how much it has, and a
+# session that's gone (404/410) means starting over. Subclasses implement
+# endpoint and link, and headers and metadata if the service wants any.
+class ResumableUploader(Uploader):
+    name = 'resumable' # endpoint name for httpclient stats
+    chunk_size = CHUNK_SIZE
+
+    # URL to POST to for a new session
+    @abc.abstractmethod
+    def endpoint(self):
+        pass
+
+    def headers(self):
+        return {}
+
+    def metadata(self, title):
+        return {}
+
+    # Link to the video from the JSON a finished session answers with
+    @abc.abstractmethod
+    def link(self, response_data):
+        pass
+
+    def upload(self, title, path, state, save_state):
+        total = os.path.getsize(path)
+        if total == 0:
+            raise Exception('Nothing to upload in {}'.format(path))
+        session = state.get('session')
+        offset = None
+        if session is not None:
+            offset, link = self._query_session(session, total)
+            # the last attempt got the whole video up, but not journaled as done
+            if link is not None:
+                print('******** {} was already uploaded to {}'.format(title, link))
+                return link
+        if offset is None:
+            session = self._open_session(title, total)
+            offset = 0
+            save_state({'session': session, 'offset': offset})
+        if offset > 0:
+            print('******** resuming upload of {} at {} of {} bytes'.format(title, offset, total))
+
+        with open(path, 'rb') as video_file:
+            while True:
+                length = min(self.chunk_size, total - offset)
+                headers = self.headers()
+                headers['Content-Range'] = 'bytes {}-{}/{}'.format(offset, offset + length - 1,
+                                                                   total)
+                start = time.time()
+                r = httpclient.put(self.name + '-chunk', session,
+                                   data=FileSlice(video_file, offset, length), headers=headers)
+                self.throughput.add(length, time.time() - start)
+
+                if r.status_code in (200, 201):
+                    link = self.link(r.json())
+                    print('******** uploaded {} to {} at {:.1f} MB/s'.format(
+                        title, link, (self.throughput.rate or 0) / 1e6))
+                    return link
+                if r.status_code != 308:
+                    r.raise_for_status()
+                    raise Exception('Unexpected {} response uploading {}'.format(r.status_code,
+                                                                                 title))
+                offset = received_bytes(r)
+                save_state({'session': session, 'offset': offset})
+
+    def _open_session(self, title, total):
+        headers = self.headers()
+        headers['X-Upload-Content-Length'] = str(total)
+        headers['X-Upload-Content-Type'] = 'video/mp4'
+        r = httpclient.post(self.name + '-session', self.endpoint(), json=self.metadata(title),
+                            headers=headers)
+        r.raise_for_status()
+        return r.headers['Location']
+
+    # (how much of the video SESSION has or None if it's expired, the link to
+    # the video if the session already finished it)
+    def _query_session(self, session, total):
+        headers = self.headers()
+        headers['Content-Range'] = 'bytes */{}'.format(total)
+        r = httpclient.put(self.name + '-query', session, headers=headers)
+        if r.status_code in (404, 410):
+            return (None, None)
+        if r.status_code in (200, 201):
+            return (total, self.link(r.json()))
+        if r.status_code != 308:
+            r.raise_for_status()
+            raise Exception('Unexpected {} response querying {}'.format(r.status_code, session))
+        return (received_bytes(r), None)
+
+# Bytes the server says it has from the Range header of a 308
+def received_bytes(response):
+    received = response.headers.get('Range')
+    if received is None:
+        return 0
+    return int(received.rsplit('-', 1)[1]) + 1
+
+class YoutubeUploader(ResumableUploader):
+    name = 'youtube'
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._access_token = None
+        self._expires = 0
+
+    # OAuth access token from the refresh token in credentials.json, refreshed
+    # a minute before it runs out
+    def headers(self):
+        with self._lock:
+            if time.time() >= self._expires:
+                youtube_credentials = credentials()['youtube']
+                r = httpclient.post('youtube-token', YOUTUBE_TOKEN_ENDPOINT, data={
+                    'client_id': youtube_credentials['client_id'],
+                    'client_secret': youtube_credentials['client_secret'],
+                    'refresh_token': youtube_credentials['refresh_token'],
+                    'grant_type': 'refresh_token',
+                })
+                r.raise_for_status()
+                token = r.json()
+                self._access_token = token['access_token']
+                self._expires = time.time() + token['expires_in'] - 60
+            return {'Authorization': 'Bearer {}'.format(self._access_token)}
+
+    def endpoint(self):
+        return YOUTUBE_UPLOAD_ENDPOINT
+
+    def metadata(self, title):
+        return {
+            'snippet': {'title': title},
+            'status': {'privacyStatus': 'public'},
+        }
+
+    def link(self, response_data):
+        return YOUTUBE_LINK_FORMAT.format(response_data['id'])
+
+UPLOADERS = {
+    'streamable': StreamableUploader(),
+    'youtube': YoutubeUploader(),
+}
+
+_twitter_apis = {}
+_twitter_apis_lock = threading.Lock()
+
+# One python-twitter client per user, kept for the life of the process
+def twitter_api(twitter_user):
+    with _twitter_apis_lock:
+        if twitter_user not in _twitter_apis:
+            _twitter_apis[twitter_user] = twitter.Api(base_url=TWITTER_BASE_URL,
+                                                      **credentials()['twitter'][twitter_user])
+        return _twitter_apis[twitter_user]
+
+# One attempt at tweeting LINK as TWITTER_USER
+def twitter_post(title, link, twitter_user):
+    tweet = TWEET_FORMAT.format(title, link)
+    with httpclient.timed('twitter-update'):
+        status = twitter_api(twitter_user).PostUpdate(tweet)
+    print('******** posted tweet: {}'.format(status.text))
+
+# Blocking versions retrying forever, for one-off uploads. Recorders go through
+# uploadqueue.py instead.
+@retrying.retry(wait_fixed=RETRY_DELAY)
+def upload_to_streamable(title, path):
+    try:
+        return streamable_upload(title, path)
     except:
         traceback.print_exc()
         raise
@@ -64,9 +309,7 @@ def upload_to_streamable(title, path):
 @retrying.retry(wait_fixed=RETRY_DELAY)
 def post_video_to_twitter(title, link, twitter_user):
     try:
-        tweet = TWEET_FORMAT.format(title, link)
-        status = twitter.Api(**CREDENTIALS['twitter'][twitter_user]).PostUpdate(tweet)
-        print('******** posted tweet: {}'.format(status.text))
+        twitter_post(title, link, twitter_user)
     except:
         traceback.print_exc()
         raise
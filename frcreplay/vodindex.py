@@ -0,0 +1,153 @@
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Packet index of a downloaded VOD, so anything that needs to seek or cut the
+# file can look up where the keyframes are instead of probing it again. The
+# index is built once with ffprobe (demuxing only, nothing is decoded) and
+# kept next to the VOD as a .npy sidecar of fixed size records:
+#
+#   pts   presentation time of the packet in seconds from the start of the
+#         file (its format start_time), the time ffmpeg's -ss and -to use
+#   pos   byte offset of the packet in the file
+#   size  packet size in bytes
+#   key   whether the packet is a keyframe
+#
+# Only the first video stream is indexed.
+
+import os
+import shutil
+import subprocess
+
+import numpy
+
+INDEX_DTYPE = numpy.dtype([
+    ('pts',  '<f8'),
+    ('pos',  '<i8'),
+    ('size', '<i4'),
+    ('key',  '?'),
+])
+
+# Changed whenever what the records mean changes, so old sidecars are rebuilt
+INDEX_SUFFIX = '.index2.npy'
+
+def index_path(vod_path):
+    return vod_path + INDEX_SUFFIX
+
+# ffprobe lives next to ffmpeg, so prefer the one beside FFMPEG_BIN
+def find_ffprobe(ffmpeg_bin=None):
+    if ffmpeg_bin is not None:
+        ffprobe_bin = os.path.join(os.path.dirname(ffmpeg_bin), 'ffprobe')
+        if os.path.isfile(ffprobe_bin):
+            return ffprobe_bin
+    ffprobe_bin = shutil.which('ffprobe')
+    if ffprobe_bin is None:
+        raise Exception('Unable to find ffprobe')
+    return ffprobe_bin
+
+def probe_start_time(vod_path, ffprobe_bin):
+    proc = subprocess.run([
+        ffprobe_bin,
+        '-v', 'error',
+        '-show_entries', 'format=start_time',
+        '-of', 'csv=p=0',
+        vod_path,
+    ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        raise Exception('Failed to probe {}: {}'.format(
+            vod_path, proc.stderr.decode('utf-8', 'replace')))
+    try:
+        return float(proc.stdout.decode('utf-8').strip())
+    except ValueError:
+        return 0.0
+
+# Read the packets of the first video stream of VOD_PATH into an index array.
+# Stream timestamps rarely start at 0 (MPEG-TS starts anywhere), so they're
+# stored relative to the start of the file.
+def probe_packets(vod_path, ffprobe_bin):
+    start_time = probe_start_time(vod_path, ffprobe_bin)
+    proc = subprocess.run([
+        ffprobe_bin,
+        '-v', 'error',
+        '-select_streams', 'v:0',
+        '-show_entries', 'packet=pts_time,pos,size,flags',
+        '-of', 'csv=p=0',
+        vod_path,
+    ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        raise Exception('Failed to index {}: {}'.format(
+            vod_path, proc.stderr.decode('utf-8', 'replace')))
+
+    # ffprobe prints the fields in its own order, not the order asked for
+    rows = []
+    for line in proc.stdout.decode('utf-8').splitlines():
+        fields = line.split(',')
+        if len(fields) < 4 or 'N/A' in fields[:3]:
+            continue
+        pts_time, size, pos, flags = fields[:4]
+        rows.append((float(pts_time) - start_time, int(pos), int(size), 'K' in flags))
+    return numpy.array(rows, dtype=INDEX_DTYPE)
+
+class VodIndex:
+    def __init__(self, packets):
+        self.packets = packets
+        keys = packets[packets['key']]
+        order = numpy.argsort(keys['pts'], kind='stable')
+        self.keyframes = numpy.array(keys['pts'][order])
+        self._keyframe_pos = numpy.array(keys['pos'][order])
+
+        # packets are stored in decode order, which isn't presentation order
+        # once there are B-frames
+        order = numpy.argsort(packets['pts'], kind='stable')
+        self._pts = numpy.array(packets['pts'][order])
+        self._end = numpy.maximum.accumulate(packets['pos'][order] + packets['size'][order])
+
+    # Time of the last frame from the start of the file
+    def duration(self):
+        if len(self._pts) == 0:
+            return 0.0
+        return float(self._pts[-1])
+
+    # Time of the keyframe at or before T, the first keyframe if there is none
+    def keyframe_before(self, t):
+        i = numpy.searchsorted(self.keyframes, t, side='right')
+        return float(self.keyframes[max(i - 1, 0)])
+
+    # Bytes [start, end) of the file holding everything needed to decode the
+    # frames from T0 to T1, starting from the keyframe at or before T0
+    def byte_range(self, t0, t1):
+        i = numpy.searchsorted(self.keyframes, t0, side='right')
+        start = int(self._keyframe_pos[max(i - 1, 0)])
+        j = numpy.searchsorted(self._pts, t1, side='right')
+        end = int(self._end[max(j - 1, 0)])
+        return (start, max(start, end))
+
+def build(vod_path, ffprobe_bin=None):
+    packets = probe_packets(vod_path, ffprobe_bin or find_ffprobe())
+    numpy.save(index_path(vod_path), packets)
+    return VodIndex(packets)
+
+# The index of VOD_PATH, building it first if there isn't one yet or the VOD
+# has changed since
+def load(vod_path, ffprobe_bin=None):
+    path = index_path(vod_path)
+    if not os.path.isfile(path) or os.path.getmtime(path) < os.path.getmtime(vod_path):
+        print('******** indexing {}'.format(vod_path))
+        return build(vod_path, ffprobe_bin)
+    return VodIndex(numpy.load(path, mmap_mode='r'))